@@ -0,0 +1,100 @@
+"""
+Throughput of the bundled pure Python AES (`django_twofactor.pyaes`),
+compared with PyCrypto / PyCryptodome when installed and with a baseline
+PEP-272 module: by default the byte at a time pyaes it replaced
+(`benchmarks/_pyaes_bytewise.py`), or any other one::
+
+    python benchmarks/aes_throughput.py --baseline /path/to/other_aes.py
+    python benchmarks/aes_throughput.py --baseline ""   # no baseline
+
+Two workloads are timed:
+
+* seed: what `decrypt_value` does per login, a fresh key (the salt is
+  part of it) and one or two blocks of ECB decryption;
+* bulk: ECB decryption of many blocks in one call, as in exports.
+
+All modules are checked to produce the same output first.
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BYTEWISE = os.path.join(ROOT, "benchmarks", "_pyaes_bytewise.py")
+
+
+def load_source(name, path):
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        # Python 2
+        import imp
+        return imp.load_source(name, path)
+    spec = spec_from_file_location(name, path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_modules(baseline):
+    from django_twofactor import pyaes
+    modules = [("pyaes", pyaes)]
+    if baseline:
+        modules.append(("baseline", load_source("baseline_aes", baseline)))
+    try:
+        from Crypto.Cipher import AES
+        modules.append(("Crypto", AES))
+    except ImportError:
+        pass
+    return modules
+
+
+def timed(func, repeat):
+    start = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--baseline", default=BYTEWISE,
+                        help="path of another pure Python AES module "
+                             "(default: the byte at a time pyaes)")
+    parser.add_argument("--seeds", type=int, default=2000)
+    parser.add_argument("--blocks", type=int, default=4096)
+    args = parser.parse_args()
+
+    modules = load_modules(args.baseline)
+    keys = [os.urandom(32) for i in range(args.seeds)]
+    seed = os.urandom(32)
+    bulk = os.urandom(16 * args.blocks)
+
+    reference = None
+    for name, module in modules:
+        output = [module.new(key, module.MODE_ECB).decrypt(seed)
+                  for key in keys[:50]]
+        output.append(module.new(keys[0], module.MODE_ECB).decrypt(bulk))
+        if reference is None:
+            reference = output
+        elif output != reference:
+            sys.exit("%s gives different results" % name)
+
+    print("%-10s %14s %12s" % ("", "seeds/s", "bulk MB/s"))
+    for name, module in modules:
+        def seeds():
+            for key in keys:
+                module.new(key, module.MODE_ECB).decrypt(seed)
+
+        cipher = module.new(keys[0], module.MODE_ECB)
+        per_seeds = timed(seeds, 1)
+        per_bulk = timed(lambda: cipher.decrypt(bulk), 1)
+        print("%-10s %14.0f %12.3f" % (
+            name, len(keys) / per_seeds, len(bulk) / per_bulk / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Measures how long `import django_twofactor.models` takes in a fresh
+interpreter, and which heavy backends it drags in.
+
+Usage::
+
+    python benchmarks/import_time.py [runs]
+
+Each run starts a new Python process, sets up a minimal Django
+configuration and times the import of the app's models module during
+`django.setup()`. Django itself is already loaded at that point, so the
+figure is the cost added by django_twofactor.
+"""
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import sys
+import time
+from django.apps import AppConfig
+from django.conf import settings
+settings.configure(
+    SECRET_KEY="bench",
+    INSTALLED_APPS=["django.contrib.auth", "django.contrib.contenttypes",
+                    "django_twofactor"],
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3",
+                           "NAME": ":memory:"}},
+)
+
+import_models = AppConfig.import_models
+
+def timed_import_models(self, *args):
+    start = time.time()
+    import_models(self, *args)
+    if self.name == "django_twofactor":
+        sys.stdout.write("%f\\n" % (time.time() - start))
+
+AppConfig.import_models = timed_import_models
+
+import django
+django.setup()
+for name in ("oath", "Crypto.Cipher.AES", "django_twofactor.pyaes",
+             "django_twofactor.forms"):
+    if name in sys.modules:
+        sys.stdout.write("loaded: %s\\n" % name)
+"""
+
+
+def run_once():
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHILD], env=env, universal_newlines=True)
+    lines = output.splitlines()
+    loaded = [line.split(": ", 1)[1] for line in lines[1:]]
+    return float(lines[0]), loaded
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        seconds, loaded = run_once()
+        timings.append(seconds * 1000)
+    timings.sort()
+    print("import django_twofactor.models, %d runs" % runs)
+    print("  min    %8.2f ms" % timings[0])
+    print("  median %8.2f ms" % timings[len(timings) // 2])
+    print("  max    %8.2f ms" % timings[-1])
+    print("heavy modules loaded: %s" % (", ".join(loaded) or "none"))
+
+
+if __name__ == "__main__":
+    main()
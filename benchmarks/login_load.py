@@ -0,0 +1,311 @@
+"""
+Concurrent login load test for django_twofactor.
+
+Seeds a throw-away SQLite database with users that have TOTP or HOTP tokens,
+then fires `authenticate()` calls at it from a thread (or process) pool:
+every user's correct code is sent several times at once, each time from
+another session as when a phished code is relayed (or, with
+`--same-session`, all from one session, mimicking double-clicks and
+retrying clients), and a few users get a burst of wrong codes to exercise
+the HOTP rate limit. Reports throughput, latency percentiles and whether
+these invariants held:
+
+* no HOTP code was accepted in two sessions,
+* no TOTP time step was accepted in two sessions for a user,
+* HOTP counters advanced exactly once per accepted code,
+* the HOTP rate limit rejected a correct code after too many wrong ones.
+
+Usage::
+
+    python benchmarks/login_load.py --users 500 --concurrency 500
+
+Threads share a locmem cache. With `--processes` the workers share a
+file based cache instead, which is a stand-in only: it is not atomic, so
+expect the cache locks to leak there; add `--shared-memory` to keep the
+locks and rate limits in a `SharedMemoryStore` instead. Pass
+`--real-hasher` to include the cost of PBKDF2 password hashing.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from binascii import hexlify
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = "loadtest-password"
+USERNAME = "load%d"
+
+
+def configure(db_path, cache_dir=None, real_hasher=False, gate_path=None):
+    from django.conf import settings
+    if settings.configured:
+        # A forked pool worker; just drop the parent's connection.
+        from django.db import connections
+        connections.close_all()
+        return
+    if cache_dir:
+        cache = {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": cache_dir,
+        }
+    else:
+        # The default MAX_ENTRIES of 300 would cull locks and rate limit
+        # counters mid-run.
+        cache = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                 "OPTIONS": {"MAX_ENTRIES": 10 ** 6}}
+    options = dict(
+        SECRET_KEY="loadtest",
+        INSTALLED_APPS=["django.contrib.auth", "django.contrib.contenttypes",
+                        "django_twofactor"],
+        DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3",
+                               "NAME": db_path,
+                               "OPTIONS": {"timeout": 60}}},
+        CACHES={"default": cache},
+        AUTHENTICATION_BACKENDS=[
+            "django_twofactor.auth_backends.TwoFactorAuthBackend"],
+    )
+    if gate_path:
+        options["TWOFACTOR_GATE_STORE"] = (
+            "django_twofactor.stores.SharedMemoryStore")
+        options["TWOFACTOR_GATE_STORE_OPTIONS"] = {"path": gate_path}
+    if not real_hasher:
+        options["PASSWORD_HASHERS"] = [
+            "django.contrib.auth.hashers.MD5PasswordHasher"]
+    settings.configure(**options)
+    import django
+    django.setup()
+
+
+def seed(n_users, hotp_ratio):
+    """
+    Creates `n_users` users with bulk inserts and returns a list of
+    `(username, token type, raw seed)`.
+    """
+    from django.contrib.auth.hashers import make_password
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from django_twofactor.models import UserAuthToken
+    from django_twofactor.util import encrypt_value
+
+    call_command("migrate", verbosity=0)
+
+    # Hash once; every user gets the same password.
+    password = make_password(PASSWORD)
+    User.objects.bulk_create(
+        [User(username=USERNAME % i, password=password)
+         for i in range(n_users)], batch_size=500)
+    user_ids = dict(User.objects.values_list("username", "pk"))
+
+    n_hotp = int(n_users * hotp_ratio)
+    plan = []
+    tokens = []
+    for i in range(n_users):
+        username = USERNAME % i
+        token_type = (UserAuthToken.TYPE_HOTP if i < n_hotp
+                      else UserAuthToken.TYPE_TOTP)
+        # Hex text keeps the seed identical after an encrypt/decrypt trip.
+        raw_seed = hexlify(os.urandom(10)).decode("ascii")
+        plan.append((username, token_type, raw_seed))
+        tokens.append(UserAuthToken(
+            user_id=user_ids[username], type=token_type,
+            encrypted_seed=encrypt_value(raw_seed)))
+    UserAuthToken.objects.bulk_create(tokens, batch_size=500)
+    return plan
+
+
+class FakeRequest(object):
+    """
+    Just enough of a request to tell its session apart. It has no
+    address, so that all of them aren't throttled as one client.
+    """
+    META = {}
+
+    def __init__(self, session_key):
+        class Session(object):
+            pass
+        self.session = Session()
+        self.session.session_key = session_key
+
+
+def attempt(username, code, session_key):
+    from django.contrib.auth import authenticate
+    start = time.time()
+    try:
+        user = authenticate(request=FakeRequest(session_key),
+                            username=username, password=PASSWORD, token=code)
+        error = None
+    except Exception as e:
+        user = None
+        error = "%s: %s" % (e.__class__.__name__, e)
+    return time.time() - start, user is not None, error
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def build_attempts(plan, duplicates, ratelimit_users, same_session):
+    """
+    Returns `(attempts, ratelimited)`: the concurrent `(username, code,
+    kind, session key)` attempts, and the usernames that get a burst of
+    wrong codes before their correct one.
+    """
+    from oath import totp
+    from django_twofactor.conf import get_config
+    from django_twofactor.models import UserAuthToken
+    from django_twofactor.util import get_hotp
+
+    config = get_config()
+    attempts = []
+    ratelimited = []
+    for username, token_type, raw_seed in plan:
+        if token_type == UserAuthToken.TYPE_HOTP:
+            if len(ratelimited) < ratelimit_users:
+                ratelimited.append(username)
+                for i in range(config.hotp_ratelimit_count + 5):
+                    attempts.append((username, "%06d" % i, "wrong",
+                                     "%s-wrong-%d" % (username, i)))
+                continue
+            code = get_hotp(raw_seed, 0)
+            kind = "hotp"
+        else:
+            code = totp(hexlify(raw_seed.encode("ascii")).decode("ascii"),
+                        format=config.token_type, period=config.period)
+            kind = "totp"
+        attempts.extend(
+            (username, code, kind,
+             username if same_session else "%s-%d" % (username, i))
+            for i in range(duplicates))
+    return attempts, ratelimited
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--duplicates", type=int, default=3,
+                        help="identical attempts per user")
+    parser.add_argument("--hotp-ratio", type=float, default=0.5)
+    parser.add_argument("--ratelimit-users", type=int, default=10)
+    parser.add_argument("--same-session", action="store_true",
+                        help="send a user's identical attempts from one "
+                             "session instead of one session each")
+    parser.add_argument("--processes", action="store_true")
+    parser.add_argument("--real-hasher", action="store_true")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="keep locks and rate limits in a "
+                             "SharedMemoryStore instead of the cache")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="twofactor-load-")
+    try:
+        return run(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(args, workdir):
+    db_path = os.path.join(workdir, "db.sqlite3")
+    cache_dir = os.path.join(workdir, "cache") if args.processes else None
+    gate_path = os.path.join(workdir, "gates") if args.shared_memory else None
+    configure(db_path, cache_dir, args.real_hasher, gate_path)
+
+    from django.db import connection
+    from django_twofactor.models import UserAuthToken
+    from django_twofactor.util import get_hotp
+
+    start = time.time()
+    plan = seed(args.users, args.hotp_ratio)
+    print("seeded %d users in %.2f s" % (len(plan), time.time() - start))
+    # Workers open their own connections.
+    connection.close()
+
+    attempts, ratelimited = build_attempts(
+        plan, args.duplicates, args.ratelimit_users, args.same_session)
+
+    if args.processes:
+        pool = ProcessPoolExecutor(
+            max_workers=args.concurrency, initializer=configure,
+            initargs=(db_path, cache_dir, args.real_hasher, gate_path))
+    else:
+        pool = ThreadPoolExecutor(max_workers=args.concurrency)
+
+    start = time.time()
+    with pool:
+        futures = [pool.submit(attempt, username, code, session_key)
+                   for username, code, kind, session_key in attempts]
+        results = [future.result() for future in futures]
+        wall = time.time() - start
+
+        # The correct code after a burst of wrong ones must be refused.
+        seeds = dict((username, raw_seed) for username, _, raw_seed in plan)
+        leaked = sum(
+            1 for username in ratelimited
+            if pool.submit(attempt, username, get_hotp(seeds[username], 0),
+                           username + "-late").result()[1])
+
+    latencies = sorted(result[0] * 1000 for result in results)
+    errors = Counter(result[2] for result in results if result[2])
+    accepted = Counter()
+    accepted_per_user = Counter()
+    sessions = {}
+    for (username, code, kind, session_key), (_, ok, _) in zip(
+            attempts, results):
+        if ok:
+            accepted[kind] += 1
+            sessions.setdefault((username, code), set()).add(session_key)
+    # One code may log in one session, however often it is sent from it.
+    for key, session_keys in sessions.items():
+        accepted_per_user[key] = len(session_keys)
+
+    print("attempts      %d in %.2f s, %.1f logins/s"
+          % (len(attempts), wall, len(attempts) / wall))
+    print("latency ms    p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % (
+        percentile(latencies, 0.5), percentile(latencies, 0.9),
+        percentile(latencies, 0.99), latencies[-1]))
+    print("accepted      totp %d  hotp %d  wrong %d"
+          % (accepted["totp"], accepted["hotp"], accepted["wrong"]))
+    for error, count in errors.most_common(5):
+        print("error         %dx %s" % (count, error))
+
+    counters = dict(UserAuthToken.objects.values_list(
+        "user__username", "counter"))
+    hotp_users = set(attempt[0] for attempt in attempts
+                     if attempt[2] == "hotp")
+    kinds = dict(((username, code), kind)
+                 for username, code, kind, session_key in attempts)
+    double_hotp = sum(1 for key, count in accepted_per_user.items()
+                      if kinds[key] == "hotp" and count > 1)
+    double_totp = sum(1 for key, count in accepted_per_user.items()
+                      if kinds[key] == "totp" and count > 1)
+    counter_mismatch = sum(
+        1 for username in hotp_users
+        if counters.get(username, 0) != sum(
+            count for (name, code), count in accepted_per_user.items()
+            if name == username))
+
+    checks = [
+        ("no HOTP code accepted in two sessions", double_hotp),
+        ("no TOTP time step accepted in two sessions", double_totp),
+        ("HOTP counters match accepted codes", counter_mismatch),
+        ("wrong codes never accepted", accepted["wrong"]),
+        ("rate limit held after wrong-code bursts", leaked),
+    ]
+    print("invariants")
+    for name, violations in checks:
+        print("  [%s] %s (%d violations)"
+              % ("ok" if not violations else "FAIL", name, violations))
+    return 1 if any(violations for name, violations in checks) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
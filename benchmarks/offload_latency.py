@@ -0,0 +1,121 @@
+"""
+Tail latency of a threaded worker while it verifies codes, with the
+pure Python AES fallback, with and without `TWOFACTOR_OFFLOAD_WORKERS`.
+
+`--threads` threads keep checking wrong TOTP codes against devices whose
+seed isn't decrypted yet (the cost of a login), while one more thread
+stands in for the worker's other requests: every few milliseconds it
+does a little pure Python work and records how long that took from when
+it was due. Without offloading, decryption holds the GIL and those
+requests queue up behind it::
+
+    python benchmarks/offload_latency.py --threads 8 --workers 2
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from binascii import hexlify
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def configure(workers, batch_size):
+    from django.conf import settings
+    settings.configure(
+        SECRET_KEY="offload",
+        INSTALLED_APPS=["django.contrib.auth", "django.contrib.contenttypes",
+                        "django_twofactor"],
+        DATABASES={},
+        # Wrong codes only; no locks needed.
+        TWOFACTOR_TOTP_CACHE_LOCKS=False,
+        TWOFACTOR_OFFLOAD_WORKERS=workers,
+        TWOFACTOR_OFFLOAD_BATCH_SIZE=batch_size,
+    )
+    import django
+    django.setup()
+    from django_twofactor import encutil, pyaes
+    encutil._AES = pyaes
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def run(args):
+    from django_twofactor.models import UserAuthToken
+    from django_twofactor.offload import get_pool
+    from django_twofactor.util import encrypt_value
+
+    seeds = [encrypt_value(hexlify(os.urandom(10)).decode("ascii"))
+             for i in range(100)]
+    if get_pool() is not None:
+        # Start the workers before timing.
+        get_pool().run("hotp", seeds[0], "000000", 0)
+
+    stop = threading.Event()
+    logins, requests = [], []
+
+    def login_loop(n):
+        i = n
+        while not stop.is_set():
+            token = UserAuthToken(pk=i, encrypted_seed=seeds[i % len(seeds)])
+            start = time.time()
+            token.check_auth_code("000000")
+            logins.append(time.time() - start)
+            i += args.threads
+
+    def request_loop():
+        due = time.time()
+        while not stop.is_set():
+            due += args.interval / 1000.0
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            sum(range(2000))
+            requests.append(time.time() - due)
+
+    threads = [threading.Thread(target=login_loop, args=(n,))
+               for n in range(args.threads)]
+    threads.append(threading.Thread(target=request_loop))
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    for name, values in (("logins", logins), ("requests", requests)):
+        values.sort()
+        print("%-9s %6d  p50 %7.2f  p99 %7.2f  max %7.2f ms" % (
+            name, len(values), percentile(values, 0.5) * 1000,
+            percentile(values, 0.99) * 1000, values[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="offload processes, 0 to verify in process")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--interval", type=float, default=5.0,
+                        help="ms between the other requests")
+    args = parser.parse_args()
+    configure(args.workers, args.batch_size)
+    print("%d login threads, %s" % (
+        args.threads, "%d offload workers" % args.workers
+        if args.workers else "no offloading"))
+    run(args)
+    from django_twofactor.offload import get_pool
+    if get_pool() is not None:
+        get_pool().shutdown()
+
+
+if __name__ == "__main__":
+    main()
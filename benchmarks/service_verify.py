@@ -0,0 +1,144 @@
+"""
+Compares in-process token verification with the verification service in
+`django_twofactor.service`, one attempt per request and batched.
+
+Usage::
+
+    python benchmarks/service_verify.py [--users 200] [--batch 50]
+
+The service runs on a threaded wsgiref server on localhost in the same
+process, so the numbers show protocol and batching overhead, not network
+latency. Every attempt uses a distinct wrong code so that each one does
+the full work: token query, cache locks, seed decryption and the HMAC
+window.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from binascii import hexlify
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def configure(db_path):
+    from django.conf import settings
+    settings.configure(
+        SECRET_KEY="bench",
+        INSTALLED_APPS=["django.contrib.auth", "django.contrib.contenttypes",
+                        "django_twofactor"],
+        DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3",
+                               "NAME": db_path,
+                               "CONN_MAX_AGE": None}},
+        CACHES={"default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+        TWOFACTOR_SERVICE_TOKEN="bench",
+    )
+    import django
+    django.setup()
+
+
+def seed(n_users):
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from django_twofactor.models import UserAuthToken
+    from django_twofactor.util import encrypt_value
+
+    call_command("migrate", verbosity=0)
+    User.objects.bulk_create(
+        [User(username="bench%d" % i) for i in range(n_users)])
+    users = list(User.objects.order_by("pk"))
+    UserAuthToken.objects.bulk_create([
+        UserAuthToken(
+            user=user,
+            type=UserAuthToken.TYPE_TOTP if i % 2 else UserAuthToken.TYPE_HOTP,
+            encrypted_seed=encrypt_value(hexlify(os.urandom(10)).decode()))
+        for i, user in enumerate(users)])
+    return users
+
+
+def timed(label, n, func):
+    from django.core.cache import cache
+    cache.clear()
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print("%-28s %8.1f verifications/s  %7.3f ms each"
+          % (label, n / elapsed, elapsed * 1000 / n))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--batch", type=int, default=50)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="twofactor-service-")
+    try:
+        configure(os.path.join(workdir, "db.sqlite3"))
+        run(args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(args):
+    from django.test.utils import override_settings
+    from django_twofactor.models import UserAuthToken
+    from django_twofactor.service import application, verify_remote
+
+    users = seed(args.users)
+    server = make_server("127.0.0.1", 0, application,
+                         server_class=ThreadingWSGIServer,
+                         handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d/" % server.server_port
+
+    attempts = [(user.pk, "%06d" % (n * len(users) + i))
+                for n in range(args.rounds) for i, user in enumerate(users)]
+
+    def in_process():
+        for user, code in zip(users * args.rounds, (a[1] for a in attempts)):
+            tokens = UserAuthToken.objects.active_for_user(user)
+            UserAuthToken.objects.match_auth_code(tokens, code)
+
+    def single():
+        for attempt in attempts:
+            verify_remote([attempt])
+
+    def batched():
+        for i in range(0, len(attempts), args.batch):
+            verify_remote(attempts[i:i + args.batch])
+
+    with override_settings(TWOFACTOR_SERVICE_URL=url):
+        # The first pass through the service decrypts and caches seeds.
+        verify_remote(attempts[:len(users)])
+        timed("in-process", len(attempts), in_process)
+        timed("service, 1 per request", len(attempts), single)
+        timed("service, %d per request" % args.batch, len(attempts), batched)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+def warm_up():
+    """
+    Loads the OTP and AES backends, the forms and the configuration up front
+    instead of on the first login. Call it after `django.setup()`, e.g. from
+    a gunicorn `on_starting` hook with `preload_app`, so that forked workers
+    start warm.
+    """
+    from django_twofactor import conf, encutil, util
+    conf.get_config()
+    util.load_oath()
+    encutil.load_aes()
+
+    # Imported only to have the form machinery loaded.
+    from django_twofactor import auth_forms, forms  # noqa
@@ -0,0 +1,10 @@
+from django.contrib import admin
+
+from django_twofactor.adminsite import UserAuthTokenAdmin, twofactor_admin_site
+from django_twofactor.models import UserAuthToken
+
+
+# With the recommended `admin.site = twofactor_admin_site` (see the demo's
+# urls.py) the model is registered already.
+if admin.site is not twofactor_admin_site:
+    admin.site.register(UserAuthToken, UserAuthTokenAdmin)
@@ -1,16 +1,26 @@
+from django.contrib import admin
 from django.contrib.admin.sites import AdminSite
-from django_twofactor.auth_forms import TwoFactorAdminAuthenticationForm
-from django_twofactor.forms import (ResetTwoFactorAuthForm,
-    DisableTwoFactorAuthForm)
-from django.shortcuts import render_to_response
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.shortcuts import render, render_to_response
 from django.template import RequestContext
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext_lazy as _
+from django_twofactor import verification
 from django_twofactor.models import UserAuthToken
 
 class TwoFactorAuthAdminSite(AdminSite):
-    login_form = TwoFactorAdminAuthenticationForm
     login_template = "twofactor_admin/twofactor_login.html"
     password_change_template = "twofactor_admin/registration/password_change_form.html"
 
+    @property
+    def login_form(self):
+        # Imported here so that importing the admin site doesn't pull in
+        # the form machinery before it is needed.
+        from django_twofactor.auth_forms import TwoFactorAdminAuthenticationForm
+        return TwoFactorAdminAuthenticationForm
+
     def get_urls(self):
         try:
             from django.conf.urls import url
@@ -21,6 +31,9 @@ class TwoFactorAuthAdminSite(AdminSite):
             url(r'^twofactor_auth_setup/$',
                 self.twofactor_config,
                 name="twofactor_config"),
+            url(r'^twofactor_dashboard/$',
+                self.admin_view(self.dashboard),
+                name="twofactor_dashboard"),
         ]
         urlpatterns += super(TwoFactorAuthAdminSite, self).get_urls()
 
@@ -30,13 +43,19 @@ class TwoFactorAuthAdminSite(AdminSite):
         """
         Handles two-factor authenticator configuration.
         """
+        from django_twofactor.forms import (ResetTwoFactorAuthForm,
+            DisableTwoFactorAuthForm)
+        from django_twofactor.middleware import get_user_tokens
+
+        tokens = get_user_tokens(request)
+
         disableform = None
         resetform = None
         if (request.method == "POST")\
         and ("reset_confirmation" in request.POST):
             # We are resetting the user's two-factor key.
             resetform = ResetTwoFactorAuthForm(user=request.user,
-                data=request.POST)
+                tokens=tokens, data=request.POST)
             if resetform.is_valid():
                 token = resetform.save()
                 return render_to_response(
@@ -57,11 +76,12 @@ class TwoFactorAuthAdminSite(AdminSite):
                     context_instance=RequestContext(request)
                 )
         if not resetform:
-            resetform = ResetTwoFactorAuthForm(user=request.user)
+            resetform = ResetTwoFactorAuthForm(user=request.user,
+                tokens=tokens)
         if not disableform:
             disableform = DisableTwoFactorAuthForm(user=request.user)
 
-        has_token = bool(UserAuthToken.objects.filter(user=request.user))
+        has_token = any(token.is_active for token in tokens)
 
         return render_to_response(
             "twofactor_admin/registration/twofactor_config.html",
@@ -73,5 +93,99 @@ class TwoFactorAuthAdminSite(AdminSite):
             context_instance=RequestContext(request)
         )
 
+    def dashboard(self, request):
+        """
+        Two-factor adoption and health figures, from the cache (see
+        `django_twofactor.dashboard`).
+        """
+        from django_twofactor.dashboard import get_stats
+
+        if not request.user.has_perm("django_twofactor.change_userauthtoken"):
+            raise PermissionDenied
+        return render(request, "twofactor_admin/dashboard.html", dict(
+            self.each_context(request),
+            title=_("Two-factor authentication dashboard"),
+            stats=get_stats(),
+        ))
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that doesn't `COUNT(*)` a large unfiltered table: on
+    PostgreSQL and MySQL it uses the planner's row estimate instead once
+    that goes over `exact_count_limit`.
+    """
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        if not query.where:
+            estimate = self._estimated_count()
+            if estimate is not None and estimate > self.exact_count_limit:
+                return estimate
+        return super(EstimatedCountPaginator, self).count
+
+    def _estimated_count(self):
+        model = self.object_list.model
+        connection = connections[self.object_list.db]
+        table = model._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute(
+                    "SELECT reltuples FROM pg_class WHERE relname = %s",
+                    [table])
+            elif connection.vendor == "mysql":
+                cursor.execute(
+                    "SELECT table_rows FROM information_schema.tables "
+                    "WHERE table_schema = DATABASE() AND table_name = %s",
+                    [table])
+            else:
+                return None
+            row = cursor.fetchone()
+        return int(row[0]) if row else None
+
+
+class UserAuthTokenAdmin(admin.ModelAdmin):
+    list_display = ("user", "name", "type", "is_active", "counter",
+                    "created_datetime", "updated_datetime", "last_used")
+    list_filter = ("type", "is_active")
+    list_select_related = ("user",)
+    search_fields = ("=user__username", "name")
+    fields = ("user", "name", "type", "is_active", "counter",
+              "last_time_step", "created_datetime", "updated_datetime",
+              "last_used")
+    readonly_fields = ("user", "type", "counter", "last_time_step",
+                       "created_datetime", "updated_datetime", "last_used")
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ["disable_tokens", "enable_tokens", "force_reenroll"]
+
+    def has_add_permission(self, request):
+        # Seeds are only ever created through enrollment.
+        return False
+
+    def disable_tokens(self, request, queryset):
+        user_ids = set(queryset.values_list("user_id", flat=True))
+        updated = queryset.update(is_active=False)
+        # update() sends no signals, so void the sessions explicitly.
+        verification.revoke(user_ids)
+        self.message_user(request, _("Disabled %d devices.") % updated)
+    disable_tokens.short_description = _("Disable selected devices")
+
+    def enable_tokens(self, request, queryset):
+        updated = queryset.update(is_active=True)
+        self.message_user(request, _("Enabled %d devices.") % updated)
+    enable_tokens.short_description = _("Enable selected devices")
+
+    def force_reenroll(self, request, queryset):
+        deleted = queryset.delete()[0]
+        self.message_user(
+            request, _("Removed %d devices; their users need to enroll "
+                       "again.") % deleted)
+    force_reenroll.short_description = _(
+        "Remove selected devices to force re-enrollment")
+
 
 twofactor_admin_site = TwoFactorAuthAdminSite()
+twofactor_admin_site.register(UserAuthToken, UserAuthTokenAdmin)
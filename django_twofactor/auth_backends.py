@@ -1,26 +1,92 @@
+import logging
+from functools import wraps
+
 from django.contrib.auth.models import User
 from django.contrib.auth.backends import ModelBackend
-from django_twofactor.models import UserAuthToken
+from django_twofactor import routers, throttle
+from django_twofactor.models import UserAuthToken, request_caller
+
+
+logger = logging.getLogger(__name__)
+
+
+def throttled(authenticate):
+    """
+    Refuses throttled usernames and addresses before `authenticate` hashes
+    the password, and counts the attempts it fails (see
+    `django_twofactor.throttle`).
+    """
+    @wraps(authenticate)
+    def wrapper(self, request=None, username=None, password=None, token=None):
+        ip = throttle.client_ip(request)
+        if throttle.is_throttled(username, ip):
+            return None
+        user = authenticate(self, request=request, username=username,
+                            password=password, token=token)
+        if user is None:
+            throttle.record_failure(username, ip)
+        return user
+    return wrapper
+
 
 class TwoFactorAuthBackend(ModelBackend):
-    def authenticate(self, username=None, password=None, token=None):
-        # Validate username and password first
-        user_or_none = super(TwoFactorAuthBackend, self).authenticate(username, password)
+    @throttled
+    def authenticate(self, request=None, username=None, password=None, token=None):
+        # Validate username and password first. `request` is passed by
+        # keyword: it goes to **kwargs on Django versions that don't take it.
+        user_or_none = super(TwoFactorAuthBackend, self).authenticate(
+            request=request, username=username, password=password)
         
         if user_or_none and isinstance(user_or_none, User):
-            # Got a valid login. Now check token.
-            try:
-                user_token = UserAuthToken.objects.get(user=user_or_none)
-            except UserAuthToken.DoesNotExist:
+            # Got a valid login. Now check token against all of the user's
+            # devices, as they are on the primary.
+            routers.pin_primary()
+            user_tokens = UserAuthToken.objects.active_for_user(user_or_none)
+            if not user_tokens:
                 # User doesn't have two-factor authentication enabled, so
                 # just return the User object.
                 return user_or_none
             
-            validate = user_token.check_auth_code(token)
-            if (validate == True):
-                # Auth code was valid.
+            matched = UserAuthToken.objects.match_auth_code(
+                user_tokens, token, request_caller(request))
+            if matched is not None:
+                # Auth code was valid. Let the caller know which device
+                # it came from.
+                user_or_none.twofactor_token = matched
                 return user_or_none
             else:
                 # Bad auth code
                 return None
         return user_or_none
+
+
+class ServiceTwoFactorAuthBackend(ModelBackend):
+    """
+    Drop-in for `TwoFactorAuthBackend` that leaves the token check to the
+    verification service (see `django_twofactor.service`), so that this
+    node never decrypts seeds. `user.twofactor_token` is set to an unsaved
+    `UserAuthToken` carrying only the matched device's id, name and type.
+    """
+    @throttled
+    def authenticate(self, request=None, username=None, password=None, token=None):
+        from django_twofactor.service import verify_remote
+
+        user_or_none = super(ServiceTwoFactorAuthBackend, self).authenticate(
+            request=request, username=username, password=password)
+
+        if user_or_none and isinstance(user_or_none, User):
+            try:
+                result = verify_remote([(user_or_none.pk, token)])[0]
+            except Exception:
+                # Fail closed: no login while the service can't be asked.
+                logger.exception("Two-factor verification service failed")
+                return None
+
+            if not result["enabled"]:
+                return user_or_none
+            if result["token"] is not None:
+                user_or_none.twofactor_token = UserAuthToken(
+                    user=user_or_none, **result["token"])
+                return user_or_none
+            return None
+        return user_or_none
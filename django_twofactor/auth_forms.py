@@ -3,6 +3,7 @@ from django.contrib.auth.forms import AuthenticationForm
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth import authenticate
 
+from django_twofactor import throttle
 from django_twofactor.models import UserAuthToken
 
 
@@ -10,6 +11,9 @@ ERROR_MESSAGE = _("Please enter the correct username, password and "
     "authentication code (if applicable). Note that all fields are "
     "case-sensitive.")
 
+THROTTLED_MESSAGE = _("Too many failed login attempts. Please try again "
+    "later.")
+
 
 class TwoFactorAuthenticationForm(AuthenticationForm):
     """ Allow two-factor login, either with username or email """
@@ -24,6 +28,13 @@ class TwoFactorAuthenticationForm(AuthenticationForm):
         password = self.cleaned_data.get('password')
         token = self.cleaned_data.get('token')
 
+        # Checked before any query, by the username as entered. The backend
+        # checks again and counts the failures, since it is also reached
+        # without this form.
+        ip = throttle.client_ip(self.request)
+        if throttle.is_throttled(username, ip):
+            raise forms.ValidationError(THROTTLED_MESSAGE)
+
         try:
             from django.contrib.auth import get_user_model
             User = get_user_model()
@@ -39,9 +50,14 @@ class TwoFactorAuthenticationForm(AuthenticationForm):
                 username = u.username
             except User.DoesNotExist:
                 pass
+            else:
+                # By the username the backend counts under.
+                if throttle.is_throttled(username, ip):
+                    raise forms.ValidationError(THROTTLED_MESSAGE)
 
         if username and password:
-            self.user_cache = authenticate(username=username, password=password, token=token)
+            self.user_cache = authenticate(request=self.request,
+                username=username, password=password, token=token)
             if self.user_cache is None:
                 raise forms.ValidationError(ERROR_MESSAGE)
             elif not self.user_cache.is_active:
@@ -63,9 +79,10 @@ class TwoFactorMixin(object):
     def __init__(self, user):
         self.user = user
 
-        try:
-            self.user_auth_token = UserAuthToken.objects.get(user=self.user)
-        except UserAuthToken.DoesNotExist:
+        self.user_auth_tokens = UserAuthToken.objects.active_for_user(self.user)
+        if self.user_auth_tokens:
+            self.user_auth_token = self.user_auth_tokens[0]
+        else:
             self.user_auth_token = None
 
         if self.user_auth_token:
@@ -80,7 +97,9 @@ class TwoFactorMixin(object):
         assert self.user_auth_token, "User has two-factor authentication disabled. Should not end up here."
 
         token = self.cleaned_data.get('token')
-        if not self.user_auth_token.check_auth_code(token):
+        matched = UserAuthToken.objects.match_auth_code(
+            self.user_auth_tokens, token)
+        if matched is None:
             if self.user_token.type == UserAuthToken.TYPE_HOTP:
                 raise forms.ValidationError(_(u"This doesn't seem to match with the code on the paper. Please try again."))
             else:
@@ -0,0 +1,325 @@
+"""
+Settings for django_twofactor, validated and gathered into one immutable
+object. The object is built on first use and dropped whenever one of the
+settings it depends on changes (e.g. with `override_settings`), so it is
+always current without re-reading settings on every verification.
+"""
+
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    # Django < 1.8; importing django.test is slow, so only do it here.
+    from django.test.signals import setting_changed
+
+# Durations (latency budgets, flush intervals) are measured with this, not
+# with `TWOFACTOR_CLOCK`, which can jump or be a test's fake.
+perf_counter = getattr(time, "perf_counter", time.time)
+
+
+SETTING_NAMES = frozenset([
+    "TWOFACTOR_TOTP_OPTIONS",
+    "TWOFACTOR_ENCRYPTION_KEY",
+    "TWOFACTOR_TOTP_CACHE_LOCKS",
+    "TWOFACTOR_CLOCK",
+    "TWOFACTOR_READ_DATABASE",
+    "TWOFACTOR_WRITE_DATABASE",
+    "TWOFACTOR_GRIDCARD_CACHE_KEY",
+    "TWOFACTOR_GRIDCARD_CACHE_TIME",
+    "TWOFACTOR_GRIDCARD_POOL_SIZE",
+    "HOTP_MAX_COUNTER",
+    "HOTP_RATELIMIT_COUNT",
+    "HOTP_RATELIMIT_TIMEFRAME",
+    "TWOFACTOR_SERVICE_URL",
+    "TWOFACTOR_SERVICE_TOKEN",
+    "TWOFACTOR_SERVICE_TIMEOUT",
+    "TWOFACTOR_SERVICE_SEED_CACHE_SIZE",
+    "TWOFACTOR_LOW_CODES_NOTIFIER",
+    "TWOFACTOR_THROTTLE_USERNAME_COUNT",
+    "TWOFACTOR_THROTTLE_IP_COUNT",
+    "TWOFACTOR_THROTTLE_ACCOUNT_COUNT",
+    "TWOFACTOR_THROTTLE_TIMEFRAME",
+    "TWOFACTOR_THROTTLE_IP_HEADER",
+    "TWOFACTOR_VERIFY_URL",
+    "TWOFACTOR_REQUIRED_PATHS",
+    "TWOFACTOR_GRANT_TTL",
+    "TWOFACTOR_GATE_STORE",
+    "TWOFACTOR_GATE_STORE_OPTIONS",
+    "TWOFACTOR_GATE_TIMEOUT",
+    "TWOFACTOR_GATE_FAILURES",
+    "TWOFACTOR_GATE_RESET",
+    "TWOFACTOR_GATE_FALLBACK_SIZE",
+    "TWOFACTOR_OFFLOAD_WORKERS",
+    "TWOFACTOR_OFFLOAD_BATCH_SIZE",
+    "TWOFACTOR_OFFLOAD_TIMEOUT",
+    "TWOFACTOR_LAST_USED_INTERVAL",
+    "TWOFACTOR_DASHBOARD_TTL",
+    "TWOFACTOR_SHADOW_ENGINE",
+    "TWOFACTOR_SHADOW_SINK",
+    "TWOFACTOR_SHADOW_SAMPLE_RATE",
+    "TWOFACTOR_SHADOW_MAX_OVERHEAD",
+])
+
+TOKEN_LENGTHS = {
+    "dec4": 4,
+    "dec6": 6,
+    "dec7": 7,
+    "dec8": 8,
+    "hex40": 40,
+}
+
+
+class TwoFactorConfig(namedtuple("TwoFactorConfig", [
+        "period",
+        "forward_drift",
+        "backward_drift",
+        "drift_range",
+        "drift_search_order",
+        "max_forward_drift",
+        "max_backward_drift",
+        "clock",
+        "token_type",
+        "token_length",
+        "encryption_key",
+        "totp_cache_locks",
+        "hotp_max_counter",
+        "hotp_ratelimit_count",
+        "hotp_ratelimit_timeframe",
+        "gridcard_cache_key",
+        "gridcard_cache_time",
+        "gridcard_pool_size",
+        "service_url",
+        "service_token",
+        "service_timeout",
+        "service_seed_cache_size",
+        "low_codes_notifier",
+        "read_database",
+        "write_database",
+        "throttle_username_count",
+        "throttle_ip_count",
+        "throttle_account_count",
+        "throttle_timeframe",
+        "throttle_ip_header",
+        "verify_url",
+        "required_paths",
+        "grant_ttl",
+        "gate_store",
+        "gate_store_options",
+        "gate_timeout",
+        "gate_failures",
+        "gate_reset",
+        "gate_fallback_size",
+        "offload_workers",
+        "offload_batch_size",
+        "offload_timeout",
+        "last_used_interval",
+        "dashboard_ttl",
+        "shadow_engine",
+        "shadow_sink",
+        "shadow_sample_rate",
+        "shadow_max_overhead",
+        ])):
+    """
+    The effective configuration. `drift_range` holds the TOTP time step
+    offsets to try, `drift_search_order` the same nearest first, and
+    `token_length` the number of characters in a code. `clock` returns the
+    current time in seconds since the epoch.
+    """
+    __slots__ = ()
+
+
+def _positive_int(name, value, allow_zero=False):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ImproperlyConfigured("%s must be an integer" % name)
+    if value < 0 or (value == 0 and not allow_zero):
+        raise ImproperlyConfigured("%s must be positive" % name)
+    return value
+
+
+def _fraction(name, value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ImproperlyConfigured("%s must be a number" % name)
+    if not 0 <= value <= 1:
+        raise ImproperlyConfigured("%s must be between 0 and 1" % name)
+    return value
+
+
+def build_config():
+    """ Reads and validates the settings. """
+    totp_options = getattr(settings, "TWOFACTOR_TOTP_OPTIONS", {})
+    period = _positive_int("TWOFACTOR_TOTP_OPTIONS['period']",
+                           totp_options.get("period", 30))
+    forward_drift = _positive_int(
+        "TWOFACTOR_TOTP_OPTIONS['forward_drift']",
+        totp_options.get("forward_drift", 1), allow_zero=True)
+    backward_drift = _positive_int(
+        "TWOFACTOR_TOTP_OPTIONS['backward_drift']",
+        totp_options.get("backward_drift", 1), allow_zero=True)
+    # How far (in time steps) a device's tracked drift may take the search
+    # window, each way. By default no further than the window itself
+    # reaches in that direction; `max_drift` sets both.
+    max_drift = totp_options.get("max_drift")
+    max_forward_drift = _positive_int(
+        "TWOFACTOR_TOTP_OPTIONS['max_forward_drift']",
+        totp_options.get("max_forward_drift", forward_drift
+                         if max_drift is None else max_drift),
+        allow_zero=True)
+    max_backward_drift = _positive_int(
+        "TWOFACTOR_TOTP_OPTIONS['max_backward_drift']",
+        totp_options.get("max_backward_drift", backward_drift
+                         if max_drift is None else max_drift),
+        allow_zero=True)
+    drift_range = tuple(range(-backward_drift, forward_drift + 1))
+
+    clock = getattr(settings, "TWOFACTOR_CLOCK", None) or time.time
+    if not callable(clock):
+        clock = import_string(clock)
+
+    # note: Google Authenticator only outputs dec6, so changing this
+    # will result in incompatibility
+    token_type = totp_options.get("default_token_type", "dec6")
+    if token_type not in TOKEN_LENGTHS:
+        raise ImproperlyConfigured(
+            "Unknown TWOFACTOR_TOTP_OPTIONS['default_token_type'] %r"
+            % (token_type,))
+
+    shadow_engine = getattr(settings, "TWOFACTOR_SHADOW_ENGINE", None)
+
+    return TwoFactorConfig(
+        period=period,
+        forward_drift=forward_drift,
+        backward_drift=backward_drift,
+        drift_range=drift_range,
+        drift_search_order=tuple(sorted(drift_range, key=abs)),
+        max_forward_drift=max_forward_drift,
+        max_backward_drift=max_backward_drift,
+        clock=clock,
+        token_type=token_type,
+        token_length=TOKEN_LENGTHS[token_type],
+        encryption_key=getattr(settings, "TWOFACTOR_ENCRYPTION_KEY", ""),
+        totp_cache_locks=bool(
+            getattr(settings, "TWOFACTOR_TOTP_CACHE_LOCKS", True)),
+        hotp_max_counter=_positive_int(
+            "HOTP_MAX_COUNTER", getattr(settings, "HOTP_MAX_COUNTER", 100)),
+        hotp_ratelimit_count=_positive_int(
+            "HOTP_RATELIMIT_COUNT",
+            getattr(settings, "HOTP_RATELIMIT_COUNT", 30)),
+        hotp_ratelimit_timeframe=_positive_int(
+            "HOTP_RATELIMIT_TIMEFRAME",
+            getattr(settings, "HOTP_RATELIMIT_TIMEFRAME", 3600)),
+        gridcard_cache_key=getattr(
+            settings, "TWOFACTOR_GRIDCARD_CACHE_KEY",
+            "twofactor-gridcard-{0}"),
+        gridcard_cache_time=_positive_int(
+            "TWOFACTOR_GRIDCARD_CACHE_TIME",
+            getattr(settings, "TWOFACTOR_GRIDCARD_CACHE_TIME", 24 * 60 * 60)),
+        gridcard_pool_size=_positive_int(
+            "TWOFACTOR_GRIDCARD_POOL_SIZE",
+            getattr(settings, "TWOFACTOR_GRIDCARD_POOL_SIZE", 0),
+            allow_zero=True),
+        service_url=getattr(settings, "TWOFACTOR_SERVICE_URL", None),
+        service_token=getattr(settings, "TWOFACTOR_SERVICE_TOKEN", ""),
+        service_timeout=float(
+            getattr(settings, "TWOFACTOR_SERVICE_TIMEOUT", 2.0)),
+        service_seed_cache_size=_positive_int(
+            "TWOFACTOR_SERVICE_SEED_CACHE_SIZE",
+            getattr(settings, "TWOFACTOR_SERVICE_SEED_CACHE_SIZE", 100000)),
+        low_codes_notifier=getattr(
+            settings, "TWOFACTOR_LOW_CODES_NOTIFIER", None),
+        read_database=getattr(settings, "TWOFACTOR_READ_DATABASE", None),
+        write_database=getattr(
+            settings, "TWOFACTOR_WRITE_DATABASE", "default"),
+        throttle_username_count=_positive_int(
+            "TWOFACTOR_THROTTLE_USERNAME_COUNT",
+            getattr(settings, "TWOFACTOR_THROTTLE_USERNAME_COUNT", 20),
+            allow_zero=True),
+        throttle_ip_count=_positive_int(
+            "TWOFACTOR_THROTTLE_IP_COUNT",
+            getattr(settings, "TWOFACTOR_THROTTLE_IP_COUNT", 200),
+            allow_zero=True),
+        throttle_account_count=_positive_int(
+            "TWOFACTOR_THROTTLE_ACCOUNT_COUNT",
+            getattr(settings, "TWOFACTOR_THROTTLE_ACCOUNT_COUNT", 100),
+            allow_zero=True),
+        throttle_timeframe=_positive_int(
+            "TWOFACTOR_THROTTLE_TIMEFRAME",
+            getattr(settings, "TWOFACTOR_THROTTLE_TIMEFRAME", 300)),
+        throttle_ip_header=getattr(
+            settings, "TWOFACTOR_THROTTLE_IP_HEADER", None),
+        verify_url=getattr(settings, "TWOFACTOR_VERIFY_URL", None),
+        required_paths=tuple(
+            getattr(settings, "TWOFACTOR_REQUIRED_PATHS", ())),
+        grant_ttl=_positive_int(
+            "TWOFACTOR_GRANT_TTL",
+            getattr(settings, "TWOFACTOR_GRANT_TTL", 0), allow_zero=True),
+        gate_store=import_string(getattr(
+            settings, "TWOFACTOR_GATE_STORE",
+            "django_twofactor.stores.CacheStore")),
+        gate_store_options=dict(
+            getattr(settings, "TWOFACTOR_GATE_STORE_OPTIONS", {})),
+        gate_timeout=float(getattr(settings, "TWOFACTOR_GATE_TIMEOUT", 0.1)),
+        gate_failures=_positive_int(
+            "TWOFACTOR_GATE_FAILURES",
+            getattr(settings, "TWOFACTOR_GATE_FAILURES", 5),
+            allow_zero=True),
+        gate_reset=_positive_int(
+            "TWOFACTOR_GATE_RESET",
+            getattr(settings, "TWOFACTOR_GATE_RESET", 30)),
+        gate_fallback_size=_positive_int(
+            "TWOFACTOR_GATE_FALLBACK_SIZE",
+            getattr(settings, "TWOFACTOR_GATE_FALLBACK_SIZE", 10000)),
+        offload_workers=_positive_int(
+            "TWOFACTOR_OFFLOAD_WORKERS",
+            getattr(settings, "TWOFACTOR_OFFLOAD_WORKERS", 0),
+            allow_zero=True),
+        offload_batch_size=_positive_int(
+            "TWOFACTOR_OFFLOAD_BATCH_SIZE",
+            getattr(settings, "TWOFACTOR_OFFLOAD_BATCH_SIZE", 32)),
+        offload_timeout=float(
+            getattr(settings, "TWOFACTOR_OFFLOAD_TIMEOUT", 1.0)),
+        last_used_interval=_positive_int(
+            "TWOFACTOR_LAST_USED_INTERVAL",
+            getattr(settings, "TWOFACTOR_LAST_USED_INTERVAL", 300),
+            allow_zero=True),
+        dashboard_ttl=_positive_int(
+            "TWOFACTOR_DASHBOARD_TTL",
+            getattr(settings, "TWOFACTOR_DASHBOARD_TTL", 600)),
+        shadow_engine=shadow_engine and import_string(shadow_engine),
+        shadow_sink=import_string(getattr(
+            settings, "TWOFACTOR_SHADOW_SINK",
+            "django_twofactor.shadow.log_sink")),
+        shadow_sample_rate=_fraction(
+            "TWOFACTOR_SHADOW_SAMPLE_RATE",
+            getattr(settings, "TWOFACTOR_SHADOW_SAMPLE_RATE", 0.01)),
+        shadow_max_overhead=_fraction(
+            "TWOFACTOR_SHADOW_MAX_OVERHEAD",
+            getattr(settings, "TWOFACTOR_SHADOW_MAX_OVERHEAD", 0.02)),
+    )
+
+
+_config = None
+
+
+def get_config():
+    """ The current `TwoFactorConfig`, built on first use. """
+    global _config
+    if _config is None:
+        _config = build_config()
+    return _config
+
+
+def _reset_config(sender, setting, **kwargs):
+    global _config
+    if setting in SETTING_NAMES:
+        _config = None
+
+setting_changed.connect(_reset_config)
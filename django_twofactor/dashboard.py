@@ -0,0 +1,129 @@
+"""
+Adoption and health figures for the admin dashboard
+(`TwoFactorAuthAdminSite.dashboard`).
+
+`compute_stats()` gets them with two aggregate queries, one grouped by
+device type and one over users, whatever the size of the table. The
+results are cached for `TWOFACTOR_DASHBOARD_TTL` seconds (default 600).
+After that `get_stats()` still returns them, but starts a refresh in a
+background thread; only when nothing is cached does a page view wait for
+the queries.
+"""
+
+import threading
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Case, Count, IntegerField, Q, Sum, When
+from django.utils import timezone
+
+from django_twofactor.conf import get_config
+
+
+CACHE_KEY = "twofactor-dashboard"
+REFRESH_LOCK_KEY = "twofactor-dashboard-refresh"
+
+# Active HOTP devices by codes left on the paper card: (label, fewest, most).
+CODES_LEFT_BUCKETS = (
+    ("0-5", 0, 5),
+    ("6-25", 6, 25),
+    ("26-50", 26, 50),
+    ("51+", 51, None),
+)
+
+
+def _count(condition):
+    return Sum(Case(When(condition, then=1), default=0,
+                    output_field=IntegerField()))
+
+
+def compute_stats():
+    """
+    Returns a dict with `types`: a row per device type (`type`, `name`,
+    `devices`, `active`, `users`, `enrolled_week`, `enrolled_month`),
+    `codes_left`: `(label, devices)` per `CODES_LEFT_BUCKETS`, `users` and
+    `users_both` (users with a device, and with both kinds), and `computed`.
+    """
+    from django_twofactor.models import UserAuthToken
+
+    now = timezone.now()
+    max_counter = get_config().hotp_max_counter
+    buckets = {}
+    for i, (label, fewest, most) in enumerate(CODES_LEFT_BUCKETS):
+        condition = Q(type=UserAuthToken.TYPE_HOTP, is_active=True,
+                      counter__lte=max_counter - fewest)
+        if most is not None:
+            condition &= Q(counter__gte=max_counter - most)
+        buckets["codes_left_%d" % i] = _count(condition)
+
+    types = list(
+        UserAuthToken.objects.order_by().values("type").annotate(
+            devices=Count("pk"),
+            active=_count(Q(is_active=True)),
+            users=Count("user", distinct=True),
+            enrolled_week=_count(
+                Q(created_datetime__gte=now - timedelta(days=7))),
+            enrolled_month=_count(
+                Q(created_datetime__gte=now - timedelta(days=30))),
+            **buckets).order_by("type"))
+    type_names = dict(UserAuthToken.TYPE_CHOICES)
+    codes_left = [0] * len(CODES_LEFT_BUCKETS)
+    for row in types:
+        row["name"] = type_names.get(row["type"], row["type"])
+        for i in range(len(CODES_LEFT_BUCKETS)):
+            codes_left[i] += row.pop("codes_left_%d" % i) or 0
+
+    totals = UserAuthToken.objects.order_by().values("user").annotate(
+        kinds=Count("type", distinct=True)
+    ).aggregate(users=Count("user"), users_both=_count(Q(kinds__gt=1)))
+    return dict(
+        types=types,
+        codes_left=[(bucket[0], devices) for bucket, devices
+                    in zip(CODES_LEFT_BUCKETS, codes_left)],
+        users=totals["users"],
+        users_both=totals["users_both"] or 0,
+        computed=now)
+
+
+def refresh():
+    """ Recomputes and caches the figures; returns them. """
+    stats = compute_stats()
+    # Keep stale figures around long after the TTL, to serve while
+    # refreshing.
+    cache.set(CACHE_KEY, stats, get_config().dashboard_ttl * 10)
+    return stats
+
+
+def _refresh_in_background():
+    try:
+        refresh()
+    finally:
+        cache.delete(REFRESH_LOCK_KEY)
+        connection.close()
+
+
+def get_stats(background=True):
+    """
+    The cached figures, computed now if there are none. Stale ones are
+    returned as they are while a refresh runs, in a thread unless
+    `background` is False; at most one refresh runs at a time.
+    """
+    config = get_config()
+    stats = cache.get(CACHE_KEY)
+    if stats is None:
+        return refresh()
+    age = timezone.now() - stats["computed"]
+    if (age >= timedelta(seconds=config.dashboard_ttl) and
+            cache.add(REFRESH_LOCK_KEY, 1, 5 * 60)):
+        if background:
+            thread = threading.Thread(target=_refresh_in_background,
+                                      name="twofactor-dashboard")
+            thread.daemon = True
+            thread.start()
+        else:
+            try:
+                refresh()
+            finally:
+                cache.delete(REFRESH_LOCK_KEY)
+    return stats
@@ -0,0 +1,41 @@
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth import REDIRECT_FIELD_NAME
+from django.contrib.auth.views import redirect_to_login
+
+from django_twofactor.conf import get_config
+from django_twofactor.verification import is_verified
+
+
+def redirect_to_verify(request, verify_url=None,
+                       redirect_field_name=REDIRECT_FIELD_NAME):
+    """
+    Sends `request` to `verify_url`, `TWOFACTOR_VERIFY_URL` or
+    `LOGIN_URL`, in that order, to log in with a token.
+    """
+    verify_url = (verify_url or get_config().verify_url or
+                  settings.LOGIN_URL)
+    return redirect_to_login(request.get_full_path(), verify_url,
+                             redirect_field_name)
+
+
+def twofactor_required(view_func=None, verify_url=None,
+                       redirect_field_name=REDIRECT_FIELD_NAME):
+    """
+    Like `login_required`, but the session must also have passed two-factor
+    authentication. Decided from the session alone: users that have no
+    device are never let through.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if is_verified(request):
+                return view_func(request, *args, **kwargs)
+            return redirect_to_verify(request, verify_url,
+                                      redirect_field_name)
+        return wrapper
+
+    if view_func is not None:
+        return decorator(view_func)
+    return decorator
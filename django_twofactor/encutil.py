@@ -9,13 +9,24 @@ from django.utils.encoding import smart_bytes, force_bytes
 from binascii import hexlify, unhexlify
 import string
 
-# Get best AES implementation we can.
-try:
-    from Crypto.Cipher import AES
-except ImportError:
-    from django_twofactor import pyaes as AES
+BLOCK_SIZE = 16
+
+_AES = None
 
-BLOCK_SIZE = AES.block_size
+def load_aes():
+    """
+    Imports the best AES implementation we can on first use (or from
+    `django_twofactor.warm_up`): PyCrypto if available, the bundled pure
+    Python `pyaes` otherwise.
+    """
+    global _AES
+    if _AES is None:
+        try:
+            from Crypto.Cipher import AES
+        except ImportError:
+            from django_twofactor import pyaes as AES
+        _AES = AES
+    return _AES
 
 # Get best `random` implementation we can.
 import random
@@ -27,14 +38,16 @@ except:
 def _gen_salt(length=16):
     return ''.join([random.choice(string.ascii_letters + string.digits) for i in range(length)])
 
-def _get_key(salt):
-    """ Combines `settings.SECRET_KEY` with a salt. """
+def _get_key(salt, secret=None):
+    """ Combines `secret` (default: `settings.SECRET_KEY`) with a salt. """
     if not salt: salt = ""
+    if secret is None: secret = settings.SECRET_KEY
     
-    return sha256(force_bytes(settings.SECRET_KEY) + force_bytes(salt)).digest()
+    return sha256(force_bytes(secret) + force_bytes(salt)).digest()
 
-def encrypt(data, salt):
-    cipher = AES.new(_get_key(salt), mode=AES.MODE_ECB)
+def encrypt(data, salt, secret=None):
+    AES = load_aes()
+    cipher = AES.new(_get_key(salt, secret), mode=AES.MODE_ECB)
     value = smart_bytes(data)
 
     padding  = BLOCK_SIZE - len(value) % BLOCK_SIZE
@@ -42,8 +55,9 @@ def encrypt(data, salt):
         value += b"\0" + ''.join([random.choice(string.printable) for index in range(padding-1)]).encode('ascii')
     return hexlify(cipher.encrypt(value)).decode('ascii')
 
-def decrypt(encrypted_data, salt):
-    cipher = AES.new(_get_key(salt), mode=AES.MODE_ECB)
+def decrypt(encrypted_data, salt, secret=None):
+    AES = load_aes()
+    cipher = AES.new(_get_key(salt, secret), mode=AES.MODE_ECB)
 
     # Note: this doesn't return the correct raw data if it has a null character
     # ("\x00") somewhere. Correct way would be
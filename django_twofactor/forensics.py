@@ -0,0 +1,102 @@
+"""
+Finds the HOTP devices (paper cards) that leaked codes belong to, e.g.
+after a phishing kit captured some; see the `twofactor_find_codes`
+command.
+
+The devices are read in chunks of `chunk_size`, and each chunk is
+decrypted and checked in a process pool, with a bounded number of chunks
+in flight so that memory stays flat on large tables.
+"""
+
+import time
+
+from django_twofactor.conf import get_config
+from django_twofactor.util import chunks
+
+
+def _scan_chunk(rows, codes, window):
+    """
+    Returns `(token id, user id, counter, code)` for each code in `codes`
+    that the devices in `rows`, `(id, user id, encrypted seed, counter)`
+    tuples, accept at one of `window` counters from their own (all of the
+    card's if `window` is None).
+    """
+    from django_twofactor.util import decrypt_value, get_hotp
+    max_counter = get_config().hotp_max_counter
+    matches = []
+    for pk, user_id, encrypted_seed, counter in rows:
+        raw_seed = decrypt_value(encrypted_seed)
+        if window is None:
+            counters = range(max_counter)
+        else:
+            counters = range(counter, min(counter + window, max_counter))
+        for i in counters:
+            code = get_hotp(raw_seed, i)
+            if code in codes:
+                matches.append((pk, user_id, i, code))
+    return matches
+
+
+def find_codes(codes, queryset=None, window=1, workers=None,
+               chunk_size=1000, progress=None):
+    """
+    Yields `(token id, user id, counter, code)` for the HOTP devices in
+    `queryset` (default: all) that accept one of `codes` within `window`
+    (at least 1) counters of their current one; None checks the whole card,
+    used codes included. `workers` is the size of the process pool
+    (default: one per CPU; 0 checks in this process). `progress` is called
+    with the number of devices and the seconds taken so far after each
+    chunk.
+    """
+    from django_twofactor.models import UserAuthToken
+
+    if window is not None and window < 1:
+        raise ValueError("window must be at least 1, or None")
+    if queryset is None:
+        queryset = UserAuthToken.objects.all()
+    rows = (queryset.filter(type=UserAuthToken.TYPE_HOTP).order_by("pk")
+                    .values_list("pk", "user_id", "encrypted_seed", "counter")
+                    .iterator())
+    codes = frozenset(codes)
+    start = time.time()
+    scanned = 0
+
+    if workers == 0:
+        for chunk in chunks(rows, chunk_size):
+            for match in _scan_chunk(chunk, codes, window):
+                yield match
+            scanned += len(chunk)
+            if progress is not None:
+                progress(scanned, time.time() - start)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import cpu_count
+    from django_twofactor.offload import _init_worker
+
+    if workers is None:
+        workers = cpu_count()
+    executor = ProcessPoolExecutor(workers, initializer=_init_worker)
+    in_flight = []
+    try:
+        pending = chunks(rows, chunk_size)
+        while True:
+            # Keep each worker busy with a chunk and one more queued.
+            while len(in_flight) < 2 * workers:
+                chunk = next(pending, None)
+                if chunk is None:
+                    break
+                in_flight.append((len(chunk), executor.submit(
+                    _scan_chunk, chunk, codes, window)))
+            if not in_flight:
+                return
+            size, future = in_flight.pop(0)
+            for match in future.result():
+                yield match
+            scanned += size
+            if progress is not None:
+                progress(scanned, time.time() - start)
+    finally:
+        for size, future in in_flight:
+            future.cancel()
+        executor.shutdown()
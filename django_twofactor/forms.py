@@ -1,6 +1,6 @@
 from django import forms
-from django_twofactor.models import UserAuthToken
-from django_twofactor import util
+from django_twofactor.models import UserAuthToken, request_caller
+from django_twofactor import grants, routers, util
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -10,13 +10,22 @@ class ResetTwoFactorAuthForm(forms.Form):
     reset_confirmation = forms.BooleanField(required=True)
 
     def __init__(self, user, *args, **kwargs):
+        # `name` picks the device to reset; the unnamed one by default.
+        name = kwargs.pop("name", "")
+        # All of the user's devices, if the caller has them already (see
+        # `middleware.get_user_tokens`).
+        tokens = kwargs.pop("tokens", None)
         super(ResetTwoFactorAuthForm, self).__init__(*args, **kwargs)
         if user:
-            try:
-                self.token = UserAuthToken.objects.get(user=user)
+            if tokens is not None:
+                self.token = next(
+                    (token for token in tokens if token.name == name), None)
+            else:
+                self.token = UserAuthToken.objects.get_for_user(user, name)
+            if self.token:
                 self.fields["type"].initial = self.token.type
-            except UserAuthToken.DoesNotExist:
-                self.token = UserAuthToken(user=user)
+            else:
+                self.token = UserAuthToken(user=user, name=name)
         else:
             self.token = None
 
@@ -35,13 +44,18 @@ class DisableTwoFactorAuthForm(forms.Form):
 
     def __init__(self, user, *args, **kwargs):
         self.user = user
+        # Disables all of the user's devices unless `name` is given.
+        self.name = kwargs.pop("name", None)
         super(DisableTwoFactorAuthForm, self).__init__(*args, **kwargs)
 
     def save(self):
         if not self.user:
             return None
 
-        UserAuthToken.objects.filter(user=self.user).delete()
+        tokens = UserAuthToken.objects.filter(user=self.user)
+        if self.name is not None:
+            tokens = tokens.filter(name=self.name)
+        tokens.delete()
 
         return self.user
 
@@ -52,6 +66,7 @@ class GridCardActivationForm(forms.Form):
 
     def __init__(self, user, *args, **kwargs):
         self.user = user
+        self.name = kwargs.pop("name", "")
         super(GridCardActivationForm, self).__init__(*args, **kwargs)
 
     def clean_key(self):
@@ -78,10 +93,9 @@ class GridCardActivationForm(forms.Form):
         return data
 
     def save(self):
-        try:
-            token = UserAuthToken.objects.get(user=self.user)
-        except UserAuthToken.DoesNotExist:
-            token = UserAuthToken(user=self.user)
+        token = UserAuthToken.objects.get_for_user(self.user, self.name)
+        if token is None:
+            token = UserAuthToken(user=self.user, name=self.name)
 
         base36_with_checksum = self.cleaned_data["key"]
         seed = util.key_to_seed(base36_with_checksum)
@@ -124,14 +138,51 @@ class TwoFactorMixin(object):
         def save(self):
             UserAuthToken.objects.filter(user=self.user).delete()
             return self.user
+
+    `tokens` are all of the user's devices if the caller has them already;
+    they default to the request's when `user` is `request.user` (see
+    `middleware.get_user_tokens`), so forms on one page share one query.
+
+    With `request`, a verified code also issues a step-up grant for `scope`
+    (see `django_twofactor.grants`) once the whole form is valid, and while
+    it lasts forms of the same scope don't ask for a code:
+    `twofactor_granted` is set and there is no token field. The grant is
+    issued from `full_clean`, so the mixin must come before the form class
+    in the bases; otherwise call `issue_grant()` after `is_valid()`.
     """
 
-    def __init__(self, user):
-        self.user = user
+    twofactor_scope = grants.DEFAULT_SCOPE
 
-        try:
-            self.user_auth_token = UserAuthToken.objects.get(user=self.user)
-        except UserAuthToken.DoesNotExist:
+    def __init__(self, user, request=None, scope=None, tokens=None):
+        self.user = user
+        self.twofactor_request = request
+        if scope is not None:
+            self.twofactor_scope = scope
+        self.matched_auth_token = None
+        self._grant_issued = False
+
+        self.twofactor_granted = grants.has_grant(
+            request, user, self.twofactor_scope)
+        if self.twofactor_granted:
+            self.user_auth_tokens = []
+            self.user_auth_token = None
+            return
+
+        # Any of the user's devices is accepted; the cheapest one to verify
+        # decides the help texts.
+        if (tokens is None and request is not None and
+                getattr(request, "user", None) == user):
+            from django_twofactor.middleware import get_user_tokens
+            tokens = get_user_tokens(request)
+        if tokens is not None:
+            self.user_auth_tokens = [
+                token for token in tokens if token.is_active]
+        else:
+            self.user_auth_tokens = UserAuthToken.objects.active_for_user(
+                self.user)
+        if self.user_auth_tokens:
+            self.user_auth_token = self.user_auth_tokens[0]
+        else:
             self.user_auth_token = None
 
         if self.user_auth_token:
@@ -152,21 +203,54 @@ class TwoFactorMixin(object):
         if len(token) != 6:
             raise forms.ValidationError(_(u"Token must be six digits long."))
 
-        if not self.user_auth_token.check_auth_code(token):
+        if routers.reads_from_replica():
+            # The devices were read for the help texts, maybe from a lagging
+            # replica; verify against the primary.
+            routers.pin_primary()
+            self.user_auth_tokens = UserAuthToken.objects.active_for_user(
+                self.user)
+
+        self.matched_auth_token = UserAuthToken.objects.match_auth_code(
+            self.user_auth_tokens, token,
+            request_caller(self.twofactor_request))
+        if self.matched_auth_token is None:
             if self.user_auth_token.type == UserAuthToken.TYPE_HOTP:
                 raise forms.ValidationError(_(u"This doesn't seem to match with the code on the paper. Please try again."))
             else:
                 raise forms.ValidationError(_(u"The code does not match. Make sure your mobile phone has correct time. You can synchronize the time in Authenticator app settings."))
 
+        return token
+
+    def full_clean(self):
+        super(TwoFactorMixin, self).full_clean()
+        if not self._errors:
+            self.issue_grant()
+
+    def issue_grant(self):
+        """
+        Issues the step-up grant for a verified code, if there is a request
+        and it isn't issued yet. Call only once the form is valid.
+        """
+        if (self.matched_auth_token is None or
+                self.twofactor_request is None or self._grant_issued):
+            return
+        grants.issue(self.twofactor_request, self.matched_auth_token,
+                     self.twofactor_scope)
+        self._grant_issued = True
+
 
 class GridCardReactivationForm(TwoFactorMixin, GridCardActivationForm):
     """ Activate your next grid card. """
 
     def __init__(self, user, *args, **kwargs):
+        request = kwargs.pop("request", None)
+        scope = kwargs.pop("scope", None)
+        tokens = kwargs.pop("tokens", None)
         GridCardActivationForm.__init__(self, user, *args, **kwargs)
-        TwoFactorMixin.__init__(self, user)
+        TwoFactorMixin.__init__(self, user, request, scope, tokens)
 
         self.fields["key"].label = _(u"Key from the new paper")
         self.fields["first_code"].label = _(u"First code from the new paper")
-        self.fields["token"].label = _(u"Authentication code from the current paper")
+        if "token" in self.fields:
+            self.fields["token"].label = _(u"Authentication code from the current paper")
 
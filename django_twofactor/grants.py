@@ -0,0 +1,63 @@
+"""
+Short-lived step-up grants, so that a user who just entered a code for one
+sensitive form isn't asked for another one (which TOTP replay protection
+would refuse within the same time step anyway).
+
+A `TwoFactorMixin` form given the request issues a grant for its scope
+when it verifies a code, and accepts an unexpired grant of that scope in
+place of a code. Grants live in the session for `TWOFACTOR_GRANT_TTL`
+seconds; the default of 0 turns them off. Like session stamps (see
+`django_twofactor.verification`), they are void once one of the user's
+devices is reset or removed.
+"""
+
+from django_twofactor.conf import get_config
+from django_twofactor.verification import revoked_at
+
+
+SESSION_KEY = "_twofactor_grants"
+DEFAULT_SCOPE = "default"
+
+
+def issue(request, token, scope=DEFAULT_SCOPE):
+    """ Grants `scope` to `request.session` after `token` was verified. """
+    config = get_config()
+    if not config.grant_ttl:
+        return
+    # Caches the user's revocation time, for has_grant().
+    revoked_at(token.user_id)
+    grants = request.session.get(SESSION_KEY, {})
+    now = config.clock()
+    # Drop expired grants so the session doesn't grow.
+    grants = dict((key, grant) for key, grant in grants.items()
+                  if grant["expires"] > now)
+    grants[scope] = {
+        "user_id": str(token.user_id),
+        "token_id": token.pk,
+        "time": now,
+        "expires": now + config.grant_ttl,
+    }
+    request.session[SESSION_KEY] = grants
+
+
+def has_grant(request, user, scope=DEFAULT_SCOPE):
+    """ Whether `request.session` holds a valid grant of `scope` for `user`. """
+    config = get_config()
+    if not config.grant_ttl or request is None:
+        return False
+    grant = request.session.get(SESSION_KEY, {}).get(scope)
+    if (grant is None or grant["user_id"] != str(user.pk) or
+            grant["expires"] <= config.clock()):
+        return False
+    revoked = revoked_at(grant["user_id"])
+    return revoked is None or revoked < grant["time"]
+
+
+def revoke(request, scope=None):
+    """ Drops the grant of `scope`, or all grants, from `request.session`. """
+    if scope is None:
+        request.session.pop(SESSION_KEY, None)
+        return
+    grants = request.session.get(SESSION_KEY, {})
+    if grants.pop(scope, None) is not None:
+        request.session[SESSION_KEY] = grants
@@ -0,0 +1,58 @@
+"""
+Optional pool of pre-generated gridcard keys, so that the gridcard page
+doesn't generate a key and its codes inside the request.
+
+`TWOFACTOR_GRIDCARD_POOL_SIZE` cache slots each hold an unassigned
+`(key, codes)` pair. `fill_pool` (run by the `twofactor_fill_gridcard_pool`
+command) tops up empty slots, and `claim` hands a pair to exactly one
+caller: claims are made with `cache.add`, which only one caller can win.
+"""
+
+import random
+
+from django.core.cache import cache
+
+from django_twofactor.conf import get_config
+from django_twofactor.util import key_to_seed, list_codes, random_base36_with_checksum
+
+
+SLOT_KEY = "twofactor-gridcard-pool-{0}"
+CLAIM_KEY = "twofactor-gridcard-claimed-{0}"
+CODES_KEY = "twofactor-gridcard-codes-{0}"
+
+
+def generate():
+    """ A new random key and its list of codes. """
+    key = random_base36_with_checksum()
+    return key, list(list_codes(key_to_seed(key)))
+
+
+def fill_pool(size=None):
+    """ Fills empty slots of the pool. Returns the number of new keys. """
+    if size is None:
+        size = get_config().gridcard_pool_size
+    slots = [SLOT_KEY.format(i) for i in range(size)]
+    present = cache.get_many(slots)
+    added = 0
+    for slot in slots:
+        if slot not in present and cache.add(slot, generate(), None):
+            added += 1
+    return added
+
+
+def claim():
+    """
+    Takes a `(key, codes)` pair out of the pool, or returns None if the
+    pool is empty.
+    """
+    config = get_config()
+    slots = [SLOT_KEY.format(i) for i in range(config.gridcard_pool_size)]
+    entries = list(cache.get_many(slots).items())
+    random.shuffle(entries)
+    for slot, (key, codes) in entries:
+        if cache.add(CLAIM_KEY.format(key), True, config.gridcard_cache_time):
+            # May remove a fresh key if the slot was refilled meanwhile;
+            # that only costs the filler some work.
+            cache.delete(slot)
+            return key, codes
+    return None
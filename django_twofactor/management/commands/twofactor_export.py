@@ -0,0 +1,50 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_twofactor import transfer
+from django_twofactor.models import UserAuthToken
+
+
+class Command(BaseCommand):
+    help = ("Streams all two-factor devices to a JSON lines file (gzipped "
+            "if the name ends in .gz, stdout for -), with seeds encrypted "
+            "under a transport key. Load it with twofactor_import.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument(
+            "--transport-key",
+            default=os.environ.get("TWOFACTOR_TRANSPORT_KEY"),
+            help="Key to encrypt the seeds with. Defaults to the "
+                 "TWOFACTOR_TRANSPORT_KEY environment variable, which "
+                 "keeps it out of the process list.")
+        parser.add_argument(
+            "--active-only", action="store_true",
+            help="Leave out disabled devices.")
+        parser.add_argument(
+            "--chunk-size", type=int, default=1000,
+            help="Devices decrypted and written at a time.")
+
+    def handle(self, *args, **options):
+        if not options["transport_key"]:
+            raise CommandError("A transport key is required.")
+
+        queryset = UserAuthToken.objects.all()
+        if options["active_only"]:
+            queryset = queryset.filter(is_active=True)
+
+        def progress(total):
+            if options["verbosity"] > 0:
+                self.stderr.write("\rexported %d" % total, ending="")
+
+        out = transfer.open_stream(options["path"], "wb")
+        try:
+            total = transfer.export_tokens(
+                out, options["transport_key"], queryset,
+                options["chunk_size"], progress)
+        finally:
+            if options["path"] != "-":
+                out.close()
+        if options["verbosity"] > 0:
+            self.stderr.write("\rexported %d devices" % total)
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_twofactor import gridcard_pool
+from django_twofactor.conf import get_config
+
+
+class Command(BaseCommand):
+    help = ("Tops up the pool of pre-generated gridcard keys "
+            "(TWOFACTOR_GRIDCARD_POOL_SIZE), once or every --interval "
+            "seconds.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--size", type=int,
+            help="Pool size; defaults to TWOFACTOR_GRIDCARD_POOL_SIZE.")
+        parser.add_argument(
+            "--interval", type=float,
+            help="Keep running, topping up every this many seconds.")
+
+    def handle(self, *args, **options):
+        size = options["size"]
+        if size is None:
+            size = get_config().gridcard_pool_size
+        while True:
+            added = gridcard_pool.fill_pool(size)
+            if options["verbosity"] > 1 or (added and not options["interval"]):
+                self.stdout.write("Added %d gridcard keys" % added)
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
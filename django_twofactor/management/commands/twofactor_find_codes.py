@@ -0,0 +1,78 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_twofactor.conf import get_config
+from django_twofactor.forensics import find_codes
+from django_twofactor.models import UserAuthToken
+
+
+class Command(BaseCommand):
+    help = ("Finds the HOTP devices (paper cards) that accept any of the "
+            "given codes, e.g. codes captured by a phishing kit. Prints "
+            "the device id, user id, counter and code of each match.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("codes", nargs="*")
+        parser.add_argument(
+            "--file",
+            help="Read more codes from this file, one per line (- for "
+                 "stdin).")
+        parser.add_argument(
+            "--window", type=int, default=1,
+            help="How many codes from each card's current counter on to "
+                 "check. Defaults to 1: the code the card accepts now.")
+        parser.add_argument(
+            "--whole-card", action="store_true",
+            help="Check all codes of each card, used ones included.")
+        parser.add_argument(
+            "--active-only", action="store_true",
+            help="Leave out disabled devices.")
+        parser.add_argument(
+            "--workers", type=int, default=None,
+            help="Processes to decrypt and check in (default: one per "
+                 "CPU, 0 for none).")
+        parser.add_argument(
+            "--chunk-size", type=int, default=1000,
+            help="Devices handed to a process at a time.")
+
+    def handle(self, *args, **options):
+        codes = list(options["codes"])
+        if options["file"]:
+            lines = (sys.stdin if options["file"] == "-"
+                     else open(options["file"]))
+            try:
+                codes.extend(line.strip() for line in lines if line.strip())
+            finally:
+                if lines is not sys.stdin:
+                    lines.close()
+        length = get_config().token_length
+        invalid = [code for code in codes
+                   if not code.isdigit() or len(code) != length]
+        if invalid:
+            raise CommandError("Not %d digit codes: %s"
+                               % (length, ", ".join(invalid)))
+        if not codes:
+            raise CommandError("No codes given.")
+        if options["window"] < 1:
+            raise CommandError("--window must be at least 1.")
+
+        queryset = UserAuthToken.objects.all()
+        if options["active_only"]:
+            queryset = queryset.filter(is_active=True)
+
+        def progress(scanned, seconds):
+            if options["verbosity"] > 0:
+                self.stderr.write("\rscanned %d devices, %.0f/s" % (
+                    scanned, scanned / max(seconds, 1e-6)), ending="")
+
+        matches = 0
+        for match in find_codes(
+                codes, queryset,
+                window=None if options["whole_card"] else options["window"],
+                workers=options["workers"],
+                chunk_size=options["chunk_size"], progress=progress):
+            self.stdout.write("%d\t%d\t%d\t%s" % match)
+            matches += 1
+        if options["verbosity"] > 0:
+            self.stderr.write("\n%d matches" % matches)
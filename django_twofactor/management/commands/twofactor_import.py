@@ -0,0 +1,53 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_twofactor import routers, transfer
+
+
+class Command(BaseCommand):
+    help = ("Loads two-factor devices from a file written by "
+            "twofactor_export (gzipped if the name ends in .gz, stdin for "
+            "-), re-encrypting the seeds for this site.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument(
+            "--transport-key",
+            default=os.environ.get("TWOFACTOR_TRANSPORT_KEY"),
+            help="Key the seeds were exported with. Defaults to the "
+                 "TWOFACTOR_TRANSPORT_KEY environment variable.")
+        parser.add_argument(
+            "--replace", action="store_true",
+            help="Replace a user's device of the same name instead of "
+                 "skipping it.")
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Devices inserted at a time.")
+
+    def handle(self, *args, **options):
+        if not options["transport_key"]:
+            raise CommandError("A transport key is required.")
+
+        def progress(counts):
+            if options["verbosity"] > 0:
+                self.stderr.write("\rimported %(created)d" % counts,
+                                  ending="")
+
+        lines = transfer.open_stream(options["path"], "rb")
+        try:
+            with routers.pinning_scope():
+                counts = transfer.import_tokens(
+                    (line.decode("utf-8") for line in lines),
+                    options["transport_key"], options["batch_size"],
+                    options["replace"], progress)
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            if options["path"] != "-":
+                lines.close()
+        if options["verbosity"] > 0:
+            self.stderr.write(
+                "\rimported %(created)d devices, replaced %(replaced)d, "
+                "skipped %(existing)d existing and %(no_user)d of unknown "
+                "users" % counts)
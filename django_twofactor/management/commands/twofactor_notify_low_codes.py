@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from django_twofactor.conf import get_config
+from django_twofactor.models import UserAuthToken
+
+
+class Command(BaseCommand):
+    help = ("Finds users whose paper card is running out of codes and hands "
+            "them to TWOFACTOR_LOW_CODES_NOTIFIER in chunks. Without a "
+            "notifier, prints `username<TAB>codes left` lines.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", type=int, default=5,
+            help="Notify when at most this many codes are left.")
+        parser.add_argument(
+            "--chunk-size", type=int, default=1000,
+            help="Users loaded and handed to the notifier at a time.")
+        parser.add_argument(
+            "--notifier",
+            help="Dotted path of a callable taking a list of (user, list of "
+                 "UserAuthToken) pairs, one per user. Overrides "
+                 "TWOFACTOR_LOW_CODES_NOTIFIER.")
+
+    def handle(self, *args, **options):
+        notifier_path = options["notifier"] or get_config().low_codes_notifier
+        notifier = import_string(notifier_path) if notifier_path else None
+
+        queryset = UserAuthToken.objects.low_on_codes(options["limit"])
+        total = 0
+        last_user_id = 0
+        while True:
+            # Keyset pagination on the user: each chunk starts where the last
+            # one stopped, and has all the low cards of its users.
+            user_ids = list(queryset.filter(user_id__gt=last_user_id)
+                                    .order_by("user_id")
+                                    .values_list("user_id", flat=True)
+                                    .distinct()[:options["chunk_size"]])
+            if not user_ids:
+                break
+            last_user_id = user_ids[-1]
+            tokens = (queryset.filter(user_id__in=user_ids)
+                              .select_related("user")
+                              .order_by("user_id", "pk"))
+            chunk = []
+            for token in tokens:
+                if not chunk or chunk[-1][0].pk != token.user_id:
+                    chunk.append((token.user, []))
+                chunk[-1][1].append(token)
+            total += len(chunk)
+            if notifier is not None:
+                notifier(chunk)
+            else:
+                self._print(chunk)
+
+        if notifier is not None or options["verbosity"] > 1:
+            self.stderr.write("%d users low on codes" % total)
+
+    def _print(self, users):
+        max_counter = get_config().hotp_max_counter
+        for user, tokens in users:
+            counter = max(token.counter for token in tokens)
+            self.stdout.write("%s\t%d" % (
+                user.username, max(0, max_counter - counter)))
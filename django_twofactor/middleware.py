@@ -0,0 +1,51 @@
+from django.utils.functional import SimpleLazyObject
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    # Django < 1.10
+    MiddlewareMixin = object
+
+from django_twofactor.conf import get_config
+from django_twofactor.decorators import redirect_to_verify
+from django_twofactor.verification import is_verified
+
+
+def get_user_tokens(request):
+    """
+    All devices of `request.user` (see `UserAuthTokenManager.for_user`),
+    queried once per request and shared by everything that is handed the
+    request. Not refreshed when devices change during the request.
+    """
+    if not hasattr(request, "_twofactor_tokens"):
+        from django_twofactor.models import UserAuthToken
+        user = request.user
+        if user.pk is None:
+            # Anonymous
+            request._twofactor_tokens = []
+        else:
+            request._twofactor_tokens = UserAuthToken.objects.for_user(user)
+    return request._twofactor_tokens
+
+
+class TwoFactorMiddleware(MiddlewareMixin):
+    """
+    Sets `request.twofactor_tokens`, the user's devices as returned by
+    `get_user_tokens`, loaded on first use.
+
+    Requires two-factor authentication for every path starting with one of
+    `TWOFACTOR_REQUIRED_PATHS`, as `twofactor_required` does for single
+    views. The login view must not be under one of them.
+
+    Goes after `SessionMiddleware` and `AuthenticationMiddleware`. Views
+    can call `django_twofactor.verification.is_verified(request)` to look
+    at the same (per-request memoised) result.
+    """
+
+    def process_request(self, request):
+        request.twofactor_tokens = SimpleLazyObject(
+            lambda: get_user_tokens(request))
+
+        required_paths = get_config().required_paths
+        if (required_paths and request.path.startswith(required_paths) and
+                not is_verified(request)):
+            return redirect_to_verify(request)
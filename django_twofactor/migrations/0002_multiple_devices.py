@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_twofactor', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userauthtoken',
+            name='name',
+            field=models.CharField(default='', max_length=64, blank=True),
+        ),
+        migrations.AddField(
+            model_name='userauthtoken',
+            name='is_active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='userauthtoken',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='userauthtoken',
+            unique_together=set([('user', 'name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='userauthtoken',
+            index_together=set([('user', 'is_active')]),
+        ),
+    ]
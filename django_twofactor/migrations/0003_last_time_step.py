@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_twofactor', '0002_multiple_devices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userauthtoken',
+            name='last_time_step',
+            field=models.PositiveIntegerField(null=True, blank=True),
+        ),
+    ]
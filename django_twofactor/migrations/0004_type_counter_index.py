@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_twofactor', '0003_last_time_step'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='userauthtoken',
+            index_together=set([('user', 'is_active'), ('type', 'counter')]),
+        ),
+    ]
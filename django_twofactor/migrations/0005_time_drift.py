@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_twofactor', '0004_type_counter_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userauthtoken',
+            name='time_drift',
+            field=models.SmallIntegerField(default=0),
+        ),
+    ]
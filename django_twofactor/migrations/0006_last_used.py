@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_twofactor', '0005_time_drift'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userauthtoken',
+            name='last_used',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,45 +1,201 @@
 import logging
-import random
-import time
 
 from base64 import b32encode
+from datetime import timedelta
 from socket import gethostname
 
-from django.db import models
-from django.core.cache import cache
 from django.conf import settings
-
+from django.db import models
+from django.db.models import Count, F, Q
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from django_twofactor import usage, verification
+from django_twofactor.conf import get_config
+from django_twofactor.offload import get_pool
+from django_twofactor.stores import get_store
 from django_twofactor.util import (
-    check_raw_seed,
+    SingleFlight,
     check_hotp,
     decrypt_value,
     encrypt_value,
+    current_time_step,
     get_google_url,
+    match_totp_step,
     random_seed,
 )
 
 
-HOTP_MAX_COUNTER = getattr(settings, "HOTP_MAX_COUNTER", 100)
-
-HOTP_RATELIMIT_COUNT = getattr(settings, "HOTP_RATELIMIT_COUNT", 30)
-HOTP_RATELIMIT_TIMEFRAME = getattr(settings, "HOTP_RATELIMIT_TIMEFRAME", 3600)
-
-
 logger = logging.getLogger(__name__)
 
+# Verifications in flight in this process, by device ids and code.
+_verifications = SingleFlight()
+
 
 def hex(s):
     return ":".join("{0:x}".format(ord(c)) for c in s)
 
 
 def auth_code_lock(auth_type, auth_code, username):
-    content = '{}_{}'.format(time.time(), random.randint(0, 99999999999))
-    test = cache.get_or_set(
+    """
+    Claims `auth_code` for 10 seconds, so that concurrent requests (or a
+    lagging database replica) can't use it twice. Returns whether this
+    caller got it.
+    """
+    return get_store().add(
         'auth_code_lock_2fa_{}_{}_{}'.format(auth_type, auth_code, username),
-        content,
-        10,
-    )
-    return content == test
+        10)
+
+
+def request_caller(request):
+    """
+    What identifies the client of `request` to `match_auth_code`: its
+    session key, or before there is a session (as on a login page) its CSRF
+    cookie and address. None if there is neither.
+    """
+    session = getattr(request, "session", None)
+    session_key = getattr(session, "session_key", None)
+    if session_key or request is None:
+        return session_key
+    csrf_token = request.COOKIES.get(settings.CSRF_COOKIE_NAME)
+    if not csrf_token:
+        return None
+    return (csrf_token, request.META.get("REMOTE_ADDR"))
+
+
+class UserAuthTokenManager(models.Manager):
+    def active_for_user(self, user):
+        """
+        All active devices of `user` in a single query, ordered cheapest to
+        verify first (TOTP before HOTP).
+        """
+        tokens = list(self.filter(user=user, is_active=True)
+                          .order_by("type", "pk"))
+        for token in tokens:
+            # Saves a query per device when the username is needed for locks.
+            token.user = user
+        return tokens
+
+    def for_user(self, user):
+        """
+        All devices of `user`, active or not, in a single query and in the
+        order of `active_for_user`.
+        """
+        tokens = list(self.filter(user=user).order_by("type", "pk"))
+        for token in tokens:
+            token.user = user
+        return tokens
+
+    def active_for_users(self, user_ids):
+        """
+        Like `active_for_user`, for many users in a single query. Returns a
+        dict of user id to that user's devices.
+        """
+        tokens = {}
+        for token in (self.filter(user__in=user_ids, is_active=True)
+                          .select_related("user").order_by("type", "pk")):
+            tokens.setdefault(token.user_id, []).append(token)
+        return tokens
+
+    def get_for_user(self, user, name=""):
+        """
+        The device of `user` called `name` (the unnamed device by default),
+        or None.
+        """
+        return self.filter(user=user, name=name).first()
+
+    def low_on_codes(self, limit=5):
+        """
+        Active HOTP devices with at most `limit` codes left on their paper
+        card (the set `get_last_hotp_token_warning` warns about).
+        """
+        return self.filter(
+            type=UserAuthToken.TYPE_HOTP,
+            counter__gte=get_config().hotp_max_counter - limit,
+            is_active=True)
+
+    def unused_for(self, days):
+        """
+        Devices not used for `days` days: last used before then, or never
+        used and created before then. Recent uses may not be written yet
+        (see `django_twofactor.usage`).
+        """
+        cutoff = timezone.now() - timedelta(days=days)
+        return self.filter(
+            Q(last_used__lt=cutoff) |
+            Q(last_used__isnull=True, created_datetime__lt=cutoff))
+
+    def drift_distribution(self):
+        """
+        How many active TOTP devices run how many time steps ahead (positive)
+        or behind (negative) of the server clock, as a dict.
+        """
+        return dict(
+            self.filter(type=UserAuthToken.TYPE_TOTP, is_active=True)
+                .values_list("time_drift")
+                .annotate(devices=Count("pk"))
+                .order_by())
+
+    def match_auth_code(self, tokens, auth_code, caller=None):
+        """
+        Checks `auth_code` against all of `tokens` (devices of a single user)
+        in one pass, cheapest first: the TOTP window, then the HOTP look-up.
+
+        Returns the device that accepted the code, or None.
+
+        Identical attempts of the same `caller` (see `request_caller`) that
+        run concurrently in this process, such as double clicks, share one
+        verification, so the later ones don't fail on the locks the first
+        one holds. Attempts of different callers, or without one, never
+        share a result: a code only ever logs in one session.
+        """
+        if not tokens or not auth_code or not auth_code.isdigit():
+            return None
+        if len(auth_code) != get_config().token_length:
+            return None
+        if caller is None:
+            match = self._match_auth_code(tokens, auth_code)
+            if match is not None:
+                usage.record(match)
+            return match
+
+        key = (tuple(sorted(token.pk for token in tokens)), auth_code, caller)
+        match, shared = _verifications.do(
+            key, lambda: self._match_auth_code(tokens, auth_code))
+        if match is None:
+            return None
+        if not shared:
+            usage.record(match)
+            return match
+        # Hand back our own instance, brought up to date.
+        token = [t for t in tokens if t.pk == match.pk][0]
+        token.counter = match.counter
+        token.last_time_step = match.last_time_step
+        token.time_drift = match.time_drift
+        return token
+
+    def _match_auth_code(self, tokens, auth_code):
+        config = get_config()
+        totp_tokens = [t for t in tokens if t.is_totp()]
+        hotp_tokens = [t for t in tokens if t.is_hotp()]
+
+        # Replay protection for TOTP is done with `last_time_step` in the
+        # database; the cache locks are an extra layer that can be disabled.
+        if totp_tokens and (not config.totp_cache_locks or
+                            totp_tokens[0]._acquire_totp_code(auth_code)):
+            now_step = current_time_step()
+            for token in totp_tokens:
+                step = token._match_totp_step(auth_code, now_step)
+                if step is not None and token._accept_time_step(
+                        step, step - now_step):
+                    return token
+
+        if hotp_tokens and hotp_tokens[0]._acquire_hotp_code(auth_code):
+            for token in hotp_tokens:
+                if token._check_hotp(auth_code) and token._advance_hotp():
+                    return token
+
+        return None
 
 
 class UserAuthToken(models.Model):
@@ -50,32 +206,64 @@ class UserAuthToken(models.Model):
         (TYPE_HOTP, "Counter based (HOTP)"),
     )
 
-    user = models.OneToOneField("auth.User", on_delete=models.CASCADE)
+    user = models.ForeignKey("auth.User", on_delete=models.CASCADE)
+    name = models.CharField(max_length=64, blank=True, default="")
     encrypted_seed = models.CharField(max_length=120)  # fits 16b salt+40b seed
     type = models.PositiveSmallIntegerField(
         choices=TYPE_CHOICES, default=TYPE_TOTP)
+    is_active = models.BooleanField(default=True)
 
     counter = models.PositiveIntegerField(default=0)  # for HOTP
+    # for TOTP: the newest time step a code has been accepted for
+    last_time_step = models.PositiveIntegerField(null=True, blank=True)
+    # for TOTP: how many time steps the device ran ahead of us last time
+    time_drift = models.SmallIntegerField(default=0)
 
     created_datetime = models.DateTimeField(
         verbose_name="created", auto_now_add=True)
     updated_datetime = models.DateTimeField(
         verbose_name="last updated", auto_now=True)
+    # written in batches, see django_twofactor.usage
+    last_used = models.DateTimeField(null=True, blank=True, db_index=True)
 
-    def check_auth_code(self, auth_code):
+    objects = UserAuthTokenManager()
 
-        if not auth_code or not auth_code.isdigit():
-            return False
+    class Meta:
+        unique_together = (("user", "name"),)
+        index_together = (("user", "is_active"), ("type", "counter"))
 
-        if self.type == self.TYPE_TOTP:
-            return self._check_auth_code_totp(auth_code)
-        else:
-            return self._check_auth_code_hotp(auth_code)
+    def check_auth_code(self, auth_code, caller=None):
+        return UserAuthToken.objects.match_auth_code(
+            [self], auth_code, caller) is not None
 
-    def _check_auth_code_totp(self, auth_code):
+    def get_raw_seed(self):
         """
-        Checks whether `auth_code` is a valid authentication code for this
-        user, at the current time. (TOTP)
+        The decrypted seed. It is decrypted once per instance and seed; a
+        `(encrypted_seed, raw_seed)` pair can also be handed in through
+        `_raw_seed` by callers that keep seeds around.
+        """
+        raw_seed = getattr(self, "_raw_seed", None)
+        if raw_seed is None or raw_seed[0] != self.encrypted_seed:
+            raw_seed = (self.encrypted_seed,
+                        decrypt_value(self.encrypted_seed))
+            self._raw_seed = raw_seed
+        return raw_seed[1]
+
+    def _offload_pool(self):
+        """
+        The pool to check codes in (see `django_twofactor.offload`), or
+        None to check them here: when offloading is off, or the seed is
+        decrypted already.
+        """
+        raw_seed = getattr(self, "_raw_seed", None)
+        if raw_seed is not None and raw_seed[0] == self.encrypted_seed:
+            return None
+        return get_pool()
+
+    def _acquire_totp_code(self, auth_code):
+        """
+        Takes the cache locks for a TOTP `auth_code` of this user. Returns
+        False if the code was already tried recently.
         """
 
         # For DB replication, just to be sure...
@@ -85,47 +273,95 @@ class UserAuthToken(models.Model):
         # Do not allow the same time-based two- factor
         # code to be used within 40 seconds
         lock_key = "two-factor-lock-%s-%s" % (self.user.username, auth_code)
-        lock = cache.get(lock_key)
-        if lock:
+        if not get_store().add(lock_key, 40):
             logger.warn("Two-factor duplicate authentication attempt %s",
                         self.user.username)
             return False
+        return True
 
-        cache.set(lock_key, 40)
-
-        return check_raw_seed(decrypt_value(self.encrypted_seed), auth_code)
-
-    def _check_auth_code_hotp(self, auth_code):
+    def _match_totp_step(self, auth_code, now_step):
         """
-        Checks whether `auth_code` is a valid authentication code for this
-        user, for the current iteration. (HOTP)
+        Returns the time step `auth_code` is valid for on this device at
+        time step `now_step`, or None. The search starts at the device's
+        recorded drift. Steps that have already been used are rejected.
+        (TOTP)
+        """
+        config = get_config()
+        pool = self._offload_pool()
+        if pool is not None:
+            step = pool.run("totp", self.encrypted_seed, auth_code,
+                            now_step * config.period, self.time_drift)
+        else:
+            step = match_totp_step(
+                self.get_raw_seed(), auth_code, t=now_step * config.period,
+                drift=self.time_drift)
+        if step is None:
+            return None
+        if self.last_time_step is not None and step <= self.last_time_step:
+            logger.warn("Two-factor replayed time step %s", self.user.username)
+            return None
+        return step
+
+    def _accept_time_step(self, step, drift):
+        """
+        Records `step` as used, and `drift` as the device's offset, with a
+        single conditional UPDATE. Returns False if another request got
+        there first.
+        """
+        updated = UserAuthToken.objects.filter(pk=self.pk).filter(
+            Q(last_time_step__isnull=True) | Q(last_time_step__lt=step)
+        ).update(last_time_step=step, time_drift=drift)
+        if updated:
+            self.last_time_step = step
+            self.time_drift = drift
+        return bool(updated)
+
+    def _acquire_hotp_code(self, auth_code):
+        """
+        Takes the cache lock for a HOTP `auth_code` of this user and applies
+        the retry rate limit. Returns False if the attempt is not allowed.
         """
 
         # For DB replication, just to be sure...
         if not auth_code_lock('hotp', auth_code, self.user.username):
             return False
 
-        # Do not allow too many retries. This is
-        # not perfectly atomic, but good enough.
+        # Do not allow too many retries within HOTP_RATELIMIT_TIMEFRAME of
+        # the first one at this counter.
+        config = get_config()
         ratelimit_key = "two-factor-ratelimit-%s-%s" % (self.user.username,
                                                         self.counter)
-        times = cache.get(ratelimit_key) or []
-        times = [t for t in times
-                 if t + HOTP_RATELIMIT_TIMEFRAME > time.time()]
-        times.append(time.time())
-        cache.set(ratelimit_key, times, HOTP_RATELIMIT_TIMEFRAME)
-        if len(times) > HOTP_RATELIMIT_COUNT:
-            return False
+        attempts = get_store().incr(ratelimit_key,
+                                    config.hotp_ratelimit_timeframe)
+        return attempts <= config.hotp_ratelimit_count
 
-        correct = check_hotp(
-            decrypt_value(self.encrypted_seed), auth_code, self.counter)
+    def _check_hotp(self, auth_code):
+        """
+        Checks whether `auth_code` is a valid authentication code for this
+        device, for the current iteration. (HOTP)
+        """
+        pool = self._offload_pool()
+        if pool is not None:
+            return pool.run("hotp", self.encrypted_seed, auth_code,
+                            self.counter)
+        return check_hotp(self.get_raw_seed(), auth_code, self.counter)
 
-        if correct:
-            self.counter += 1
-            self.save()
-            if self.counter >= HOTP_MAX_COUNTER:
-                self.delete()
-        return correct
+    def _advance_hotp(self):
+        """
+        Moves the counter past the code just used, with a conditional UPDATE
+        so that a code is only ever accepted once, even when this row was
+        read from a lagging replica. Returns False if the counter had moved
+        on already.
+        """
+        updated = UserAuthToken.objects.filter(
+            pk=self.pk, counter=self.counter
+        ).update(counter=F("counter") + 1, updated_datetime=timezone.now())
+        if not updated:
+            return False
+        self.counter += 1
+        if self.counter >= get_config().hotp_max_counter:
+            self.delete()
+        return True
 
     def reset_seed(self, seed=None):
         """
@@ -176,7 +412,32 @@ class UserAuthToken(models.Model):
         Return total available tokensfor this user or 0.
         """
         if self.type == UserAuthToken.TYPE_HOTP:
-            if self.counter >= HOTP_MAX_COUNTER - limit:
-                return HOTP_MAX_COUNTER
+            hotp_max_counter = get_config().hotp_max_counter
+            if self.counter >= hotp_max_counter - limit:
+                return hotp_max_counter
 
         return 0
+
+
+class TwoFactorRevocation(models.Model):
+    """
+    When the two-factor session stamps and step-up grants of a user were
+    last voided (see `django_twofactor.verification`), in seconds since
+    the epoch.
+    """
+    user = models.OneToOneField(
+        "auth.User", on_delete=models.CASCADE, primary_key=True)
+    time = models.FloatField()
+
+
+def revoke_verification(sender, instance, created=False, **kwargs):
+    """
+    A reset or removed device voids the sessions verified with the user's
+    devices. Adding a device doesn't.
+    """
+    if not created:
+        verification.revoke([instance.user_id])
+
+
+post_save.connect(revoke_verification, sender=UserAuthToken)
+post_delete.connect(revoke_verification, sender=UserAuthToken)
@@ -0,0 +1,220 @@
+"""
+Optional process pool for the CPU-bound part of a verification: decrypting
+the seed and computing the HMACs of the code window. With the pure Python
+`pyaes` fallback, decryption holds the GIL for milliseconds, which stalls
+the other threads of a threaded worker or an event loop. With::
+
+    TWOFACTOR_OFFLOAD_WORKERS = 2
+
+`UserAuthToken.check_auth_code` and `match_auth_code` send that work to a
+pool of that many processes instead (0, the default, keeps it in process).
+Jobs that queue up while the pool is busy are sent to it together, in
+batches of up to `TWOFACTOR_OFFLOAD_BATCH_SIZE`, so concurrent requests
+share the round trip. Devices whose seed is already decrypted (see
+`UserAuthToken.get_raw_seed`) are checked in process, as that is cheap.
+A check that gets no answer within `TWOFACTOR_OFFLOAD_TIMEOUT` seconds
+(default 1) is logged and fails.
+
+The workers are forked from the process that first needs them, or else
+set up from `DJANGO_SETTINGS_MODULE`, and only get the encrypted seeds.
+Async code can await `asyncio.wrap_future(get_pool().submit(...))`.
+"""
+
+import logging
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from django.core.exceptions import ImproperlyConfigured
+
+from django_twofactor.conf import get_config
+
+
+logger = logging.getLogger(__name__)
+
+
+def _init_worker():
+    from django.apps import apps
+    if not apps.ready:
+        import django
+        django.setup()
+
+
+def _run_job(job):
+    from django_twofactor.util import check_hotp, decrypt_value, match_totp_step
+    kind, encrypted_seed, auth_code, arg, drift = job
+    raw_seed = decrypt_value(encrypted_seed)
+    if kind == "totp":
+        return match_totp_step(raw_seed, auth_code, t=arg, drift=drift)
+    return check_hotp(raw_seed, auth_code, arg)
+
+
+def _run_batch(jobs):
+    """ Runs `jobs` in a worker; returns `(error, result)` for each. """
+    results = []
+    for job in jobs:
+        try:
+            results.append((None, _run_job(job)))
+        except Exception as e:
+            results.append((e, None))
+    return results
+
+
+class SeedPool(object):
+    """
+    A process pool fed by a dispatcher thread, which sends the jobs that
+    are waiting whenever it gets to them as one batch.
+    """
+
+    def __init__(self, workers, batch_size, timeout=None):
+        try:
+            from concurrent.futures import (
+                Future, ProcessPoolExecutor, TimeoutError)
+        except ImportError:
+            raise ImproperlyConfigured(
+                "TWOFACTOR_OFFLOAD_WORKERS needs concurrent.futures (the "
+                "futures package on Python 2)")
+        self._future_class = Future
+        self._timeout_error = TimeoutError
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._closed = False
+        self._lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(workers, initializer=_init_worker)
+        self._queue = queue.Queue()
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="twofactor-offload")
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def submit(self, kind, encrypted_seed, auth_code, arg, drift=0):
+        """
+        Queues a check and returns a `concurrent.futures.Future` of its
+        result. `kind` is "totp" (`arg` is the time, the result the
+        matching time step or None) or "hotp" (`arg` is the counter, the
+        result a bool). Once the pool is shut down, checks are run here.
+        """
+        future = self._future_class()
+        job = (kind, encrypted_seed, auth_code, arg, drift)
+        with self._lock:
+            if not self._closed:
+                self._queue.put((job, future))
+                return future
+        future.set_running_or_notify_cancel()
+        error, result = _run_batch([job])[0]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        return future
+
+    def run(self, *args, **kwargs):
+        """
+        `submit` and wait for the result, or None (a failed check) if it
+        takes more than `timeout` seconds.
+        """
+        future = self.submit(*args, **kwargs)
+        try:
+            return future.result(self.timeout)
+        except self._timeout_error:
+            future.cancel()
+            logger.error("Two-factor offload check timed out after %ss",
+                         self.timeout)
+            return None
+
+    def shutdown(self, wait=True):
+        """
+        Stops taking jobs; those already queued still run. Waits for them
+        unless `wait` is False.
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+        if wait:
+            self._dispatcher.join()
+            self.executor.shutdown()
+
+    def _dispatch(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                # Lets the batches sent so far finish, then stops the
+                # processes.
+                self.executor.shutdown(wait=False)
+                return
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            futures = [future for job, future in batch]
+            try:
+                done = self.executor.submit(
+                    _run_batch, [job for job, future in batch])
+            except Exception as e:
+                for future in futures:
+                    if future.set_running_or_notify_cancel():
+                        future.set_exception(e)
+                continue
+            done.add_done_callback(
+                lambda done, futures=futures: self._resolve(done, futures))
+
+    @staticmethod
+    def _resolve(done, futures):
+        # Futures cancelled by `run` after a timeout are skipped.
+        error = done.exception()
+        if error is not None:
+            logger.error("Two-factor offload batch failed: %r", error)
+            for future in futures:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(error)
+            return
+        for future, (error, result) in zip(futures, done.result()):
+            if not future.set_running_or_notify_cancel():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    The `SeedPool` of this process for the current configuration, or None
+    if offloading is off.
+    """
+    global _pool
+    config = get_config()
+    pid = os.getpid()
+    current = _pool
+    if current is not None and current[0] is config and current[1] == pid:
+        return current[2]
+    with _pool_lock:
+        current = _pool
+        if current is None or current[0] is not config or current[1] != pid:
+            if (current is not None and current[1] == pid and
+                    current[2] is not None):
+                # Other threads may still be using it: it finishes their
+                # jobs, or runs them in process, before it stops.
+                current[2].shutdown(wait=False)
+            pool = None
+            if config.offload_workers:
+                pool = SeedPool(config.offload_workers,
+                                config.offload_batch_size,
+                                config.offload_timeout)
+            _pool = current = (config, pid, pool)
+    return current[2]
@@ -4,25 +4,23 @@ Homepage: https://bitbucket.org/intgr/pyaes/
 
 The goal of this module is to be as fast as reasonable in Python while still
 being Pythonic and readable/understandable. It is licensed under the permissive
-MIT license.
+MIT license. It runs on Python 2 and 3.
 
-Hopefully the code is readable and commented enough that it can serve as an
-introduction to the AES cipher for Python coders. In fact, it should go along
-well with the Stick Figure Guide to AES:
-http://www.moserware.com/2009/09/stick-figure-guide-to-advanced.html
+Instead of doing SubBytes, ShiftRows and MixColumns one byte at a time, every
+round is done on four 32-bit words (the columns of the state) with lookup
+tables, as in the reference implementation by Rijmen, Bosselaers and Barreto:
+the table entry ``T0[x]`` is the column that MixColumns makes out of S-box
+value ``S[x]`` in the first row, and ``T1``..``T3`` are the same column
+rotated for the other rows. A round is then sixteen table lookups and XORs::
 
-Contrary to intuition, this implementation numbers the 4x4 matrices from top to
-bottom for efficiency reasons::
+  t0 = T0[s0 >> 24] ^ T1[(s1 >> 16) & 255] ^ T2[(s2 >> 8) & 255] ^ T3[s3 & 255] ^ k0
 
-  0  4  8 12
-  1  5  9 13
-  2  6 10 14
-  3  7 11 15
-
-Effectively it's the transposition of what you'd expect. This actually makes
-the code simpler -- except the ShiftRows step, but hopefully the explanation
-there clears it up.
+Decryption works the same way with the inverse tables (the "equivalent
+inverse cipher" of FIPS-197, section 5.3.5), which needs InvMixColumns applied
+to the round keys once in advance.
 
+Columns are big-endian words: the state byte in row ``r`` of column ``c`` is
+input byte ``4 * c + r``, as in FIPS-197.
 """
 
 ####
@@ -48,7 +46,9 @@ there clears it up.
 ####
 
 
+import struct
 from array import array
+from binascii import unhexlify
 
 # Globals mandated by PEP 272:
 # http://www.python.org/dev/peps/pep-0272/
@@ -60,17 +60,29 @@ block_size = 16
 # variable length key: 16, 24 or 32 bytes
 key_size = None
 
+# Compact arrays of unsigned 32-bit words
+WORD = 'I' if array('I').itemsize == 4 else 'L'
+
 def new(key, mode, IV=None):
     if mode == MODE_ECB:
         return ECBMode(AES(key))
     elif mode == MODE_CBC:
         if IV is None:
-            raise ValueError, "CBC mode needs an IV value!"
+            raise ValueError("CBC mode needs an IV value!")
 
         return CBCMode(AES(key), IV)
     else:
         raise NotImplementedError
 
+def _words(data):
+    """Big-endian 32-bit words of `data` (a multiple of 4 bytes long)"""
+    if isinstance(data, array):
+        data = data.tobytes() if hasattr(data, 'tobytes') else data.tostring()
+    return struct.unpack('>%dI' % (len(data) // 4), data)
+
+def _bytes(words):
+    return struct.pack('>%dI' % len(words), *words)
+
 #### AES cipher implementation
 
 class AES(object):
@@ -92,201 +104,142 @@ class AES(object):
         elif self.key_size == 32:
             self.rounds = 14
         else:
-            raise ValueError, "Key length must be 16, 24 or 32 bytes"
+            raise ValueError("Key length must be 16, 24 or 32 bytes")
 
         self.expand_key()
 
     def expand_key(self):
-        """Performs AES key expansion on self.key and stores in self.exkey"""
-
-        # The key schedule specifies how parts of the key are fed into the
-        # cipher's round functions. "Key expansion" means performing this
-        # schedule in advance. Almost all implementations do this.
-        #
-        # Here's a description of AES key schedule:
-        # http://en.wikipedia.org/wiki/Rijndael_key_schedule
-
-        # The expanded key starts with the actual key itself
-        exkey = array('B', self.key)
-
-        # extra key expansion steps
-        if self.key_size == 16:
-            extra_cnt = 0
-        elif self.key_size == 24:
-            extra_cnt = 2
-        else:
-            extra_cnt = 3
-
-        # 4-byte temporary variable for key expansion
-        word = exkey[-4:]
-        # Each expansion cycle uses 'i' once for Rcon table lookup
-        for i in xrange(1, 11):
-
-            #### key schedule core:
-            # left-rotate by 1 byte
-            word = word[1:4] + word[0:1]
-
-            # apply S-box to all bytes
-            for j in xrange(4):
-                word[j] = aes_sbox[word[j]]
-
-            # apply the Rcon table to the leftmost byte
-            word[0] ^= aes_Rcon[i]
-            #### end key schedule core
-
-            for z in xrange(4):
-                for j in xrange(4):
-                    # mix in bytes from the last subkey
-                    word[j] ^= exkey[-self.key_size + j]
-                exkey.extend(word)
+        """Performs AES key expansion on self.key into self.ekey (encryption)
+        and self.dkey (decryption), (rounds + 1) * 4 words each.
 
-            # Last key expansion cycle always finishes here
-            if len(exkey) >= (self.rounds+1) * self.block_size:
-                break
-
-            # Special substitution step for 256-bit key
-            if self.key_size == 32:
-                for j in xrange(4):
-                    # mix in bytes from the last subkey XORed with S-box of
-                    # current word bytes
-                    word[j] = aes_sbox[word[j]] ^ exkey[-self.key_size + j]
-                exkey.extend(word)
-
-            # Twice for 192-bit key, thrice for 256-bit key
-            for z in xrange(extra_cnt):
-                for j in xrange(4):
-                    # mix in bytes from the last subkey
-                    word[j] ^= exkey[-self.key_size + j]
-                exkey.extend(word)
-
-        self.exkey = exkey
-
-    def add_round_key(self, block, round):
-        """AddRoundKey step in AES. This is where the key is mixed into plaintext"""
-
-        offset = round * 16
-        exkey = self.exkey
-
-        for i in xrange(16):
-            block[i] ^= exkey[offset + i]
-
-        #print 'AddRoundKey:', block
-
-    def sub_bytes(self, block, sbox):
-        """SubBytes step, apply S-box to all bytes
-
-        Depending on whether encrypting or decrypting, a different sbox array
-        is passed in.
-        """
-
-        for i in xrange(16):
-            block[i] = sbox[block[i]]
-
-        #print 'SubBytes   :', block
-
-    def shift_rows(self, b):
-        """ShiftRows step. Shifts 2nd row to left by 1, 3rd row by 2, 4th row by 3
-
-        Since we're performing this on a transposed matrix, cells are numbered
-        from top to bottom first::
-
-          0  4  8 12   ->    0  4  8 12    -- 1st row doesn't change
-          1  5  9 13   ->    5  9 13  1    -- row shifted to left by 1 (wraps around)
-          2  6 10 14   ->   10 14  2  6    -- shifted by 2
-          3  7 11 15   ->   15  3  7 11    -- shifted by 3
+        Here's a description of AES key schedule:
+        http://en.wikipedia.org/wiki/Rijndael_key_schedule
         """
 
-        b[1], b[5], b[ 9], b[13] = b[ 5], b[ 9], b[13], b[ 1]
-        b[2], b[6], b[10], b[14] = b[10], b[14], b[ 2], b[ 6]
-        b[3], b[7], b[11], b[15] = b[15], b[ 3], b[ 7], b[11]
-
-        #print 'ShiftRows  :', b
-
-    def shift_rows_inv(self, b):
-        """Similar to shift_rows above, but performed in inverse for decryption."""
-
-        b[ 5], b[ 9], b[13], b[ 1] = b[1], b[5], b[ 9], b[13]
-        b[10], b[14], b[ 2], b[ 6] = b[2], b[6], b[10], b[14]
-        b[15], b[ 3], b[ 7], b[11] = b[3], b[7], b[11], b[15]
-
-        #print 'ShiftRows  :', b
-
-    def mix_columns(self, block):
-        """MixColumns step. Mixes the values in each column"""
-
-        # Cache global multiplication tables (see below)
-        mul_by_2 = gf_mul_by_2
-        mul_by_3 = gf_mul_by_3
-
-        # Since we're dealing with a transposed matrix, columns are already
-        # sequential
-        for col in xrange(0, 16, 4):
-            v0, v1, v2, v3 = block[col : col+4]
-
-            block[col  ] = mul_by_2[v0] ^ v3 ^ v2 ^ mul_by_3[v1]
-            block[col+1] = mul_by_2[v1] ^ v0 ^ v3 ^ mul_by_3[v2]
-            block[col+2] = mul_by_2[v2] ^ v1 ^ v0 ^ mul_by_3[v3]
-            block[col+3] = mul_by_2[v3] ^ v2 ^ v1 ^ mul_by_3[v0]
-
-        #print 'MixColumns :', block
-
-    def mix_columns_inv(self, block):
-        """Similar to mix_columns above, but performed in inverse for decryption."""
-
-        # Cache global multiplication tables (see below)
-        mul_9  = gf_mul_by_9
-        mul_11 = gf_mul_by_11
-        mul_13 = gf_mul_by_13
-        mul_14 = gf_mul_by_14
-
-        # Since we're dealing with a transposed matrix, columns are already
-        # sequential
-        for col in xrange(0, 16, 4):
-            v0, v1, v2, v3 = block[col : col+4]
-
-            block[col  ] = mul_14[v0] ^ mul_9[v3] ^ mul_13[v2] ^ mul_11[v1]
-            block[col+1] = mul_14[v1] ^ mul_9[v0] ^ mul_13[v3] ^ mul_11[v2]
-            block[col+2] = mul_14[v2] ^ mul_9[v1] ^ mul_13[v0] ^ mul_11[v3]
-            block[col+3] = mul_14[v3] ^ mul_9[v2] ^ mul_13[v1] ^ mul_11[v0]
-
-        #print 'MixColumns :', block
+        sbox = aes_sbox
+        nk = self.key_size // 4
+        # The expanded key starts with the actual key itself
+        ekey = array(WORD, _words(self.key))
+
+        for i in range(nk, (self.rounds + 1) * 4):
+            word = ekey[i - 1]
+            if i % nk == 0:
+                # key schedule core: left-rotate by 1 byte, apply the S-box,
+                # apply the Rcon table to the leftmost byte
+                word = ((sbox[(word >> 16) & 255] << 24) |
+                        (sbox[(word >> 8) & 255] << 16) |
+                        (sbox[word & 255] << 8) |
+                        sbox[word >> 24]) ^ (aes_Rcon[i // nk] << 24)
+            elif nk > 6 and i % nk == 4:
+                # Special substitution step for 256-bit key
+                word = ((sbox[word >> 24] << 24) |
+                        (sbox[(word >> 16) & 255] << 16) |
+                        (sbox[(word >> 8) & 255] << 8) |
+                        sbox[word & 255])
+            ekey.append(ekey[i - nk] ^ word)
+
+        # Decryption uses the round keys in reverse, with InvMixColumns
+        # applied to all but the first and the last: Td*[S[x]] is
+        # InvMixColumns of a column with x in one row.
+        Td0, Td1, Td2, Td3 = aes_Td
+        dkey = array(WORD)
+        for round in range(self.rounds, -1, -1):
+            for word in ekey[round * 4 : round * 4 + 4]:
+                if 0 < round < self.rounds:
+                    word = (Td0[sbox[word >> 24]] ^
+                            Td1[sbox[(word >> 16) & 255]] ^
+                            Td2[sbox[(word >> 8) & 255]] ^
+                            Td3[sbox[word & 255]])
+                dkey.append(word)
+
+        self.ekey = ekey
+        self.dkey = dkey
+
+    def encrypt_words(self, words):
+        """Encrypts a sequence of big-endian words, four per block. Returns
+        an array of the encrypted words."""
+
+        Te0, Te1, Te2, Te3 = aes_Te
+        sbox = aes_sbox
+        rk = self.ekey
+        last = self.rounds * 4
+        out = array(WORD)
+
+        for offset in range(0, len(words), 4):
+            s0 = words[offset    ] ^ rk[0]
+            s1 = words[offset + 1] ^ rk[1]
+            s2 = words[offset + 2] ^ rk[2]
+            s3 = words[offset + 3] ^ rk[3]
+
+            for k in range(4, last, 4):
+                t0 = (Te0[s0 >> 24] ^ Te1[(s1 >> 16) & 255] ^
+                      Te2[(s2 >> 8) & 255] ^ Te3[s3 & 255] ^ rk[k])
+                t1 = (Te0[s1 >> 24] ^ Te1[(s2 >> 16) & 255] ^
+                      Te2[(s3 >> 8) & 255] ^ Te3[s0 & 255] ^ rk[k + 1])
+                t2 = (Te0[s2 >> 24] ^ Te1[(s3 >> 16) & 255] ^
+                      Te2[(s0 >> 8) & 255] ^ Te3[s1 & 255] ^ rk[k + 2])
+                s3 = (Te0[s3 >> 24] ^ Te1[(s0 >> 16) & 255] ^
+                      Te2[(s1 >> 8) & 255] ^ Te3[s2 & 255] ^ rk[k + 3])
+                s0, s1, s2 = t0, t1, t2
+
+            # no mix_columns step in the last round
+            out.append(((sbox[s0 >> 24] << 24) | (sbox[(s1 >> 16) & 255] << 16) |
+                        (sbox[(s2 >> 8) & 255] << 8) | sbox[s3 & 255]) ^ rk[last])
+            out.append(((sbox[s1 >> 24] << 24) | (sbox[(s2 >> 16) & 255] << 16) |
+                        (sbox[(s3 >> 8) & 255] << 8) | sbox[s0 & 255]) ^ rk[last + 1])
+            out.append(((sbox[s2 >> 24] << 24) | (sbox[(s3 >> 16) & 255] << 16) |
+                        (sbox[(s0 >> 8) & 255] << 8) | sbox[s1 & 255]) ^ rk[last + 2])
+            out.append(((sbox[s3 >> 24] << 24) | (sbox[(s0 >> 16) & 255] << 16) |
+                        (sbox[(s1 >> 8) & 255] << 8) | sbox[s2 & 255]) ^ rk[last + 3])
+
+        return out
+
+    def decrypt_words(self, words):
+        """Decrypts a sequence of big-endian words, four per block. Returns
+        an array of the decrypted words."""
+
+        Td0, Td1, Td2, Td3 = aes_Td
+        sbox = aes_inv_sbox
+        rk = self.dkey
+        last = self.rounds * 4
+        out = array(WORD)
+
+        for offset in range(0, len(words), 4):
+            s0 = words[offset    ] ^ rk[0]
+            s1 = words[offset + 1] ^ rk[1]
+            s2 = words[offset + 2] ^ rk[2]
+            s3 = words[offset + 3] ^ rk[3]
+
+            for k in range(4, last, 4):
+                t0 = (Td0[s0 >> 24] ^ Td1[(s3 >> 16) & 255] ^
+                      Td2[(s2 >> 8) & 255] ^ Td3[s1 & 255] ^ rk[k])
+                t1 = (Td0[s1 >> 24] ^ Td1[(s0 >> 16) & 255] ^
+                      Td2[(s3 >> 8) & 255] ^ Td3[s2 & 255] ^ rk[k + 1])
+                t2 = (Td0[s2 >> 24] ^ Td1[(s1 >> 16) & 255] ^
+                      Td2[(s0 >> 8) & 255] ^ Td3[s3 & 255] ^ rk[k + 2])
+                s3 = (Td0[s3 >> 24] ^ Td1[(s2 >> 16) & 255] ^
+                      Td2[(s1 >> 8) & 255] ^ Td3[s0 & 255] ^ rk[k + 3])
+                s0, s1, s2 = t0, t1, t2
+
+            # no mix_columns step in the last round
+            out.append(((sbox[s0 >> 24] << 24) | (sbox[(s3 >> 16) & 255] << 16) |
+                        (sbox[(s2 >> 8) & 255] << 8) | sbox[s1 & 255]) ^ rk[last])
+            out.append(((sbox[s1 >> 24] << 24) | (sbox[(s0 >> 16) & 255] << 16) |
+                        (sbox[(s3 >> 8) & 255] << 8) | sbox[s2 & 255]) ^ rk[last + 1])
+            out.append(((sbox[s2 >> 24] << 24) | (sbox[(s1 >> 16) & 255] << 16) |
+                        (sbox[(s0 >> 8) & 255] << 8) | sbox[s3 & 255]) ^ rk[last + 2])
+            out.append(((sbox[s3 >> 24] << 24) | (sbox[(s2 >> 16) & 255] << 16) |
+                        (sbox[(s1 >> 8) & 255] << 8) | sbox[s0 & 255]) ^ rk[last + 3])
+
+        return out
 
     def encrypt_block(self, block):
-        """Encrypts a single block. This is the main AES function"""
-
-        # For efficiency reasons, the state between steps is transmitted via a
-        # mutable array, not returned
-        self.add_round_key(block, 0)
-
-        for round in xrange(1, self.rounds):
-            self.sub_bytes(block, aes_sbox)
-            self.shift_rows(block)
-            self.mix_columns(block)
-            self.add_round_key(block, round)
-
-        self.sub_bytes(block, aes_sbox)
-        self.shift_rows(block)
-        # no mix_columns step in the last round
-        self.add_round_key(block, self.rounds)
+        """Encrypts a single block (a mutable array of 16 bytes) in place"""
+        block[:] = array('B', _bytes(self.encrypt_words(_words(block))))
 
     def decrypt_block(self, block):
-        """Decrypts a single block. This is the main AES decryption function"""
-
-        # For efficiency reasons, the state between steps is transmitted via a
-        # mutable array, not returned
-        self.add_round_key(block, self.rounds)
-
-        # count rounds down from (self.rounds) ... 1
-        for round in xrange(self.rounds-1, 0, -1):
-            self.shift_rows_inv(block)
-            self.sub_bytes(block, aes_inv_sbox)
-            self.add_round_key(block, round)
-            self.mix_columns_inv(block)
-
-        self.shift_rows_inv(block)
-        self.sub_bytes(block, aes_inv_sbox)
-        self.add_round_key(block, 0)
-        # no mix_columns step in the last round
+        """Decrypts a single block (a mutable array of 16 bytes) in place"""
+        block[:] = array('B', _bytes(self.decrypt_words(_words(block))))
 
 
 #### ECB mode implementation
@@ -296,37 +249,32 @@ class ECBMode(object):
 
     Basically this mode applies the cipher function to each block individually;
     no feedback is done. NB! This is insecure for almost all purposes
+
+    All blocks of a call are converted to words at once and run through the
+    cipher in a single loop.
     """
 
     def __init__(self, cipher):
         self.cipher = cipher
         self.block_size = cipher.block_size
 
-    def ecb(self, data, block_func):
+    def ecb(self, data, words_func):
         """Perform ECB mode with the given function"""
 
         if len(data) % self.block_size != 0:
-            raise ValueError, "Input length must be multiple of 16"
-
-        block_size = self.block_size
-        data = array('B', data)
-
-        for offset in xrange(0, len(data), block_size):
-            block = data[offset : offset+block_size]
-            block_func(block)
-            data[offset : offset+block_size] = block
+            raise ValueError("Input length must be multiple of 16")
 
-        return data.tostring()
+        return _bytes(words_func(_words(data)))
 
     def encrypt(self, data):
         """Encrypt data in ECB mode"""
 
-        return self.ecb(data, self.cipher.encrypt_block)
+        return self.ecb(data, self.cipher.encrypt_words)
 
     def decrypt(self, data):
         """Decrypt data in ECB mode"""
 
-        return self.ecb(data, self.cipher.decrypt_block)
+        return self.ecb(data, self.cipher.decrypt_words)
 
 #### CBC mode
 
@@ -343,59 +291,44 @@ class CBCMode(object):
     def __init__(self, cipher, IV):
         self.cipher = cipher
         self.block_size = cipher.block_size
-        self.IV = array('B', IV)
+        self.IV = _words(IV)
 
     def encrypt(self, data):
         """Encrypt data in CBC mode"""
 
         block_size = self.block_size
         if len(data) % block_size != 0:
-            raise ValueError, "Plaintext length must be multiple of 16"
+            raise ValueError("Plaintext length must be multiple of 16")
 
-        data = array('B', data)
+        words = _words(data)
         IV = self.IV
+        out = array(WORD)
 
-        for offset in xrange(0, len(data), block_size):
-            block = data[offset : offset+block_size]
-
+        for offset in range(0, len(words), 4):
             # Perform CBC chaining
-            for i in xrange(block_size):
-                block[i] ^= IV[i]
-
-            self.cipher.encrypt_block(block)
-            data[offset : offset+block_size] = block
-            IV = block
+            block = [word ^ iv for word, iv in zip(words[offset : offset+4], IV)]
+            IV = self.cipher.encrypt_words(block)
+            out.extend(IV)
 
-        self.IV = IV
-        return data.tostring()
+        self.IV = tuple(IV)
+        return _bytes(out)
 
     def decrypt(self, data):
         """Decrypt data in CBC mode"""
 
         block_size = self.block_size
         if len(data) % block_size != 0:
-            raise ValueError, "Ciphertext length must be multiple of 16"
-
-        data = array('B', data)
-        IV = self.IV
+            raise ValueError("Ciphertext length must be multiple of 16")
 
-        for offset in xrange(0, len(data), block_size):
-            ctext = data[offset : offset+block_size]
-            block = ctext[:]
-            self.cipher.decrypt_block(block)
+        words = _words(data)
+        # Blocks don't depend on each other's output, so they can all be
+        # decrypted in one go and chained afterwards.
+        plain = self.cipher.decrypt_words(words)
+        chain = self.IV + words[:-4]
+        out = [word ^ prev for word, prev in zip(plain, chain)]
 
-            # Perform CBC chaining
-            #for i in xrange(block_size):
-            #    data[offset + i] ^= IV[i]
-            for i in xrange(block_size):
-                block[i] ^= IV[i]
-            data[offset : offset+block_size] = block
-
-            IV = ctext
-            #data[offset : offset+block_size] = block
-
-        self.IV = IV
-        return data.tostring()
+        self.IV = words[-4:] if words else self.IV
+        return _bytes(out)
 
 ####
 
@@ -412,15 +345,6 @@ def galois_multiply(a, b):
 
     return p & 0xff
 
-# Precompute the multiplication tables for encryption
-gf_mul_by_2  = array('B', [galois_multiply(x,  2) for x in range(256)])
-gf_mul_by_3  = array('B', [galois_multiply(x,  3) for x in range(256)])
-# ... for decryption
-gf_mul_by_9  = array('B', [galois_multiply(x,  9) for x in range(256)])
-gf_mul_by_11 = array('B', [galois_multiply(x, 11) for x in range(256)])
-gf_mul_by_13 = array('B', [galois_multiply(x, 13) for x in range(256)])
-gf_mul_by_14 = array('B', [galois_multiply(x, 14) for x in range(256)])
-
 ####
 
 # The S-box is a 256-element array, that maps a single byte value to another
@@ -429,7 +353,7 @@ gf_mul_by_14 = array('B', [galois_multiply(x, 14) for x in range(256)])
 #
 # More information: http://en.wikipedia.org/wiki/Rijndael_S-box
 
-aes_sbox = array('B',
+aes_sbox = array('B', unhexlify(
     '637c777bf26b6fc53001672bfed7ab76'
     'ca82c97dfa5947f0add4a2af9ca472c0'
     'b7fd9326363ff7cc34a5e5f171d83115'
@@ -445,13 +369,13 @@ aes_sbox = array('B',
     'ba78252e1ca6b4c6e8dd741f4bbd8b8a'
     '703eb5664803f60e613557b986c11d9e'
     'e1f8981169d98e949b1e87e9ce5528df'
-    '8ca1890dbfe6426841992d0fb054bb16'.decode('hex')
-)
+    '8ca1890dbfe6426841992d0fb054bb16'
+))
 
 # This is the inverse of the above. In other words:
 # aes_inv_sbox[aes_sbox[val]] == val
 
-aes_inv_sbox = array('B',
+aes_inv_sbox = array('B', unhexlify(
     '52096ad53036a538bf40a39e81f3d7fb'
     '7ce339829b2fff87348e4344c4dee9cb'
     '547b9432a6c2233dee4c950b42fac34e'
@@ -467,29 +391,35 @@ aes_inv_sbox = array('B',
     '1fdda8338807c731b11210592780ec5f'
     '60517fa919b54a0d2de57a9f93c99cef'
     'a0e03b4dae2af5b0c8ebbb3c83539961'
-    '172b047eba77d626e169146355210c7d'.decode('hex')
-)
+    '172b047eba77d626e169146355210c7d'
+))
 
 # The Rcon table is used in AES's key schedule (key expansion)
 # It's a pre-computed table of exponentation of 2 in AES's finite field
 #
 # More information: http://en.wikipedia.org/wiki/Rijndael_key_schedule
 
-aes_Rcon = array('B',
+aes_Rcon = array('B', unhexlify(
     '8d01020408102040801b366cd8ab4d9a'
-    '2f5ebc63c697356ad4b37dfaefc59139'
-    '72e4d3bd61c29f254a943366cc831d3a'
-    '74e8cb8d01020408102040801b366cd8'
-    'ab4d9a2f5ebc63c697356ad4b37dfaef'
-    'c5913972e4d3bd61c29f254a943366cc'
-    '831d3a74e8cb8d01020408102040801b'
-    '366cd8ab4d9a2f5ebc63c697356ad4b3'
-    '7dfaefc5913972e4d3bd61c29f254a94'
-    '3366cc831d3a74e8cb8d010204081020'
-    '40801b366cd8ab4d9a2f5ebc63c69735'
-    '6ad4b37dfaefc5913972e4d3bd61c29f'
-    '254a943366cc831d3a74e8cb8d010204'
-    '08102040801b366cd8ab4d9a2f5ebc63'
-    'c697356ad4b37dfaefc5913972e4d3bd'
-    '61c29f254a943366cc831d3a74e8cb'.decode('hex')
-)
+))
+
+def _round_tables(sbox, coefficients):
+    """The four T-tables of a round: entry x of the first one is the column
+    MixColumns (or InvMixColumns) makes of sbox[x] in the first row, the
+    others are that column rotated right by 1, 2 and 3 bytes."""
+
+    c0, c1, c2, c3 = coefficients
+    t0 = array(WORD, [(galois_multiply(s, c0) << 24) |
+                      (galois_multiply(s, c1) << 16) |
+                      (galois_multiply(s, c2) << 8) |
+                      galois_multiply(s, c3) for s in sbox])
+    tables = [t0]
+    for shift in (8, 16, 24):
+        tables.append(array(WORD, [((w >> shift) | (w << (32 - shift))) &
+                                   0xffffffff for w in t0]))
+    return tuple(tables)
+
+# For encryption: MixColumns multiplies by 2, 1, 1, 3
+aes_Te = _round_tables(aes_sbox, (2, 1, 1, 3))
+# ... for decryption: InvMixColumns multiplies by 14, 9, 13, 11
+aes_Td = _round_tables(aes_inv_sbox, (14, 9, 13, 11))
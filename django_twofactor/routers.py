@@ -0,0 +1,110 @@
+"""
+Database router for running two-factor authentication on a replicated
+database::
+
+    DATABASE_ROUTERS = ["django_twofactor.routers.TwoFactorRouter"]
+    TWOFACTOR_READ_DATABASE = "replica"
+    TWOFACTOR_WRITE_DATABASE = "default"  # the default
+
+Token reads (help texts of `TwoFactorMixin` forms, admin listings) go to
+the replica. Writes (HOTP counters, enrollment, resets) go to the primary,
+and from then on the rest of the request reads from the primary too, so it
+sees its own writes. Logins pin the primary before loading the devices
+they verify against, so that a lagging replica can't reject a good code
+with a stale counter or time step. The app's tables are never migrated on
+the replica.
+
+Pinning is per thread. It is cleared when a request starts and finishes,
+and when a Celery task starts and finishes if Celery is installed; other
+work outside requests (management commands, threads) can clear it with
+`pinning_scope()`.
+
+HOTP codes stay single-use with a lagging replica: the counter is only
+advanced by a conditional UPDATE on the primary.
+"""
+
+import threading
+from contextlib import contextmanager
+
+from django.core.signals import request_finished, request_started
+
+from django_twofactor.conf import get_config
+
+
+_state = threading.local()
+
+
+def pin_primary():
+    """ Sends this thread's token reads to the primary from now on. """
+    _state.pinned = True
+
+
+def unpin(**kwargs):
+    _state.pinned = False
+
+
+def is_pinned():
+    return getattr(_state, "pinned", False)
+
+
+def reads_from_replica():
+    """ Whether this thread's token reads go to a replica right now. """
+    return bool(get_config().read_database) and not is_pinned()
+
+
+@contextmanager
+def pinning_scope():
+    """ Clears the pin on entering and leaving the block. """
+    unpin()
+    try:
+        yield
+    finally:
+        unpin()
+
+
+request_started.connect(unpin)
+request_finished.connect(unpin)
+
+try:
+    from celery.signals import task_postrun, task_prerun
+except ImportError:
+    pass
+else:
+    task_prerun.connect(unpin)
+    task_postrun.connect(unpin)
+
+
+def _is_token_model(model):
+    return (model._meta.app_label == "django_twofactor" and
+            model._meta.model_name == "userauthtoken")
+
+
+class TwoFactorRouter(object):
+    def db_for_read(self, model, **hints):
+        if not _is_token_model(model):
+            return None
+        config = get_config()
+        if not config.read_database or is_pinned():
+            return config.write_database
+        return config.read_database
+
+    def db_for_write(self, model, **hints):
+        if not _is_token_model(model):
+            return None
+        pin_primary()
+        return get_config().write_database
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label != "django_twofactor":
+            return None
+        read_database = get_config().read_database
+        if read_database and db == read_database:
+            return False
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica is a copy of the primary, so a token read from it may
+        # point at a user read from the primary and vice versa.
+        if _is_token_model(obj1) or _is_token_model(obj2):
+            return True
+        return None
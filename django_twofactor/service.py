@@ -0,0 +1,218 @@
+"""
+Optional stand-alone verification service, so that web nodes need neither
+the seeds nor `TWOFACTOR_ENCRYPTION_KEY`.
+
+The service is a WSGI application that runs with the same settings as the
+site. Give it `CONN_MAX_AGE` so that its database connections persist, and
+e.g. bind it to a unix socket::
+
+    DJANGO_SETTINGS_MODULE=mysite.settings gunicorn --threads 8 \\
+        --bind unix:/run/twofactor.sock django_twofactor.service:application
+
+The web nodes then use `ServiceTwoFactorAuthBackend` with::
+
+    TWOFACTOR_SERVICE_URL = "unix:/run/twofactor.sock"  # or http://host:port/
+    TWOFACTOR_SERVICE_TOKEN = "shared secret"
+
+Protocol: POST `{"attempts": [{"user_id": 1, "code": "123456"}, ...]}` with
+an `Authorization: Bearer <TWOFACTOR_SERVICE_TOKEN>` header. The response
+is `{"results": [...]}` in the same order, each one `{"enabled": false}` for
+users without two-factor authentication, or `{"enabled": true, "token":
+...}` where `token` is the matching device (`id`, `name`, `type`) or null.
+"""
+
+import json
+import socket
+import threading
+from collections import OrderedDict
+
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse
+except ImportError:
+    from httplib import HTTPConnection
+    from urlparse import urlparse
+
+from django.core.signals import request_finished, request_started
+from django.utils import six
+from django.utils.crypto import constant_time_compare
+
+from django_twofactor.conf import get_config
+
+
+class SeedCache(object):
+    """
+    A bounded, thread-safe LRU of decrypted seeds keyed by encrypted seed,
+    so that each seed is decrypted once per service process.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._seeds = OrderedDict()
+        self._lock = threading.Lock()
+
+    def attach(self, tokens):
+        """ Hands the cached seeds to `tokens`, decrypting missing ones. """
+        for token in tokens:
+            with self._lock:
+                raw_seed = self._seeds.pop(token.encrypted_seed, None)
+                if raw_seed is not None:
+                    self._seeds[token.encrypted_seed] = raw_seed
+            if raw_seed is None:
+                raw_seed = token.get_raw_seed()
+                with self._lock:
+                    self._seeds[token.encrypted_seed] = raw_seed
+                    while len(self._seeds) > self.max_size:
+                        self._seeds.popitem(last=False)
+            token._raw_seed = (token.encrypted_seed, raw_seed)
+
+
+def verify_batch(attempts, seed_cache=None):
+    """
+    Checks `(user_id, code)` pairs, loading the devices of all users in a
+    single query. Returns one result dict per attempt (see module docs).
+    """
+    from django_twofactor import routers
+    from django_twofactor.models import UserAuthToken
+
+    routers.pin_primary()
+    tokens_by_user = UserAuthToken.objects.active_for_users(
+        set(user_id for user_id, code in attempts))
+    results = []
+    for user_id, code in attempts:
+        tokens = tokens_by_user.get(user_id)
+        if not tokens:
+            results.append({"enabled": False})
+            continue
+        if seed_cache is not None:
+            seed_cache.attach(tokens)
+        matched = UserAuthToken.objects.match_auth_code(tokens, code)
+        if matched is None:
+            results.append({"enabled": True, "token": None})
+        else:
+            results.append({"enabled": True, "token": {
+                "id": matched.pk,
+                "name": matched.name,
+                "type": matched.type,
+            }})
+    return results
+
+
+class VerificationService(object):
+    """ The WSGI application. Django is set up on the first request. """
+
+    def __init__(self):
+        self.seed_cache = None
+
+    def __call__(self, environ, start_response):
+        from django.apps import apps
+        if not apps.ready:
+            import django
+            django.setup()
+        if self.seed_cache is None:
+            self.seed_cache = SeedCache(get_config().service_seed_cache_size)
+
+        # Lets Django recycle database connections past CONN_MAX_AGE.
+        request_started.send(sender=self.__class__, environ=environ)
+        try:
+            status, body = self.handle(environ)
+        finally:
+            request_finished.send(sender=self.__class__)
+
+        body = json.dumps(body).encode("utf-8")
+        start_response(status, [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+        ])
+        return [body]
+
+    def handle(self, environ):
+        if environ["REQUEST_METHOD"] != "POST":
+            return "405 Method Not Allowed", {"error": "POST only"}
+
+        expected = get_config().service_token
+        authorization = environ.get("HTTP_AUTHORIZATION", "")
+        if not expected or not constant_time_compare(
+                authorization, "Bearer %s" % expected):
+            return "403 Forbidden", {"error": "bad token"}
+
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            data = json.loads(environ["wsgi.input"].read(length).decode("utf-8"))
+            attempts = []
+            for attempt in data["attempts"]:
+                user_id, code = attempt["user_id"], attempt["code"] or ""
+                if (not isinstance(user_id, six.integer_types) or
+                        isinstance(user_id, bool) or
+                        not isinstance(code, six.string_types)):
+                    raise TypeError("bad attempt")
+                attempts.append((user_id, code))
+        except (ValueError, KeyError, TypeError):
+            return "400 Bad Request", {"error": "malformed request"}
+
+        return "200 OK", {"results": verify_batch(attempts, self.seed_cache)}
+
+
+application = VerificationService()
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, path, timeout):
+        HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+_connections = threading.local()
+
+
+def _get_connection(config):
+    """ A kept-alive connection to the service, one per thread. """
+    connection = getattr(_connections, "connection", None)
+    if connection is None or _connections.url != config.service_url:
+        if config.service_url.startswith("unix:"):
+            connection = UnixHTTPConnection(
+                config.service_url[len("unix:"):], config.service_timeout)
+        else:
+            url = urlparse(config.service_url)
+            connection = HTTPConnection(
+                url.hostname, url.port or 80, timeout=config.service_timeout)
+        _connections.connection = connection
+        _connections.url = config.service_url
+    return connection
+
+
+def verify_remote(attempts):
+    """
+    Sends `(user_id, code)` pairs to the service in one request and returns
+    its results.
+    """
+    config = get_config()
+    if config.service_url.startswith("unix:"):
+        path = "/"
+    else:
+        path = urlparse(config.service_url).path or "/"
+    body = json.dumps({"attempts": [
+        {"user_id": user_id, "code": code} for user_id, code in attempts
+    ]})
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": "Bearer %s" % config.service_token,
+    }
+    connection = _get_connection(config)
+    try:
+        connection.request("POST", path, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+    except Exception:
+        # Don't reuse a connection in an unknown state.
+        connection.close()
+        _connections.connection = None
+        raise
+    if response.status != 200:
+        raise IOError("Verification service answered %s" % response.status)
+    return json.loads(data.decode("utf-8"))["results"]
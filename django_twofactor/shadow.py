@@ -0,0 +1,176 @@
+"""
+Shadow verification: runs a candidate OTP engine next to the oath based
+one on a sample of live checks, to compare them before switching.
+
+`TWOFACTOR_SHADOW_ENGINE` is the dotted path of the candidate's class.
+Instances need the two methods `match_totp_step(raw_seed, auth_code,
+token_type, t, drift)` and `check_hotp(raw_seed, auth_code, counter,
+token_type)`, with the results of the functions of the same name in
+`django_twofactor.util`. Then:
+
+* `TWOFACTOR_SHADOW_SAMPLE_RATE` (default 0.01) is the share of checks
+  the candidate also runs for;
+* `TWOFACTOR_SHADOW_MAX_OVERHEAD` (default 0.02) caps the time it may
+  take, in seconds per second; samples are skipped while it is used up;
+* `TWOFACTOR_SHADOW_SINK` (default `log_sink`) is the dotted path of a
+  callable that gets a dict per sampled check: `kind` ("totp" or
+  "hotp"), `agree`, `primary` and `candidate` (the results), `error` (of
+  the candidate, if it raised), and `primary_time` and `candidate_time`
+  in seconds. Neither seeds nor codes are passed on.
+
+The candidate's result, or its exceptions, never change the outcome of a
+check, nor its latency: sampled checks are queued for a single background
+thread, and dropped while `QUEUE_SIZE` of them are waiting.
+"""
+
+import logging
+import os
+import random
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from django_twofactor.conf import get_config, perf_counter
+
+
+logger = logging.getLogger(__name__)
+
+
+def log_sink(event):
+    """ Logs disagreements and candidate errors as warnings. """
+    if event["error"] is not None:
+        logger.warning("Shadow %s engine failed: %s", event["kind"],
+                       event["error"])
+    elif not event["agree"]:
+        logger.warning(
+            "Shadow %s engine disagrees: primary %r, candidate %r",
+            event["kind"], event["primary"], event["candidate"])
+
+
+QUEUE_SIZE = 100
+
+
+class Shadow(object):
+    """
+    The candidate engine, its sink, what is left of its budget and the
+    queue of checks to compare. `skipped` counts the samples left out for
+    lack of budget, `dropped` those left out because the queue was full.
+    """
+
+    timer = staticmethod(perf_counter)
+
+    def __init__(self, engine, sink, sample_rate, max_overhead,
+                 queue_size=QUEUE_SIZE):
+        self.engine = engine
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.max_overhead = max_overhead
+        self.queue_size = queue_size
+        self.skipped = 0
+        self.dropped = 0
+        self._allowance = max_overhead
+        self._last = None
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._queue = None
+        self._pid = None
+
+    def _take(self, now):
+        """ Whether to run the candidate now, within the budget. """
+        if self._random.random() >= self.sample_rate:
+            return False
+        with self._lock:
+            if self._last is not None:
+                # At most a second's worth of budget builds up.
+                self._allowance = min(
+                    self.max_overhead,
+                    self._allowance + (now - self._last) * self.max_overhead)
+            self._last = now
+            if self._allowance <= 0:
+                self.skipped += 1
+                return False
+            return True
+
+    def compare(self, kind, args, primary, primary_time):
+        """
+        Queues the candidate's `kind` method to run with `args` if this
+        check is sampled, and to report how it compares with `primary`.
+        """
+        if not self._take(self.timer()):
+            return
+        try:
+            self._get_queue().put_nowait((kind, args, primary, primary_time))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def wait(self):
+        """ Waits until the queued checks are compared. """
+        if self._queue is not None:
+            self._queue.join()
+
+    def _get_queue(self):
+        # Started on first use, and again in a forked child, which doesn't
+        # inherit the thread.
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._queue = queue.Queue(self.queue_size)
+                    worker = threading.Thread(
+                        target=self._work, args=(self._queue,),
+                        name="twofactor-shadow")
+                    worker.daemon = True
+                    worker.start()
+                    self._pid = pid
+        return self._queue
+
+    def _work(self, checks):
+        while True:
+            check = checks.get()
+            try:
+                self._run(*check)
+            except Exception:
+                logger.exception("Shadow verification failed")
+            finally:
+                checks.task_done()
+
+    def _run(self, kind, args, primary, primary_time):
+        candidate = error = None
+        start = self.timer()
+        try:
+            candidate = getattr(self.engine, kind)(*args)
+        except Exception as e:
+            error = "%s: %s" % (e.__class__.__name__, e)
+        candidate_time = self.timer() - start
+        with self._lock:
+            self._allowance -= candidate_time
+        self.sink({
+            "kind": "totp" if kind == "match_totp_step" else "hotp",
+            "agree": error is None and candidate == primary,
+            "primary": primary,
+            "candidate": candidate,
+            "error": error,
+            "primary_time": primary_time,
+            "candidate_time": candidate_time,
+        })
+
+
+_shadow = None
+
+
+def get_shadow():
+    """ The `Shadow` for the current configuration, or None if it is off. """
+    global _shadow
+    config = get_config()
+    if _shadow is None or _shadow[0] is not config:
+        shadow = None
+        if config.shadow_engine is not None:
+            shadow = Shadow(config.shadow_engine(), config.shadow_sink,
+                            config.shadow_sample_rate,
+                            config.shadow_max_overhead)
+        _shadow = (config, shadow)
+    return _shadow[1]
@@ -0,0 +1,408 @@
+"""
+Stores for the short-lived keys that guard verification: the per-code
+locks against concurrent and repeated use, the HOTP retry counters and the
+login throttle's counters (see `django_twofactor.throttle`).
+
+`TWOFACTOR_GATE_STORE` picks the store class, `TWOFACTOR_GATE_STORE_OPTIONS`
+is passed to it as keyword arguments. A store has three methods:
+
+* `add(key, ttl)` sets `key` for `ttl` seconds unless it is set already,
+  and returns whether it did;
+* `incr(key, ttl)` adds one to the counter `key`, creating it for `ttl`
+  seconds if needed, and returns the new count;
+* `get_many(keys)` returns a dict of the counters among `keys` that are
+  set.
+
+`CacheStore` (the default) uses the Django cache and works across hosts.
+`SharedMemoryStore` keeps the keys in a memory-mapped file that all worker
+processes of one host share, so the checks need no network round trip::
+
+    TWOFACTOR_GATE_STORE = "django_twofactor.stores.SharedMemoryStore"
+    TWOFACTOR_GATE_STORE_OPTIONS = {"path": "/dev/shm/twofactor-gates"}
+
+Only use it when all logins of a user reach the same host.
+
+Unless `TWOFACTOR_GATE_FAILURES` is 0, the store is put behind a
+`CircuitBreaker`: a call that raises or takes longer than
+`TWOFACTOR_GATE_TIMEOUT` seconds counts as a failure, and after
+`TWOFACTOR_GATE_FAILURES` failures in a row the store is skipped for
+`TWOFACTOR_GATE_RESET` seconds. Meanwhile, and for each failed call, the
+keys go to a bounded `LocalStore` in the process. Replay protection then
+still rests on the database (the time step and counter updates are
+conditional); only the locks and retry limits are per process until the
+store is back. The breaker can't interrupt a call, so give the cache
+backend a socket timeout within the budget, e.g. in its `OPTIONS`.
+`gate_status()` reports the breaker's state and counters.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import force_bytes
+
+from django_twofactor.conf import get_config, perf_counter
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheStore(object):
+    """ Keys in the default Django cache. """
+
+    def add(self, key, ttl):
+        return cache.add(key, 1, ttl)
+
+    def incr(self, key, ttl):
+        cache.add(key, 0, ttl)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr().
+            cache.add(key, 1, ttl)
+            return 1
+
+    def get_many(self, keys):
+        return cache.get_many(keys)
+
+
+class SharedMemoryStore(object):
+    """
+    A fixed-size hash table in a memory-mapped file.
+
+    The table is split into `stripes` of equal size. A key always lives in
+    one stripe, found from its 64-bit hash, and every operation on the
+    stripe holds its lock: a thread lock within the process and an
+    `fcntl` record lock on one byte of the stripe across processes. Slots
+    hold `(hash, expiry time, value)`. A key is looked for in the `probes`
+    slots from its home slot on; expired slots are reused, and when all of
+    them hold live keys the one expiring first is dropped, so make `slots`
+    comfortably larger than the number of logins in the longest TTL (40
+    seconds for TOTP, `HOTP_RATELIMIT_TIMEFRAME` for HOTP retry counters).
+    """
+
+    SLOT = struct.Struct("<Qdq")
+
+    def __init__(self, path="/dev/shm/twofactor-gates", slots=1 << 16,
+                 stripes=256, probes=16):
+        if slots % stripes:
+            raise ImproperlyConfigured(
+                "TWOFACTOR_GATE_STORE_OPTIONS: slots must be a multiple of "
+                "stripes")
+        self.path = path
+        self.stripes = stripes
+        self.stripe_slots = slots // stripes
+        self.probes = min(probes, self.stripe_slots)
+        size = slots * self.SLOT.size
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        current = os.fstat(self._fd).st_size
+        if current == 0:
+            os.ftruncate(self._fd, size)
+        elif current != size:
+            raise ImproperlyConfigured(
+                "%s holds a table of a different size; remove it or use "
+                "another path" % path)
+        self._map = mmap.mmap(self._fd, size)
+        self._locks = [threading.Lock() for i in range(stripes)]
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _locate(self, key):
+        digest = hashlib.md5(force_bytes(key)).digest()
+        # 0 marks an empty slot.
+        key_hash = struct.unpack("<Q", digest[:8])[0] or 1
+        stripe = key_hash % self.stripes
+        return key_hash, stripe
+
+    def _update(self, key, ttl, update):
+        """
+        Runs `update(value)` on the live value of `key` (None if there is
+        none) under the stripe's locks. It returns `(new value, result)`;
+        a new value of None leaves the slot alone. Returns the result.
+        """
+        import fcntl
+
+        key_hash, stripe = self._locate(key)
+        first = stripe * self.stripe_slots
+        home = key_hash // self.stripes
+        now = get_config().clock()
+        slot_struct = self.SLOT
+
+        with self._locks[stripe]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1,
+                        first * slot_struct.size)
+            try:
+                found = free = oldest = None
+                oldest_expiry = None
+                for i in range(self.probes):
+                    index = first + (home + i) % self.stripe_slots
+                    slot_hash, expires, value = slot_struct.unpack_from(
+                        self._map, index * slot_struct.size)
+                    if slot_hash == key_hash and expires > now:
+                        found = index
+                        break
+                    if slot_hash == 0 or expires <= now:
+                        if free is None:
+                            free = index
+                        if slot_hash == 0:
+                            # Keys are only ever placed before an empty slot.
+                            break
+                    elif oldest_expiry is None or expires < oldest_expiry:
+                        oldest, oldest_expiry = index, expires
+
+                if found is not None:
+                    new_value, result = update(value)
+                    if new_value is not None:
+                        slot_struct.pack_into(
+                            self._map, found * slot_struct.size,
+                            key_hash, expires, new_value)
+                    return result
+
+                new_value, result = update(None)
+                if new_value is not None:
+                    index = free if free is not None else oldest
+                    slot_struct.pack_into(
+                        self._map, index * slot_struct.size,
+                        key_hash, now + ttl, new_value)
+                return result
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1,
+                            first * slot_struct.size)
+
+    def add(self, key, ttl):
+        return self._update(
+            key, ttl,
+            lambda value: (1, True) if value is None else (None, False))
+
+    def incr(self, key, ttl):
+        def update(value):
+            value = (value or 0) + 1
+            return value, value
+        return self._update(key, ttl, update)
+
+    def get_many(self, keys):
+        counts = {}
+        for key in keys:
+            value = self._update(key, 0, lambda value: (None, value))
+            if value is not None:
+                counts[key] = value
+        return counts
+
+
+class LocalStore(object):
+    """
+    Keys in a dict of the process, at most `max_keys` of them; when it is
+    full the key expiring first (of those added with the same TTL, the
+    oldest) is dropped.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _update(self, key, ttl, update):
+        now = get_config().clock()
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._keys[key]
+                entry = None
+            new_value, result = update(None if entry is None else entry[1])
+            if new_value is None:
+                return result
+            if entry is not None:
+                self._keys[key] = (entry[0], new_value)
+                return result
+            if len(self._keys) >= self.max_keys:
+                # Expired keys first, then the one expiring soonest.
+                for old_key, (expires, value) in list(self._keys.items()):
+                    if expires <= now:
+                        del self._keys[old_key]
+                if len(self._keys) >= self.max_keys:
+                    del self._keys[min(self._keys,
+                                       key=lambda k: self._keys[k][0])]
+            self._keys[key] = (now + ttl, new_value)
+            return result
+
+    def add(self, key, ttl):
+        return self._update(
+            key, ttl,
+            lambda value: (1, True) if value is None else (None, False))
+
+    def incr(self, key, ttl):
+        def update(value):
+            value = (value or 0) + 1
+            return value, value
+        return self._update(key, ttl, update)
+
+    def get_many(self, keys):
+        counts = {}
+        for key in keys:
+            value = self._update(key, 0, lambda value: (None, value))
+            if value is not None:
+                counts[key] = value
+        return counts
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of a store. It is "closed" while calls succeed,
+    "open" after `max_failures` failures in a row, and "half-open" once
+    `reset_timeout` seconds have passed since: one call is then let
+    through as a trial, which closes the breaker again or reopens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, max_failures, reset_timeout, timeout):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.timeout = timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.counts = dict.fromkeys(
+            ("calls", "errors", "slow_calls", "fallbacks", "opened"), 0)
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Whether the next call may go to the store. """
+        with self._lock:
+            if self.state == self.OPEN:
+                if (get_config().clock() - self.opened_at <
+                        self.reset_timeout):
+                    self.counts["fallbacks"] += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.trial = False
+            if self.state == self.HALF_OPEN:
+                if self.trial:
+                    self.counts["fallbacks"] += 1
+                    return False
+                self.trial = True
+            self.counts["calls"] += 1
+            return True
+
+    def record(self, duration, error=False):
+        """ Records the outcome of a call `allow()` let through. """
+        slow = duration > self.timeout
+        with self._lock:
+            if error:
+                self.counts["errors"] += 1
+            elif slow:
+                self.counts["slow_calls"] += 1
+            if not (error or slow):
+                if self.state != self.CLOSED:
+                    logger.warning("Two-factor gate store is back")
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            if error:
+                self.counts["fallbacks"] += 1
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.max_failures):
+                if self.state != self.OPEN:
+                    self.counts["opened"] += 1
+                    logger.warning(
+                        "Two-factor gate store failing, using the local "
+                        "fallback for %s seconds", self.reset_timeout)
+                self.state = self.OPEN
+                self.opened_at = get_config().clock()
+
+    def status(self):
+        with self._lock:
+            status = dict(self.counts)
+            status.update(state=self.state, failures=self.failures)
+            return status
+
+
+class GuardedStore(object):
+    """
+    Sends calls to `store` while `breaker` allows it, and to `fallback`
+    when it doesn't or when the call fails.
+    """
+
+    timer = staticmethod(perf_counter)
+
+    def __init__(self, store, fallback, breaker):
+        self.store = store
+        self.fallback = fallback
+        self.breaker = breaker
+
+    def close(self):
+        close = getattr(self.store, "close", None)
+        if close is not None:
+            close()
+
+    def _call(self, name, *args):
+        if not self.breaker.allow():
+            return getattr(self.fallback, name)(*args)
+        start = self.timer()
+        try:
+            result = getattr(self.store, name)(*args)
+        except Exception:
+            logger.exception("Two-factor gate store failed")
+            self.breaker.record(self.timer() - start, error=True)
+            return getattr(self.fallback, name)(*args)
+        self.breaker.record(self.timer() - start)
+        return result
+
+    def add(self, key, ttl):
+        return self._call("add", key, ttl)
+
+    def incr(self, key, ttl):
+        return self._call("incr", key, ttl)
+
+    def get_many(self, keys):
+        return self._call("get_many", keys)
+
+
+_store = None
+
+
+def get_store():
+    """
+    The configured store, created once per configuration and process (a
+    forked worker gets its own file descriptor and locks).
+    """
+    global _store
+    config = get_config()
+    pid = os.getpid()
+    if _store is None or _store[0] is not config or _store[1] != pid:
+        if _store is not None and _store[1] == pid:
+            close = getattr(_store[2], "close", None)
+            if close is not None:
+                close()
+        store = config.gate_store(**config.gate_store_options)
+        if config.gate_failures:
+            store = GuardedStore(
+                store, LocalStore(config.gate_fallback_size),
+                CircuitBreaker(config.gate_failures, config.gate_reset,
+                               config.gate_timeout))
+        _store = (config, pid, store)
+    return _store[2]
+
+
+def gate_status():
+    """
+    The breaker's state ("closed", "open" or "half-open") and counters of
+    this process: `calls` to the store, `errors`, `slow_calls`,
+    `fallbacks` to the local store and how often it `opened`. None if
+    there is no breaker.
+    """
+    breaker = getattr(get_store(), "breaker", None)
+    return None if breaker is None else breaker.status()
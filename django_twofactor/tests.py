@@ -1,9 +1,14 @@
 from binascii import hexlify
-from django.test import TestCase
+from django.utils.six import StringIO
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
+from django.utils.encoding import force_bytes
 from oath import totp
+from .conf import get_config
 from .models import UserAuthToken
 from .util import encrypt_value
 from .forms import GridCardActivationForm
@@ -71,6 +76,37 @@ class TotpTests(TestCase):
         self.assert_(user_or_none is None)
 
 
+@override_settings(**TWOFACTOR_SETTINGS)
+class TotpReplayTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="user", password="secret")
+        self.auth_token = UserAuthToken.objects.create(
+            user=self.user, encrypted_seed=encrypt_value("s33d"),
+            type=UserAuthToken.TYPE_TOTP)
+        self.correct_code = totp(hexlify(force_bytes("s33d")).decode('ascii'))
+
+    def test_time_step_recorded(self):
+        self.assert_(self.auth_token.check_auth_code(self.correct_code))
+        self.assertIsNotNone(self.auth_token.last_time_step)
+        self.assertEqual(
+            self.auth_token.last_time_step,
+            UserAuthToken.objects.get(pk=self.auth_token.pk).last_time_step)
+
+    def test_replay_after_cache_flush(self):
+        self.assert_(self.auth_token.check_auth_code(self.correct_code))
+        cache.clear()
+        auth_token = UserAuthToken.objects.get(pk=self.auth_token.pk)
+        self.assert_(not auth_token.check_auth_code(self.correct_code))
+
+    def test_replay_from_stale_row(self):
+        stale = UserAuthToken.objects.get(pk=self.auth_token.pk)
+        self.assert_(self.auth_token.check_auth_code(self.correct_code))
+        cache.clear()
+        self.assert_(not stale.check_auth_code(self.correct_code))
+
+
 @override_settings(**TWOFACTOR_SETTINGS)
 class HotpTests(TestCase):
     codes = ["477324", "532070", "160761"]  # hotp(hexlify("s33d"), i)
@@ -101,6 +137,56 @@ class HotpTests(TestCase):
         self.assert_(not valid)
         self.assertEqual(1, self.auth_token.counter)
 
+    def test_stale_counter_cannot_double_spend(self):
+        cache.clear()
+        stale = UserAuthToken.objects.get(pk=self.auth_token.pk)
+        self.assert_(self.auth_token.check_auth_code(self.codes[0]))
+        cache.clear()
+        self.assert_(not stale.check_auth_code(self.codes[0]))
+        self.assertEqual(
+            1, UserAuthToken.objects.get(pk=self.auth_token.pk).counter)
+
+
+@override_settings(**TWOFACTOR_SETTINGS)
+class MultipleDeviceTests(TestCase):
+    hotp_codes = HotpTests.codes
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="user", password="secret")
+        self.phone = UserAuthToken.objects.create(
+            user=self.user, name="phone", encrypted_seed=encrypt_value("s33d"),
+            type=UserAuthToken.TYPE_TOTP)
+        self.card = UserAuthToken.objects.create(
+            user=self.user, name="card", encrypted_seed=encrypt_value("s33d"),
+            type=UserAuthToken.TYPE_HOTP)
+
+    def test_active_for_user_cheapest_first(self):
+        self.assertEqual([self.phone, self.card],
+                         UserAuthToken.objects.active_for_user(self.user))
+
+    def test_inactive_devices_are_skipped(self):
+        self.card.is_active = False
+        self.card.save()
+        self.assertEqual([self.phone],
+                         UserAuthToken.objects.active_for_user(self.user))
+
+    def test_match_reports_device(self):
+        tokens = UserAuthToken.objects.active_for_user(self.user)
+        matched = UserAuthToken.objects.match_auth_code(
+            tokens, self.hotp_codes[0])
+        self.assertEqual(self.card, matched)
+        self.assertEqual(1, UserAuthToken.objects.get(pk=self.card.pk).counter)
+
+    def test_no_match(self):
+        tokens = UserAuthToken.objects.active_for_user(self.user)
+        self.assertEqual(
+            None, UserAuthToken.objects.match_auth_code(tokens, "abc"))
+        self.assertEqual(
+            None, UserAuthToken.objects.match_auth_code(
+                tokens, self.hotp_codes[1]))
+
 
 @override_settings(**TWOFACTOR_SETTINGS)
 class GridCardActivationFormTests(TestCase):
@@ -130,11 +216,12 @@ class GridCardActivationFormTests(TestCase):
         form.save()
 
         # The HOTP Token should be created
-        self.assert_(self.user.userauthtoken)
-        self.assertEqual(UserAuthToken.TYPE_HOTP, self.user.userauthtoken.type)
+        token = UserAuthToken.objects.get_for_user(self.user)
+        self.assert_(token)
+        self.assertEqual(UserAuthToken.TYPE_HOTP, token.type)
 
         # Login should work with the second code
-        self.assertEqual(1, self.user.userauthtoken.counter)
+        self.assertEqual(1, token.counter)
         user_or_none = authenticate(
             username="user", password="secret", token=self.codes[1])
         self.assertEqual(self.user, user_or_none)
@@ -205,8 +292,8 @@ class AuthFormTests(TestCase):
 @override_settings(**TWOFACTOR_SETTINGS)
 class SignalsTests(TestCase):
     def test_remove_hotp_token_after_max_logins(self):
-        from .models import HOTP_MAX_COUNTER
         from .util import get_hotp
+        HOTP_MAX_COUNTER = get_config().hotp_max_counter
         user = User.objects.create_user(
             username="user", password="secret")
         UserAuthToken.objects.create(
@@ -228,3 +315,1550 @@ class SignalsTests(TestCase):
                 username="user", password="secret", token=correct_token_2)
         self.assertEqual(user, user_or_none)
         self.assertFalse(UserAuthToken.objects.filter(user=user).exists())
+
+
+class ConfigTests(TestCase):
+    def test_rebuilt_on_setting_change(self):
+        with override_settings(HOTP_MAX_COUNTER=10):
+            self.assertEqual(10, get_config().hotp_max_counter)
+        with override_settings(HOTP_MAX_COUNTER=20):
+            self.assertEqual(20, get_config().hotp_max_counter)
+
+    def test_precomputed_values(self):
+        with override_settings(TWOFACTOR_TOTP_OPTIONS={
+                "forward_drift": 2, "backward_drift": 1,
+                "default_token_type": "dec8"}):
+            config = get_config()
+            self.assertEqual((-1, 0, 1, 2), config.drift_range)
+            self.assertEqual(8, config.token_length)
+
+    def test_invalid_settings(self):
+        with override_settings(TWOFACTOR_TOTP_OPTIONS={"period": 0}):
+            self.assertRaises(ImproperlyConfigured, get_config)
+        with override_settings(TWOFACTOR_TOTP_OPTIONS={
+                "default_token_type": "dec5"}):
+            self.assertRaises(ImproperlyConfigured, get_config)
+
+
+LAZY_IMPORT_CHILD = """
+import sys
+from django.conf import settings
+settings.configure(
+    SECRET_KEY="lazy",
+    INSTALLED_APPS=["django.contrib.auth", "django.contrib.contenttypes",
+                    "django_twofactor"],
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3",
+                           "NAME": ":memory:"}},
+)
+import django
+django.setup()
+import django_twofactor.models
+
+BACKENDS = ("oath", "Crypto.Cipher.AES", "django_twofactor.pyaes")
+sys.stdout.write(" ".join(name for name in BACKENDS if name in sys.modules))
+sys.stdout.write("\\n")
+django_twofactor.warm_up()
+sys.stdout.write(" ".join(name for name in BACKENDS if name in sys.modules))
+"""
+
+
+class WarmUpTests(TestCase):
+    def test_warm_up_loads_backends(self):
+        from . import encutil, util, warm_up
+        warm_up()
+        self.assertIsNotNone(util._oath_functions)
+        self.assertIsNotNone(encutil._AES)
+
+    def test_models_import_lazily(self):
+        # In a fresh interpreter, as this one has them loaded already.
+        import os
+        import subprocess
+        import sys
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [root] + [p for p in [os.environ.get("PYTHONPATH")] if p]))
+        env.pop("DJANGO_SETTINGS_MODULE", None)
+        output = subprocess.check_output(
+            [sys.executable, "-c", LAZY_IMPORT_CHILD], env=env,
+            universal_newlines=True)
+        before, after = output.split("\n")
+        self.assertEqual("", before)
+        loaded = after.split()
+        self.assertIn("oath", loaded)
+        self.assertTrue("Crypto.Cipher.AES" in loaded or
+                        "django_twofactor.pyaes" in loaded, loaded)
+
+
+@override_settings(TWOFACTOR_SERVICE_TOKEN="service-secret",
+                   **TWOFACTOR_SETTINGS)
+class VerificationServiceTests(TestCase):
+    codes = HotpTests.codes
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="user", password="secret")
+        self.other = User.objects.create_user(
+            username="other", password="secret")
+        self.auth_token = UserAuthToken.objects.create(
+            user=self.user, encrypted_seed=encrypt_value("s33d"),
+            type=UserAuthToken.TYPE_HOTP)
+
+    def _call(self, body, authorization="Bearer service-secret"):
+        import io
+        import json
+        from .service import VerificationService
+        body = json.dumps(body).encode("utf-8")
+        environ = {
+            "REQUEST_METHOD": "POST",
+            "CONTENT_LENGTH": str(len(body)),
+            "HTTP_AUTHORIZATION": authorization,
+            "wsgi.input": io.BytesIO(body),
+        }
+        statuses = []
+        response = VerificationService()(
+            environ, lambda status, headers: statuses.append(status))
+        return statuses[0], json.loads(b"".join(response).decode("utf-8"))
+
+    def test_verify_batch(self):
+        from .service import SeedCache, verify_batch
+        results = verify_batch([
+            (self.other.pk, "123456"),
+            (self.user.pk, self.codes[1]),
+            (self.user.pk, self.codes[0]),
+        ], SeedCache(10))
+        self.assertEqual({"enabled": False}, results[0])
+        self.assertEqual({"enabled": True, "token": None}, results[1])
+        self.assertEqual(self.auth_token.pk, results[2]["token"]["id"])
+
+    def test_requires_service_token(self):
+        status, body = self._call({"attempts": []}, authorization="Bearer x")
+        self.assertEqual("403 Forbidden", status)
+
+    def test_wsgi_application(self):
+        status, body = self._call({"attempts": [
+            {"user_id": self.user.pk, "code": self.codes[0]}]})
+        self.assertEqual("200 OK", status)
+        self.assertEqual(UserAuthToken.TYPE_HOTP,
+                         body["results"][0]["token"]["type"])
+
+    def test_malformed_attempts(self):
+        for attempt in ({"user_id": self.user.pk, "code": 477324},
+                        {"user_id": self.user.pk, "code": ["477324"]},
+                        {"user_id": str(self.user.pk), "code": "477324"},
+                        {"user_id": True, "code": "477324"}):
+            status, body = self._call({"attempts": [attempt]})
+            self.assertEqual("400 Bad Request", status)
+        self.assertEqual(0, UserAuthToken.objects.get(
+            pk=self.auth_token.pk).counter)
+
+
+@override_settings(**TWOFACTOR_SETTINGS)
+class UserAuthTokenAdminTests(TestCase):
+    def setUp(self):
+        from django.contrib.admin.sites import AdminSite
+        from django.contrib.messages.storage.cookie import CookieStorage
+        from django.test.client import RequestFactory
+        from .adminsite import UserAuthTokenAdmin
+        self.model_admin = UserAuthTokenAdmin(UserAuthToken, AdminSite())
+        self.request = RequestFactory().post("/")
+        self.request._messages = CookieStorage(self.request)
+        for username in ("a", "b", "c"):
+            UserAuthToken.objects.create(
+                user=User.objects.create_user(username=username),
+                encrypted_seed=encrypt_value("s33d"))
+
+    def test_disable_is_set_based(self):
+        # The users whose sessions are revoked, the update, then their
+        # revocations: updated, the missing ones looked up and inserted in
+        # a savepoint. None of it is per device.
+        with self.assertNumQueries(7):
+            self.model_admin.disable_tokens(
+                self.request, UserAuthToken.objects.all())
+        self.assertFalse(
+            UserAuthToken.objects.filter(is_active=True).exists())
+
+    def test_force_reenroll(self):
+        self.model_admin.force_reenroll(
+            self.request, UserAuthToken.objects.filter(user__username="a"))
+        self.assertEqual(2, UserAuthToken.objects.count())
+
+    def test_paginator_counts_small_tables(self):
+        from .adminsite import EstimatedCountPaginator
+        paginator = EstimatedCountPaginator(
+            UserAuthToken.objects.order_by("pk"), 2)
+        self.assertEqual(3, paginator.count)
+
+
+notified_chunks = []
+
+
+def collect_notifications(users):
+    notified_chunks.append([(user.username, len(tokens))
+                            for user, tokens in users])
+
+
+@override_settings(**TWOFACTOR_SETTINGS)
+class LowOnCodesTests(TestCase):
+    def setUp(self):
+        max_counter = get_config().hotp_max_counter
+        for username, token_type, counter in (
+                ("plenty", UserAuthToken.TYPE_HOTP, 10),
+                ("low", UserAuthToken.TYPE_HOTP, max_counter - 3),
+                ("lower", UserAuthToken.TYPE_HOTP, max_counter - 1),
+                ("phone", UserAuthToken.TYPE_TOTP, max_counter - 1)):
+            UserAuthToken.objects.create(
+                user=User.objects.create_user(username=username),
+                encrypted_seed=encrypt_value("s33d"),
+                type=token_type, counter=counter)
+
+    def test_low_on_codes(self):
+        self.assertEqual(
+            set(["low", "lower"]),
+            set(UserAuthToken.objects.low_on_codes(5)
+                .values_list("user__username", flat=True)))
+        self.assertEqual(
+            ["lower"],
+            list(UserAuthToken.objects.low_on_codes(1)
+                 .values_list("user__username", flat=True)))
+
+    def test_command_streams_chunks_to_notifier(self):
+        from django.core.management import call_command
+        del notified_chunks[:]
+        call_command(
+            "twofactor_notify_low_codes", chunk_size=1,
+            notifier="django_twofactor.tests.collect_notifications",
+            stderr=StringIO())
+        self.assertEqual([[("low", 1)], [("lower", 1)]], notified_chunks)
+
+    def test_command_notifies_each_user_once(self):
+        from django.core.management import call_command
+        UserAuthToken.objects.create(
+            user=User.objects.get(username="low"), name="spare card",
+            encrypted_seed=encrypt_value("s33d"),
+            type=UserAuthToken.TYPE_HOTP,
+            counter=get_config().hotp_max_counter - 2)
+        del notified_chunks[:]
+        call_command(
+            "twofactor_notify_low_codes", chunk_size=1,
+            notifier="django_twofactor.tests.collect_notifications",
+            stderr=StringIO())
+        self.assertEqual([[("low", 2)], [("lower", 1)]], notified_chunks)
+        out = StringIO()
+        call_command("twofactor_notify_low_codes", stdout=out)
+        self.assertEqual("low\t2\nlower\t1\n", out.getvalue())
+
+    def test_command_prints_without_notifier(self):
+        from django.core.management import call_command
+        out = StringIO()
+        call_command("twofactor_notify_low_codes", stdout=out)
+        self.assertEqual("low\t3\nlower\t1\n", out.getvalue())
+
+
+@override_settings(TWOFACTOR_GRIDCARD_POOL_SIZE=2, **TWOFACTOR_SETTINGS)
+class GridCardPoolTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_fill_and_claim(self):
+        from . import gridcard_pool
+        from .util import key_to_seed, get_hotp
+        self.assertEqual(2, gridcard_pool.fill_pool())
+        self.assertEqual(0, gridcard_pool.fill_pool())
+
+        first = gridcard_pool.claim()
+        second = gridcard_pool.claim()
+        self.assertNotEqual(first[0], second[0])
+        self.assertEqual(get_hotp(key_to_seed(first[0]), 0), first[1][0])
+        self.assertEqual(get_config().hotp_max_counter, len(first[1]))
+        self.assertEqual(None, gridcard_pool.claim())
+
+        self.assertEqual(2, gridcard_pool.fill_pool())
+
+
+class FakeClock(object):
+    now = 1400000000.0
+
+
+def fake_clock():
+    return FakeClock.now
+
+
+@override_settings(**dict(
+    TWOFACTOR_SETTINGS,
+    TWOFACTOR_CLOCK="django_twofactor.tests.fake_clock",
+    TWOFACTOR_TOTP_OPTIONS={"period": 30, "forward_drift": 1,
+                            "backward_drift": 1, "max_drift": 3}))
+class ClockDriftTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        FakeClock.now = 1400000000.0
+        self.user = User.objects.create_user(
+            username="user", password="secret")
+        self.auth_token = UserAuthToken.objects.create(
+            user=self.user, encrypted_seed=encrypt_value("s33d"),
+            type=UserAuthToken.TYPE_TOTP)
+        self.key = hexlify(force_bytes("s33d")).decode('ascii')
+
+    def _code(self, steps_ahead):
+        return totp(self.key, t=int(FakeClock.now) + 30 * steps_ahead)
+
+    def _check(self, steps_ahead):
+        auth_token = UserAuthToken.objects.get(pk=self.auth_token.pk)
+        return auth_token.check_auth_code(self._code(steps_ahead))
+
+    def test_drift_is_tracked(self):
+        self.assertTrue(self._check(1))
+        self.assertEqual(1, UserAuthToken.objects.get(
+            pk=self.auth_token.pk).time_drift)
+        # The device keeps drifting; the window follows it.
+        FakeClock.now += 60
+        self.assertTrue(self._check(2))
+        FakeClock.now += 60
+        self.assertTrue(self._check(3))
+        self.assertEqual({3: 1}, UserAuthToken.objects.drift_distribution())
+
+    def test_drift_is_bounded(self):
+        self.assertTrue(self._check(1))
+        FakeClock.now += 60
+        self.assertFalse(self._check(3))
+        FakeClock.now += 60
+        self.assertTrue(self._check(2))
+        FakeClock.now += 60
+        self.assertTrue(self._check(3))
+        FakeClock.now += 60
+        self.assertFalse(self._check(4))
+
+    def test_resynced_device(self):
+        self.assertTrue(self._check(1))
+        FakeClock.now += 60
+        self.assertTrue(self._check(0))
+
+    @override_settings(TWOFACTOR_TOTP_OPTIONS={
+        "period": 30, "forward_drift": 3, "backward_drift": 1})
+    def test_drift_is_bounded_each_way(self):
+        self.assertTrue(self._check(-1))
+        # The tracked drift reaches 2 steps back, but only 1 is allowed.
+        FakeClock.now += 60
+        self.assertFalse(self._check(-2))
+        FakeClock.now += 60
+        self.assertTrue(self._check(3))
+        FakeClock.now += 60
+        self.assertFalse(self._check(4))
+
+    def _count_hmacs(self, steps_ahead):
+        from . import util
+        accept_hotp, hotp = util.load_oath()
+        calls = []
+
+        def counting_hotp(*args):
+            calls.append(args[1])
+            return hotp(*args)
+        util._oath_functions = (accept_hotp, counting_hotp)
+        try:
+            self._check(steps_ahead)
+        finally:
+            util._oath_functions = (accept_hotp, hotp)
+        return calls
+
+    def test_tracked_drift_costs_one_hmac(self):
+        self.assertTrue(self._check(1))
+        FakeClock.now += 60
+        self.assertEqual(1, len(self._count_hmacs(1)))
+
+    def test_miss_tries_each_step_once(self):
+        self.assertTrue(self._check(1))
+        FakeClock.now += 60
+        steps = self._count_hmacs(-3)
+        # The window around the drift, then the one step it left out.
+        self.assertEqual(4, len(steps))
+        self.assertEqual(len(steps), len(set(steps)))
+
+    @override_settings(TWOFACTOR_TOTP_OPTIONS={
+        "period": 30, "forward_drift": 1, "backward_drift": 1,
+        "max_forward_drift": 0})
+    def test_window_is_bounded_without_drift(self):
+        self.assertFalse(self._check(1))
+        self.assertTrue(self._check(0))
+
+
+@override_settings(TWOFACTOR_READ_DATABASE="replica")
+class RouterTests(TestCase):
+    def setUp(self):
+        from .routers import TwoFactorRouter, unpin
+        unpin()
+        self.router = TwoFactorRouter()
+
+    def tearDown(self):
+        from .routers import unpin
+        unpin()
+
+    def test_reads_from_replica_until_written(self):
+        from .routers import unpin
+        self.assertEqual("replica", self.router.db_for_read(UserAuthToken))
+        self.assertEqual("default", self.router.db_for_write(UserAuthToken))
+        self.assertEqual("default", self.router.db_for_read(UserAuthToken))
+        unpin()
+        self.assertEqual("replica", self.router.db_for_read(UserAuthToken))
+
+    def test_other_models_are_left_alone(self):
+        self.assertEqual(None, self.router.db_for_read(User))
+        self.assertEqual(None, self.router.db_for_write(User))
+        self.assertEqual("replica", self.router.db_for_read(UserAuthToken))
+
+    def test_not_migrated_on_replica(self):
+        self.assertEqual(False, self.router.allow_migrate(
+            "replica", "django_twofactor", "userauthtoken"))
+        self.assertEqual(None, self.router.allow_migrate(
+            "default", "django_twofactor", "userauthtoken"))
+        self.assertEqual(None, self.router.allow_migrate("replica", "auth"))
+
+    @override_settings(**TWOFACTOR_SETTINGS)
+    def test_login_verifies_against_primary(self):
+        from .routers import is_pinned
+        User.objects.create_user(username="user", password="secret")
+        authenticate(username="user", password="secret")
+        self.assertTrue(is_pinned())
+
+    def test_pinning_scope(self):
+        from .routers import is_pinned, pin_primary, pinning_scope
+        pin_primary()
+        with pinning_scope():
+            self.assertFalse(is_pinned())
+            pin_primary()
+        self.assertFalse(is_pinned())
+
+
+@override_settings(TWOFACTOR_THROTTLE_USERNAME_COUNT=3,
+                   TWOFACTOR_THROTTLE_ACCOUNT_COUNT=4,
+                   TWOFACTOR_THROTTLE_IP_COUNT=5, **TWOFACTOR_SETTINGS)
+class ThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user(username="bouke", password="secret")
+
+    def _form(self, username, password, ip="10.0.0.1"):
+        from django.test.client import RequestFactory
+        request = RequestFactory().post("/", REMOTE_ADDR=ip)
+        return auth_forms.TwoFactorAuthenticationForm(request, data={
+            "username": username, "password": password, "token": ""})
+
+    def test_username_throttled_in_backend(self):
+        for i in range(3):
+            self.assertEqual(None, authenticate(username="bouke",
+                                                password="wrong"))
+        self.assertEqual(None, authenticate(username="bouke",
+                                            password="secret"))
+        self.assertEqual(None, authenticate(username="bouke",
+                                            password="secret"))
+
+    def test_success_is_not_counted(self):
+        for i in range(5):
+            self.assertNotEqual(None, authenticate(username="bouke",
+                                                   password="secret"))
+
+    def test_ip_throttled_in_form(self):
+        for i in range(5):
+            self.assertFalse(self._form("nobody%d" % i, "wrong").is_valid())
+        form = self._form("bouke", "secret")
+        self.assertFalse(form.is_valid())
+        self.assertIn(auth_forms.THROTTLED_MESSAGE,
+                      form.non_field_errors())
+        self.assertTrue(self._form("bouke", "secret", "10.0.0.2").is_valid())
+
+    def test_form_counts_address_once(self):
+        for i in range(4):
+            self.assertFalse(self._form("nobody%d" % i, "wrong").is_valid())
+        self.assertTrue(self._form("bouke", "secret").is_valid())
+
+    def test_account_throttled_across_addresses(self):
+        for i in range(4):
+            self.assertFalse(
+                self._form("bouke", "wrong", "10.0.1.%d" % i).is_valid())
+        form = self._form("bouke", "secret", "10.0.2.1")
+        self.assertFalse(form.is_valid())
+        self.assertIn(auth_forms.THROTTLED_MESSAGE,
+                      form.non_field_errors())
+
+    def test_username_throttled_per_address(self):
+        User.objects.filter(username="bouke").update(email="bouke@example.com")
+        # Logging in by email counts against the username.
+        for i in range(3):
+            self.assertFalse(
+                self._form("bouke@example.com", "wrong").is_valid())
+        form = self._form("bouke", "secret")
+        self.assertFalse(form.is_valid())
+        self.assertIn(auth_forms.THROTTLED_MESSAGE,
+                      form.non_field_errors())
+        # Nobody else is locked out.
+        self.assertTrue(self._form("bouke", "secret", "10.0.0.2").is_valid())
+
+
+@override_settings(**TWOFACTOR_SETTINGS)
+class TransferTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = self.workdir + "/tokens.jsonl.gz"
+        self.users = [User.objects.create_user(username="user%d" % i)
+                      for i in range(3)]
+        for i, user in enumerate(self.users):
+            UserAuthToken.objects.create(
+                user=user, type=UserAuthToken.TYPE_HOTP, counter=i,
+                encrypted_seed=encrypt_value("seed%d" % i))
+
+    def _export(self):
+        from django.core.management import call_command
+        call_command("twofactor_export", self.path, transport_key="k",
+                     chunk_size=2, stderr=StringIO())
+
+    def _import(self, **options):
+        from django.core.management import call_command
+        call_command("twofactor_import", self.path, transport_key="k",
+                     batch_size=2, stderr=StringIO(), **options)
+
+    def test_round_trip(self):
+        self._export()
+        UserAuthToken.objects.all().delete()
+        User.objects.filter(username="user2").delete()
+        with override_settings(TWOFACTOR_ENCRYPTION_KEY="other site"):
+            self._import()
+            tokens = UserAuthToken.objects.order_by("counter")
+            self.assertEqual([b"seed0", b"seed1"],
+                             [token.get_raw_seed() for token in tokens])
+        self.assertEqual([0, 1], [token.counter for token in tokens])
+
+    def test_existing_devices(self):
+        self._export()
+        UserAuthToken.objects.filter(user=self.users[0]).update(counter=50)
+        self._import()
+        self.assertEqual(3, UserAuthToken.objects.count())
+        self.assertEqual(50, UserAuthToken.objects.get(
+            user=self.users[0]).counter)
+        self._import(replace=True)
+        self.assertEqual(3, UserAuthToken.objects.count())
+        self.assertEqual(0, UserAuthToken.objects.get(
+            user=self.users[0]).counter)
+
+    def _rewrite(self, edit):
+        import gzip
+        with gzip.open(self.path, "rb") as f:
+            lines = f.read().decode("utf-8").splitlines()
+        with gzip.open(self.path, "wb") as f:
+            f.write("\n".join(edit(lines)).encode("utf-8"))
+
+    def _assert_rejected(self, **options):
+        from django.core.management.base import CommandError
+        UserAuthToken.objects.all().delete()
+        with self.assertRaises(CommandError):
+            self._import(**options)
+        self.assertEqual(0, UserAuthToken.objects.count())
+
+    def test_wrong_key(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        self._export()
+        UserAuthToken.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command("twofactor_import", self.path, transport_key="x",
+                         stderr=StringIO())
+        self.assertEqual(0, UserAuthToken.objects.count())
+
+    def test_altered_record(self):
+        self._export()
+        # The last device is in the second batch: the first one must not
+        # stay either.
+        self._rewrite(lambda lines: lines[:3] + [
+            lines[3].replace('"counter": 2', '"counter": 0')] + lines[4:])
+        self._assert_rejected()
+
+    def test_truncated(self):
+        self._export()
+        self._rewrite(lambda lines: lines[:-2])
+        self._assert_rejected()
+
+    def test_record_left_out(self):
+        self._export()
+        self._rewrite(lambda lines: lines[:2] + lines[3:])
+        self._assert_rejected()
+
+
+# For redirects in VerificationTests.
+urlpatterns = []
+
+
+@override_settings(ROOT_URLCONF=__name__, TWOFACTOR_VERIFY_URL="/login/",
+                   **TWOFACTOR_SETTINGS)
+class VerificationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="user", password="secret")
+        self.token = UserAuthToken.objects.create(
+            user=self.user,
+            type=UserAuthToken.TYPE_HOTP,
+            encrypted_seed=encrypt_value("a"),
+            counter=20)  # get_hotp("a", 20) = "022728"
+
+    def _request(self, session=None):
+        from django.contrib.sessions.backends.db import SessionStore
+        from django.test.client import RequestFactory
+        request = RequestFactory().get("/private/")
+        request.session = session if session is not None else SessionStore()
+        return request
+
+    def _login(self):
+        from django.contrib.auth import login
+        request = self._request()
+        user = authenticate(username="user", password="secret",
+                            token="022728")
+        login(request, user)
+        return request
+
+    def test_login_stamps_session(self):
+        from .decorators import twofactor_required
+        from .verification import get_verification
+        session = self._login().session
+        request = self._request(session)
+        with self.assertNumQueries(0):
+            verification = get_verification(request)
+        self.assertEqual(self.token.pk, verification["token_id"])
+
+        view = twofactor_required(lambda request: "ok")
+        self.assertEqual("ok", view(request))
+        self.assertEqual(302, view(self._request()).status_code)
+
+    def test_reset_revokes(self):
+        from .forms import ResetTwoFactorAuthForm
+        from .verification import is_verified
+        session = self._login().session
+        form = ResetTwoFactorAuthForm(self.user, {
+            "type": UserAuthToken.TYPE_TOTP, "reset_confirmation": "on"})
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertFalse(is_verified(self._request(session)))
+
+    def test_admin_disable_revokes(self):
+        from .adminsite import UserAuthTokenAdmin, twofactor_admin_site
+        from .verification import is_verified
+        session = self._login().session
+        admin = UserAuthTokenAdmin(UserAuthToken, twofactor_admin_site)
+        admin.message_user = lambda *args: None
+        admin.disable_tokens(None, UserAuthToken.objects.all())
+        self.assertFalse(is_verified(self._request(session)))
+
+    def test_revocation_survives_cache_loss(self):
+        from .verification import is_verified, revoke, stamp
+        session = self._login().session
+        revoke([self.user.pk])
+        cache.clear()
+        self.assertFalse(is_verified(self._request(session)))
+        # Verified again, then revoked again: the row is updated.
+        stamp(self._request(session), self.token)
+        self.assertTrue(is_verified(self._request(session)))
+        revoke([self.user.pk])
+        cache.clear()
+        self.assertFalse(is_verified(self._request(session)))
+
+    @override_settings(TWOFACTOR_REQUIRED_PATHS=["/private/"])
+    def test_middleware(self):
+        from .middleware import TwoFactorMiddleware
+        middleware = TwoFactorMiddleware(lambda request: None)
+        self.assertEqual(
+            302, middleware.process_request(self._request()).status_code)
+        session = self._login().session
+        self.assertEqual(
+            None, middleware.process_request(self._request(session)))
+
+
+@override_settings(TWOFACTOR_GRANT_TTL=300,
+                   TWOFACTOR_CLOCK="django_twofactor.tests.fake_clock",
+                   **TWOFACTOR_SETTINGS)
+class StepUpGrantTests(TestCase):
+    def setUp(self):
+        from django import forms
+        from django.contrib.sessions.backends.db import SessionStore
+        from django.test.client import RequestFactory
+        from .forms import TwoFactorMixin
+
+        class ConfirmForm(TwoFactorMixin, forms.Form):
+            def __init__(self, user, request=None, scope=None, data=None):
+                forms.Form.__init__(self, data)
+                TwoFactorMixin.__init__(self, user, request, scope)
+
+        cache.clear()
+        FakeClock.now = 1400000000.0
+        self.form_class = ConfirmForm
+        self.user = User.objects.create_user(username="user")
+        self.token = UserAuthToken.objects.create(
+            user=self.user,
+            type=UserAuthToken.TYPE_HOTP,
+            encrypted_seed=encrypt_value("a"),
+            counter=20)  # get_hotp("a", 20) = "022728"
+        self.request = RequestFactory().post("/")
+        self.request.session = SessionStore()
+
+    def _verify(self):
+        form = self.form_class(self.user, self.request,
+                               data={"token": "022728"})
+        self.assertTrue(form.is_valid(), form.errors)
+
+    def test_grant_skips_verification(self):
+        self._verify()
+        with self.assertNumQueries(0):
+            form = self.form_class(self.user, self.request, data={})
+            self.assertTrue(form.twofactor_granted)
+            self.assertTrue(form.is_valid())
+        self.assertNotIn("token", form.fields)
+
+    def test_grant_is_scoped(self):
+        self._verify()
+        form = self.form_class(self.user, self.request, scope="payout",
+                               data={})
+        self.assertFalse(form.twofactor_granted)
+        self.assertFalse(form.is_valid())
+
+    def test_grant_expires(self):
+        from .grants import has_grant
+        self._verify()
+        FakeClock.now += 299
+        self.assertTrue(has_grant(self.request, self.user))
+        FakeClock.now += 1
+        self.assertFalse(has_grant(self.request, self.user))
+
+    def test_grant_is_revoked_by_reset(self):
+        from .grants import has_grant
+        self._verify()
+        FakeClock.now += 1
+        self.token.reset_seed()
+        self.token.save()
+        self.assertFalse(has_grant(self.request, self.user))
+
+    def test_no_grant_for_invalid_form(self):
+        from django import forms
+        from .grants import has_grant
+
+        class ConfirmAmountForm(self.form_class):
+            amount = forms.IntegerField()
+
+        form = ConfirmAmountForm(self.user, self.request,
+                                 data={"token": "022728", "amount": "x"})
+        self.assertFalse(form.is_valid())
+        self.assertIsNotNone(form.matched_auth_token)
+        self.assertFalse(has_grant(self.request, self.user))
+
+    def test_issue_grant(self):
+        from django import forms
+        from .forms import TwoFactorMixin
+        from .grants import has_grant
+
+        class FormFirst(forms.Form, TwoFactorMixin):
+            def __init__(self, user, request, data):
+                forms.Form.__init__(self, data)
+                TwoFactorMixin.__init__(self, user, request)
+
+        form = FormFirst(self.user, self.request, data={"token": "022728"})
+        self.assertTrue(form.is_valid())
+        self.assertFalse(has_grant(self.request, self.user))
+        form.issue_grant()
+        self.assertTrue(has_grant(self.request, self.user))
+
+
+@override_settings(**TWOFACTOR_SETTINGS)
+class RequestTokensTests(TestCase):
+    def setUp(self):
+        from django.test.client import RequestFactory
+        self.user = User.objects.create_user(username="user")
+        UserAuthToken.objects.create(
+            user=self.user, encrypted_seed=encrypt_value("s33d"))
+        UserAuthToken.objects.create(
+            user=self.user, name="paper", type=UserAuthToken.TYPE_HOTP,
+            encrypted_seed=encrypt_value("s33d"), is_active=False)
+        self.request = RequestFactory().get("/")
+        self.request.user = User.objects.get(pk=self.user.pk)
+
+    def test_forms_share_one_query(self):
+        from .forms import GridCardReactivationForm, ResetTwoFactorAuthForm
+        from .middleware import TwoFactorMiddleware
+        TwoFactorMiddleware(lambda request: None).process_request(
+            self.request)
+        with self.assertNumQueries(1):
+            tokens = self.request.twofactor_tokens
+            reset = ResetTwoFactorAuthForm(self.user, tokens=tokens,
+                                           name="paper")
+            reactivate = GridCardReactivationForm(self.user,
+                                                  request=self.request)
+            self.assertEqual(2, len(tokens))
+        self.assertEqual(UserAuthToken.TYPE_HOTP,
+                         reset.fields["type"].initial)
+        self.assertEqual([tokens[0]], reactivate.user_auth_tokens)
+
+    def test_anonymous(self):
+        from django.contrib.auth.models import AnonymousUser
+        from .middleware import get_user_tokens
+        self.request.user = AnonymousUser()
+        with self.assertNumQueries(0):
+            self.assertEqual([], get_user_tokens(self.request))
+
+
+class PyAesTests(TestCase):
+    # FIPS-197, appendix C
+    PLAINTEXT = "00112233445566778899aabbccddeeff"
+    VECTORS = [
+        ("000102030405060708090a0b0c0d0e0f",
+         "69c4e0d86a7b0430d8cdb78070b4c55a"),
+        ("000102030405060708090a0b0c0d0e0f1011121314151617",
+         "dda97ca4864cdfe06eaf70a0ec0d7191"),
+        ("000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f",
+         "8ea2b7ca516745bfeafc49904b496089"),
+    ]
+
+    def test_fips_197_vectors(self):
+        from binascii import unhexlify
+        from . import pyaes
+        for key, ciphertext in self.VECTORS:
+            cipher = pyaes.new(unhexlify(key), pyaes.MODE_ECB)
+            self.assertEqual(ciphertext, hexlify(
+                cipher.encrypt(unhexlify(self.PLAINTEXT))).decode("ascii"))
+            # Several blocks per call
+            self.assertEqual(
+                unhexlify(self.PLAINTEXT) * 3,
+                cipher.decrypt(unhexlify(ciphertext) * 3))
+
+    def test_decrypts_stored_seeds(self):
+        from . import encutil, pyaes
+        from .util import decrypt_value
+        encrypted = encrypt_value("12345678901234567890")
+        aes, encutil._AES = encutil._AES, pyaes
+        try:
+            self.assertEqual(b"12345678901234567890",
+                             decrypt_value(encrypted))
+        finally:
+            encutil._AES = aes
+
+
+@override_settings(TWOFACTOR_CLOCK="django_twofactor.tests.fake_clock",
+                   **TWOFACTOR_SETTINGS)
+class SharedMemoryStoreTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        self.path = workdir + "/gates"
+        FakeClock.now = 1400000000.0
+
+    def _store(self, **options):
+        from .stores import SharedMemoryStore
+        store = SharedMemoryStore(self.path, slots=64, stripes=4, **options)
+        self.addCleanup(store.close)
+        return store
+
+    def test_add_and_expire(self):
+        store, other = self._store(), self._store()
+        self.assertTrue(store.add("lock", 10))
+        self.assertFalse(other.add("lock", 10))
+        FakeClock.now += 10
+        self.assertTrue(other.add("lock", 10))
+
+    def test_incr(self):
+        store = self._store()
+        self.assertEqual([1, 2, 3], [store.incr("count", 10)
+                                     for i in range(3)])
+        self.assertEqual(1, store.incr("other", 10))
+        FakeClock.now += 10
+        self.assertEqual(1, store.incr("count", 10))
+
+    def test_fixed_size(self):
+        import os
+        store = self._store(probes=1)
+        keys = ["key%d" % i for i in range(200)]
+        for i, key in enumerate(keys):
+            store.add(key, 100 + i)
+        # Older keys make room; the newest is still held.
+        self.assertFalse(store.add(keys[-1], 10))
+        self.assertEqual(64 * store.SLOT.size, os.path.getsize(self.path))
+
+    def test_hotp_ratelimit(self):
+        from .util import get_hotp
+        user = User.objects.create_user(username="user")
+        token = UserAuthToken.objects.create(
+            user=user, type=UserAuthToken.TYPE_HOTP,
+            encrypted_seed=encrypt_value("a"))
+        with override_settings(
+                TWOFACTOR_GATE_STORE="django_twofactor.stores.SharedMemoryStore",
+                TWOFACTOR_GATE_STORE_OPTIONS={"path": self.path},
+                HOTP_RATELIMIT_COUNT=3):
+            for code in ("000001", "000002", "000003"):
+                self.assertFalse(token.check_auth_code(code))
+            self.assertFalse(token.check_auth_code(get_hotp("a", 0)))
+            FakeClock.now += 3600
+            self.assertTrue(token.check_auth_code(get_hotp("a", 0)))
+
+
+class BrokenStore(object):
+    """ A gate store whose backend is down, or only slow with `delay`. """
+    calls = 0
+    delay = None
+
+    def add(self, key, ttl):
+        BrokenStore.calls += 1
+        if self.delay is None:
+            raise IOError("cache is down")
+        FakeClock.now += self.delay
+        return True
+
+    incr = add
+
+    def get_many(self, keys):
+        self.add(None, None)
+        return {}
+
+
+class BrokenCache(object):
+    """ A cache backend whose server is down. """
+
+    def __init__(self, location, params):
+        pass
+
+    def __getattr__(self, name):
+        def broken(*args, **kwargs):
+            raise ConnectionError("cache is down")
+        return broken
+
+
+@override_settings(TWOFACTOR_CLOCK="django_twofactor.tests.fake_clock",
+                   TWOFACTOR_GATE_STORE="django_twofactor.tests.BrokenStore",
+                   TWOFACTOR_GATE_FAILURES=3,
+                   TWOFACTOR_GATE_RESET=30,
+                   **TWOFACTOR_SETTINGS)
+class GateCircuitBreakerTests(TestCase):
+    def setUp(self):
+        from . import stores
+        # A fresh breaker for each test.
+        stores._store = None
+        FakeClock.now = 1400000000.0
+        BrokenStore.calls = 0
+        BrokenStore.delay = None
+        self.user = User.objects.create_user(username="user")
+        self.token = UserAuthToken.objects.create(
+            user=self.user, type=UserAuthToken.TYPE_HOTP,
+            encrypted_seed=encrypt_value("a"))
+
+    def test_logins_survive_outage(self):
+        from .stores import gate_status
+        from .util import get_hotp
+        self.assertTrue(self.token.check_auth_code(get_hotp("a", 0)))
+        self.assertTrue(self.token.check_auth_code(get_hotp("a", 1)))
+        status = gate_status()
+        self.assertEqual("open", status["state"])
+        self.assertEqual(3, status["errors"])
+        self.assertEqual(1, status["opened"])
+        # Open: the store isn't called any more.
+        self.assertEqual(3, BrokenStore.calls)
+
+    @override_settings(
+        TWOFACTOR_GATE_STORE="django_twofactor.stores.CacheStore",
+        CACHES={"default": {
+            "BACKEND": "django_twofactor.tests.BrokenCache"}})
+    def test_throttled_logins_survive_cache_outage(self):
+        from .util import get_hotp
+        self.user.set_password("secret")
+        self.user.save()
+        for i in range(2):
+            self.assertEqual(self.user, authenticate(
+                username="user", password="secret",
+                token=get_hotp("a", i)))
+        self.assertEqual(None, authenticate(
+            username="user", password="wrong", token=get_hotp("a", 2)))
+
+    def test_fallback_keeps_limits(self):
+        from .models import auth_code_lock
+        self.assertTrue(auth_code_lock("totp", "123456", "user"))
+        self.assertFalse(auth_code_lock("totp", "123456", "user"))
+        with override_settings(HOTP_RATELIMIT_COUNT=2):
+            for code in ("000001", "000002"):
+                self.assertFalse(self.token.check_auth_code(code))
+            from .util import get_hotp
+            self.assertFalse(self.token.check_auth_code(get_hotp("a", 0)))
+
+    def test_slow_store_opens(self):
+        from .models import auth_code_lock
+        from .stores import GuardedStore, gate_status
+        self.addCleanup(setattr, GuardedStore, "timer",
+                        GuardedStore.__dict__["timer"])
+        GuardedStore.timer = staticmethod(fake_clock)
+        BrokenStore.delay = 1
+        for code in ("1", "2", "3", "4"):
+            self.assertTrue(auth_code_lock("totp", code, "user"))
+        status = gate_status()
+        self.assertEqual(("open", 3, 0), (status["state"],
+                                          status["slow_calls"],
+                                          status["errors"]))
+        self.assertEqual(3, BrokenStore.calls)
+
+    def test_half_open_trial(self):
+        from .models import auth_code_lock
+        from .stores import gate_status
+        for code in ("1", "2", "3"):
+            auth_code_lock("totp", code, "user")
+        FakeClock.now += 30
+        auth_code_lock("totp", "4", "user")
+        self.assertEqual(("open", 2), (gate_status()["state"],
+                                       gate_status()["opened"]))
+        FakeClock.now += 30
+        BrokenStore.delay = 0
+        auth_code_lock("totp", "5", "user")
+        self.assertEqual("closed", gate_status()["state"])
+        self.assertEqual(5, BrokenStore.calls)
+
+    def test_local_store_is_bounded(self):
+        from .stores import LocalStore
+        store = LocalStore(max_keys=3)
+        for i in range(5):
+            self.assertTrue(store.add("key%d" % i, 10 + i))
+        self.assertEqual(3, len(store._keys))
+        self.assertFalse(store.add("key4", 10))
+        self.assertTrue(store.add("key0", 10))
+
+    @override_settings(TWOFACTOR_GATE_FAILURES=0)
+    def test_disabled(self):
+        from .models import auth_code_lock
+        from .stores import gate_status
+        with self.assertRaises(IOError):
+            auth_code_lock("totp", "123456", "user")
+        self.assertIsNone(gate_status())
+
+
+class InterleavingStore(object):
+    """
+    A local gate store that runs `during` (once) while holding the first
+    lock, i.e. while a verification is in flight.
+    """
+    during = None
+
+    def __init__(self):
+        from .stores import LocalStore
+        self.store = LocalStore()
+
+    def add(self, key, ttl):
+        during, InterleavingStore.during = InterleavingStore.during, None
+        if during is not None:
+            during()
+        return self.store.add(key, ttl)
+
+    def incr(self, key, ttl):
+        return self.store.incr(key, ttl)
+
+    def get_many(self, keys):
+        return self.store.get_many(keys)
+
+
+@override_settings(
+    TWOFACTOR_GATE_STORE="django_twofactor.tests.InterleavingStore",
+    **TWOFACTOR_SETTINGS)
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        from . import stores
+        # A fresh store, without the locks of other tests.
+        stores._store = None
+
+    def test_shares_result_and_error(self):
+        import threading
+        from .util import SingleFlight
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "result"
+
+        leader = threading.Thread(
+            target=lambda: results.append(flight.do("key", slow)))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(
+            target=lambda: results.append(flight.do("key", slow)))
+        follower.start()
+        follower.join(0.05)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual(sorted([("result", False), ("result", True)]),
+                         sorted(results))
+        # Done calls are forgotten.
+        self.assertEqual(("result", False), flight.do("key", lambda: "result"))
+        with self.assertRaises(ValueError):
+            flight.do("key", lambda: int("x"))
+
+    def _tokens(self):
+        from .util import get_hotp
+        user = User.objects.create_user(username="user")
+        UserAuthToken.objects.create(
+            user=user, type=UserAuthToken.TYPE_HOTP,
+            encrypted_seed=encrypt_value("a"))
+        # Two requests, each with its own instances.
+        return (list(UserAuthToken.objects.all()),
+                list(UserAuthToken.objects.all()), get_hotp("a", 0))
+
+    def test_double_submit(self):
+        import threading
+        first, second, code = self._tokens()
+        results = []
+
+        def submit_again():
+            thread = threading.Thread(target=lambda: results.append(
+                UserAuthToken.objects.match_auth_code(second, code, "s1")))
+            thread.start()
+            # It waits for this verification to finish.
+            thread.join(0.05)
+            self.assertTrue(thread.is_alive())
+            self.threads.append(thread)
+
+        self.threads = []
+        InterleavingStore.during = submit_again
+        self.assertEqual(first[0], UserAuthToken.objects.match_auth_code(
+            first, code, "s1"))
+        self.threads[0].join()
+        self.assertIs(second[0], results[0])
+        self.assertEqual(1, second[0].counter)
+        # Later attempts don't share anything.
+        self.assertIsNone(
+            UserAuthToken.objects.match_auth_code(second, code, "s1"))
+
+    def test_other_callers_dont_share(self):
+        first, second, code = self._tokens()
+        results = []
+        # A relayed code, tried while the user's own attempt is in flight,
+        # runs on its own: only one of them gets in.
+        InterleavingStore.during = lambda: results.append(
+            UserAuthToken.objects.match_auth_code(second, code, "attacker"))
+        self.assertIsNone(UserAuthToken.objects.match_auth_code(
+            first, code, "victim"))
+        self.assertEqual([second[0]], results)
+        InterleavingStore.during = lambda: results.append(
+            UserAuthToken.objects.match_auth_code(second, code))
+        self.assertIsNone(UserAuthToken.objects.match_auth_code(first, code))
+        self.assertEqual([second[0], None], results)
+
+
+@override_settings(
+    TWOFACTOR_GATE_STORE="django_twofactor.tests.InterleavingStore",
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    **TWOFACTOR_SETTINGS)
+class SessionlessSingleFlightTests(TransactionTestCase):
+    """ Logins in two threads, which need committed rows to see. """
+
+    def setUp(self):
+        from . import stores
+        from .util import get_hotp
+        stores._store = None
+        user = User.objects.create_user(username="user", password="secret")
+        UserAuthToken.objects.create(
+            user=user, type=UserAuthToken.TYPE_HOTP,
+            encrypted_seed=encrypt_value("a"))
+        self.code = get_hotp("a", 0)
+
+    def _login(self, csrf_token="c" * 32):
+        from django.test.client import RequestFactory
+        # A login page: no session yet, only the CSRF cookie.
+        factory = RequestFactory()
+        factory.cookies["csrftoken"] = csrf_token
+        return authenticate(request=factory.post("/"), username="user",
+                            password="secret", token=self.code)
+
+    def _login_during(self, csrf_token):
+        import threading
+        results, threads = [], []
+
+        def submit_again():
+            thread = threading.Thread(
+                target=lambda: results.append(self._login(csrf_token)))
+            thread.start()
+            # Enough to get to the verification in flight and wait there.
+            thread.join(0.5)
+            threads.append(thread)
+
+        InterleavingStore.during = submit_again
+        first = self._login()
+        threads[0].join()
+        return first, results[0]
+
+    def test_double_submit(self):
+        first, second = self._login_during("c" * 32)
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertEqual(1, UserAuthToken.objects.get().counter)
+
+    def test_other_clients_dont_share(self):
+        # Another browser relaying the code: only one of them gets in.
+        logins = self._login_during("d" * 32)
+        self.assertEqual(1, len([user for user in logins if user]))
+
+
+@override_settings(TWOFACTOR_CLOCK="django_twofactor.tests.fake_clock",
+                   TWOFACTOR_OFFLOAD_WORKERS=1,
+                   TWOFACTOR_OFFLOAD_BATCH_SIZE=4,
+                   **TWOFACTOR_SETTINGS)
+class OffloadTests(TestCase):
+    def setUp(self):
+        from . import offload
+        cache.clear()
+        FakeClock.now = 1400000000.0
+        self.pool = offload.get_pool()
+        self.addCleanup(self.pool.shutdown)
+        self.addCleanup(setattr, offload, "_pool", None)
+        self.user = User.objects.create_user(username="user")
+
+    def test_check_auth_code(self):
+        from .util import get_hotp
+        hotp = UserAuthToken.objects.create(
+            user=self.user, name="hotp", type=UserAuthToken.TYPE_HOTP,
+            encrypted_seed=encrypt_value("a"))
+        totp_device = UserAuthToken.objects.create(
+            user=self.user, name="totp", encrypted_seed=encrypt_value("b"))
+        self.assertFalse(hotp.check_auth_code(get_hotp("a", 1)))
+        self.assertTrue(hotp.check_auth_code(get_hotp("a", 0)))
+        code = totp(hexlify(b"b").decode("ascii"), t=int(FakeClock.now))
+        self.assertTrue(totp_device.check_auth_code(code))
+        # Nothing was decrypted here.
+        self.assertFalse(hasattr(hotp, "_raw_seed"))
+        self.assertFalse(hasattr(totp_device, "_raw_seed"))
+
+    def test_batches_and_errors(self):
+        from .util import get_hotp
+        encrypted = encrypt_value("a")
+        futures = [self.pool.submit("hotp", encrypted, get_hotp("a", i % 3), 0)
+                   for i in range(10)]
+        broken = self.pool.submit("hotp", "no-salt", "123456", 0)
+        self.assertEqual([True, False, False] * 3 + [True],
+                         [future.result() for future in futures])
+        with self.assertRaises(ValueError):
+            broken.result()
+
+    def test_timeout_fails_the_check(self):
+        from .util import get_hotp
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        hotp = UserAuthToken.objects.create(
+            user=self.user, type=UserAuthToken.TYPE_HOTP,
+            encrypted_seed=encrypt_value("a"))
+        # Jobs queued here never reach the dispatcher.
+        dispatched = self.pool._queue
+        self.pool._queue = queue.Queue()
+        self.addCleanup(setattr, self.pool, "_queue", dispatched)
+        self.pool.timeout = 0.05
+        self.assertFalse(hotp.check_auth_code(get_hotp("a", 0)))
+        self.assertEqual(0, UserAuthToken.objects.get(pk=hotp.pk).counter)
+        job, future = self.pool._queue.get_nowait()
+        self.assertTrue(future.cancelled())
+
+    def test_jobs_after_shutdown_run_here(self):
+        from .util import get_hotp
+        future = self.pool.submit("hotp", encrypt_value("a"),
+                                  get_hotp("a", 0), 0)
+        self.pool.shutdown(wait=False)
+        self.assertTrue(future.result())
+        self.assertTrue(self.pool.run("hotp", encrypt_value("a"),
+                                      get_hotp("a", 0), 0))
+
+    @override_settings(TWOFACTOR_OFFLOAD_WORKERS=0)
+    def test_off(self):
+        from .offload import get_pool
+        self.assertIsNone(get_pool())
+
+
+@override_settings(TWOFACTOR_LAST_USED_INTERVAL=60, **TWOFACTOR_SETTINGS)
+class LastUsedTests(TestCase):
+    def setUp(self):
+        from . import usage
+        usage.flush()
+        usage._last_flush[0] = None
+        cache.clear()
+        user = User.objects.create_user(username="user")
+        self.tokens = [
+            UserAuthToken.objects.create(
+                user=user, name=name, type=UserAuthToken.TYPE_HOTP,
+                encrypted_seed=encrypt_value(name))
+            for name in ("a", "b")]
+
+    def _last_used(self):
+        return [token.last_used for token in
+                UserAuthToken.objects.order_by("name")]
+
+    def test_writes_are_batched(self):
+        from . import usage
+        from .util import get_hotp
+        a, b = self.tokens
+        self.assertTrue(a.check_auth_code(get_hotp("a", 0)))
+        self.assertTrue(b.check_auth_code(get_hotp("b", 0)))
+        self.assertTrue(a.check_auth_code(get_hotp("a", 1)))
+        self.assertEqual([None, None], self._last_used())
+
+        usage._last_flush[0] -= 60
+        with self.assertNumQueries(3):  # The update, in a savepoint.
+            usage.record(b)
+        first, second = self._last_used()
+        self.assertTrue(first is not None and second is not None)
+        self.assertTrue(first <= second)
+
+    def test_failed_flush_is_kept(self):
+        from django.db import DatabaseError
+        from . import usage
+        a, b = self.tokens
+
+        def broken(*args, **kwargs):
+            raise DatabaseError("down")
+        UserAuthToken.objects.filter = broken
+        try:
+            usage.record(a)
+            self.assertEqual(0, usage.flush())
+        finally:
+            del UserAuthToken.objects.filter
+        self.assertEqual(1, usage.flush())
+        self.assertIsNotNone(self._last_used()[0])
+
+    def test_later_time_is_kept(self):
+        import datetime
+        from django.utils import timezone
+        from . import usage
+        a, b = self.tokens
+        later = timezone.now() + datetime.timedelta(days=1)
+        UserAuthToken.objects.filter(pk=a.pk).update(last_used=later)
+        usage.record(a)
+        usage.record(b)
+        self.assertEqual(2, usage.flush())
+        first, second = self._last_used()
+        self.assertEqual(later, first)
+        self.assertTrue(second < later)
+
+    @override_settings(TWOFACTOR_LAST_USED_INTERVAL=0)
+    def test_off(self):
+        from . import usage
+        from .util import get_hotp
+        self.assertTrue(self.tokens[0].check_auth_code(get_hotp("a", 0)))
+        self.assertEqual(0, usage.flush())
+
+    def test_unused_for(self):
+        import datetime
+        from django.utils import timezone
+        a, b = self.tokens
+        now = timezone.now()
+        UserAuthToken.objects.filter(pk=a.pk).update(
+            last_used=now - datetime.timedelta(days=40))
+        self.assertEqual([a], list(UserAuthToken.objects.unused_for(30)))
+        UserAuthToken.objects.filter(pk=b.pk).update(
+            created_datetime=now - datetime.timedelta(days=40))
+        self.assertEqual(2, UserAuthToken.objects.unused_for(30).count())
+        self.assertEqual(0, UserAuthToken.objects.unused_for(50).count())
+
+
+@override_settings(TWOFACTOR_DASHBOARD_TTL=60, HOTP_MAX_COUNTER=100,
+                   **TWOFACTOR_SETTINGS)
+class DashboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # user0 has both kinds of device.
+        for i, (token_type, counter) in enumerate([
+                (UserAuthToken.TYPE_TOTP, 0), (UserAuthToken.TYPE_TOTP, 0),
+                (UserAuthToken.TYPE_HOTP, 97), (UserAuthToken.TYPE_HOTP, 10)]):
+            user = User.objects.get_or_create(username="user%d" % (i % 3))[0]
+            UserAuthToken.objects.create(
+                user=user, name=str(i), type=token_type, counter=counter,
+                encrypted_seed=encrypt_value("a"))
+
+    def test_compute_stats(self):
+        from .dashboard import compute_stats
+        with self.assertNumQueries(2):
+            stats = compute_stats()
+        self.assertEqual((3, 1), (stats["users"], stats["users_both"]))
+        self.assertEqual(
+            [(UserAuthToken.TYPE_TOTP, 2, 2, 2),
+             (UserAuthToken.TYPE_HOTP, 2, 2, 2)],
+            [(row["type"], row["devices"], row["users"], row["enrolled_week"])
+             for row in stats["types"]])
+        self.assertEqual([("0-5", 1), ("6-25", 0), ("26-50", 0), ("51+", 1)],
+                         stats["codes_left"])
+
+    def test_cached_and_refreshed(self):
+        import datetime
+        from .dashboard import CACHE_KEY, get_stats
+        stats = get_stats(background=False)
+        UserAuthToken.objects.filter(type=UserAuthToken.TYPE_HOTP).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(stats, get_stats(background=False))
+
+        # Stale figures are served once more, while they are refreshed.
+        stats["computed"] -= datetime.timedelta(seconds=60)
+        cache.set(CACHE_KEY, stats)
+        self.assertEqual(2, len(get_stats(background=False)["types"]))
+        self.assertEqual(1, len(get_stats(background=False)["types"]))
+
+
+shadow_events = []
+
+
+def shadow_sink(event):
+    shadow_events.append(event)
+
+
+class CandidateEngine(object):
+    """
+    Agrees on TOTP, is off by one on HOTP, slow with `delay`, broken with
+    `fail` and held up on HOTP until `release` is set, if it is an event.
+    """
+    delay = 0
+    fail = False
+    release = None
+    running = None
+
+    def match_totp_step(self, raw_seed, auth_code, token_type, t, drift):
+        from .util import _match_totp_step
+        FakeClock.now += self.delay
+        return _match_totp_step(raw_seed, auth_code, token_type, t, drift)
+
+    def check_hotp(self, raw_seed, auth_code, counter, token_type):
+        from .util import _check_hotp
+        FakeClock.now += self.delay
+        if self.release is not None:
+            self.running.set()
+            self.release.wait()
+        if self.fail:
+            raise ValueError("broken")
+        return _check_hotp(raw_seed, auth_code, counter + 1, token_type)
+
+
+@override_settings(
+    TWOFACTOR_CLOCK="django_twofactor.tests.fake_clock",
+    TWOFACTOR_SHADOW_ENGINE="django_twofactor.tests.CandidateEngine",
+    TWOFACTOR_SHADOW_SINK="django_twofactor.tests.shadow_sink",
+    TWOFACTOR_SHADOW_SAMPLE_RATE=1,
+    TWOFACTOR_SHADOW_MAX_OVERHEAD=0.1,
+    **TWOFACTOR_SETTINGS)
+class ShadowTests(TestCase):
+    def setUp(self):
+        from . import shadow
+        shadow._shadow = None
+        FakeClock.now = 1400000000.0
+        CandidateEngine.delay = 0
+        CandidateEngine.fail = False
+        CandidateEngine.release = None
+        del shadow_events[:]
+
+    def _wait(self):
+        from .shadow import get_shadow
+        get_shadow().wait()
+
+    def test_records_disagreements(self):
+        from .util import check_hotp, get_hotp, match_totp_step
+        code = totp(hexlify(b"a").decode("ascii"), t=int(FakeClock.now))
+        self.assertIsNotNone(match_totp_step("a", code))
+        # The candidate would accept the next code, the primary decides.
+        self.assertFalse(check_hotp("a", get_hotp("a", 1), 0))
+        self._wait()
+        self.assertEqual(
+            [("totp", True, None), ("hotp", False, None)],
+            [(e["kind"], e["agree"], e["error"]) for e in shadow_events])
+        self.assertEqual((False, True), (shadow_events[1]["primary"],
+                                         shadow_events[1]["candidate"]))
+
+    def test_candidate_errors_are_contained(self):
+        from .util import check_hotp, get_hotp
+        CandidateEngine.fail = True
+        self.assertTrue(check_hotp("a", get_hotp("a", 0), 0))
+        self._wait()
+        self.assertEqual("ValueError: broken", shadow_events[-1]["error"])
+        self.assertFalse(shadow_events[-1]["agree"])
+
+    def test_overhead_is_capped(self):
+        from .shadow import Shadow, get_shadow
+        from .util import check_hotp
+        self.addCleanup(setattr, Shadow, "timer", Shadow.__dict__["timer"])
+        Shadow.timer = staticmethod(fake_clock)
+        CandidateEngine.delay = 1
+        for i in range(3):
+            check_hotp("a", "123456", 0)
+            self._wait()
+        # A one second candidate run uses up the budget for ten seconds.
+        self.assertEqual(1, len(shadow_events))
+        self.assertEqual(2, get_shadow().skipped)
+        FakeClock.now += 10
+        check_hotp("a", "123456", 0)
+        self._wait()
+        self.assertEqual(2, len(shadow_events))
+
+    def test_runs_off_the_request_thread(self):
+        import threading
+        from .shadow import get_shadow
+        from .util import check_hotp
+        shadow = get_shadow()
+        shadow.queue_size = 1
+        CandidateEngine.release = threading.Event()
+        CandidateEngine.running = threading.Event()
+        self.assertFalse(check_hotp("a", "123456", 0))
+        CandidateEngine.running.wait()
+        # The check returned with the candidate still running. One more
+        # sample can wait in the queue, the next is dropped.
+        check_hotp("a", "123456", 0)
+        check_hotp("a", "123456", 0)
+        self.assertEqual(1, shadow.dropped)
+        CandidateEngine.release.set()
+        shadow.wait()
+        self.assertEqual(2, len(shadow_events))
+
+
+@override_settings(HOTP_MAX_COUNTER=20, **TWOFACTOR_SETTINGS)
+class FindCodesTests(TestCase):
+    def setUp(self):
+        self.tokens = []
+        for i, seed in enumerate(("a", "b", "c")):
+            user = User.objects.create_user(username="user%d" % i)
+            self.tokens.append(UserAuthToken.objects.create(
+                user=user, type=UserAuthToken.TYPE_HOTP, counter=5,
+                encrypted_seed=encrypt_value(seed)))
+        # TOTP devices are not scanned.
+        UserAuthToken.objects.create(
+            user=user, name="totp", encrypted_seed=encrypt_value("a"))
+
+    def test_find_codes(self):
+        from .forensics import find_codes
+        from .util import get_hotp
+        a, b, c = self.tokens
+        codes = [get_hotp("a", 5), get_hotp("b", 7), get_hotp("c", 2)]
+        for workers in (0, 1):
+            self.assertEqual(
+                [(a.pk, a.user_id, 5, codes[0])],
+                list(find_codes(codes, workers=workers, chunk_size=2)))
+        self.assertEqual(
+            [a.pk, b.pk],
+            [m[0] for m in find_codes(codes, window=3, workers=0)])
+        self.assertEqual(
+            [a.pk, b.pk, c.pk],
+            [m[0] for m in find_codes(codes, window=None, workers=0)])
+
+    def test_command(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from .util import get_hotp
+        a = self.tokens[0]
+        out, err = StringIO(), StringIO()
+        call_command("twofactor_find_codes", get_hotp("a", 5), "000000",
+                     workers=0, stdout=out, stderr=err)
+        self.assertEqual("%d\t%d\t5\t%s\n" % (a.pk, a.user_id,
+                                               get_hotp("a", 5)),
+                         out.getvalue())
+        self.assertIn("scanned 3 devices", err.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("twofactor_find_codes", "12345", workers=0)
+        for window in (0, -1):
+            with self.assertRaises(CommandError):
+                call_command("twofactor_find_codes", get_hotp("a", 5),
+                             window=window, workers=0)
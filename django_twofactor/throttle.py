@@ -0,0 +1,80 @@
+"""
+Login throttle that runs before anything expensive.
+
+Failed logins are counted per username and client address pair, per
+username across all addresses, and per client address, in fixed time
+windows of `TWOFACTOR_THROTTLE_TIMEFRAME` seconds. Failures from one
+address thus never lock the account for anyone else, while the higher
+per-account limit still stops a guessing run spread over many addresses.
+Without a request the username and address pair is the username. Each
+counter is a single integer in the gate store (see
+`django_twofactor.stores`), bumped atomically with `incr`, so it is
+constant size however hard it is hit, and a failing cache falls back to
+per-process counters behind the circuit breaker instead of failing
+logins.
+Once a username at an address, an account or an address has reached its
+limit (`TWOFACTOR_THROTTLE_USERNAME_COUNT`,
+`TWOFACTOR_THROTTLE_ACCOUNT_COUNT`, `TWOFACTOR_THROTTLE_IP_COUNT`; 0
+turns a limit off), further attempts are refused with one cache read,
+without a password hash. Usernames are the ones logged in with, after
+the login form has looked up an email address.
+
+The client address is `REMOTE_ADDR` unless
+`TWOFACTOR_THROTTLE_IP_HEADER` names another `request.META` key (e.g.
+"HTTP_X_REAL_IP" behind a proxy that sets it).
+"""
+
+import hashlib
+
+from django.utils.encoding import force_bytes
+
+from django_twofactor.conf import get_config
+from django_twofactor.stores import get_store
+
+
+COUNTER_KEY = "twofactor-throttle-{0}-{1}-{2}"
+
+
+def client_ip(request):
+    """ The address to throttle `request` by, or None without a request. """
+    if request is None:
+        return None
+    header = get_config().throttle_ip_header or "REMOTE_ADDR"
+    return request.META.get(header) or None
+
+
+def _counters(username, ip):
+    """ `(store key, limit)` of each counter that applies to an attempt. """
+    config = get_config()
+    window = int(config.clock() // config.throttle_timeframe)
+    counters = []
+    user = username and u"%s\n%s" % (username, ip or u"")
+    for kind, value, limit in (
+            ("user", user, config.throttle_username_count),
+            ("account", username, config.throttle_account_count),
+            ("ip", ip, config.throttle_ip_count)):
+        if value and limit:
+            # Hashed, so that any username makes a short, safe cache key.
+            digest = hashlib.md5(force_bytes(value)).hexdigest()
+            counters.append((COUNTER_KEY.format(kind, digest, window), limit))
+    return counters
+
+
+def is_throttled(username, ip=None):
+    """
+    Whether attempts for `username` from `ip`, or from `ip`, are over the
+    limit.
+    """
+    counters = _counters(username, ip)
+    if not counters:
+        return False
+    counts = get_store().get_many([key for key, limit in counters])
+    return any(counts.get(key, 0) >= limit for key, limit in counters)
+
+
+def record_failure(username, ip=None):
+    """ Counts a failed login for `username` and `ip`. """
+    store = get_store()
+    timeout = get_config().throttle_timeframe
+    for key, limit in _counters(username, ip):
+        store.incr(key, timeout)
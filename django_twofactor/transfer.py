@@ -0,0 +1,220 @@
+"""
+Streaming export and import of two-factor enrollments, used by the
+`twofactor_export` and `twofactor_import` commands.
+
+The format is JSON lines: a header, one line per device and a trailer::
+
+    {"format": "django_twofactor", "version": 2,
+     "kdf": "pbkdf2_sha256", "iterations": 100000, "salt": "<salt>"}
+    {"username": "bob", "name": "", "type": 1, "is_active": true,
+     "counter": 0, "last_time_step": 49382211, "time_drift": 0,
+     "seed": "<salt>$<hex>", "mac": "<hex>"}
+    {"count": 1, "mac": "<hex>"}
+
+Users are identified by username, so that the file can be loaded into a
+database with different primary keys. The transport key is stretched
+with PBKDF2 and the header's salt into two keys: `seed` is encrypted like
+stored seeds under the first, in place of `SECRET_KEY` and
+`TWOFACTOR_ENCRYPTION_KEY`, so the file can be moved between sites with
+different keys, and each line is authenticated with an HMAC under the
+second. The trailer's count catches truncated files. A wrong key or an
+altered file makes the import fail and roll back entirely.
+
+Rows are read with `iterator()` and written back with `bulk_create` in
+batches, so memory use doesn't grow with the number of devices.
+"""
+
+import gzip
+import hmac
+import io
+import json
+import sys
+from functools import reduce
+from hashlib import sha256
+from operator import or_
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.utils.crypto import constant_time_compare, pbkdf2
+from django.utils.encoding import force_bytes
+
+from django_twofactor.encutil import _gen_salt, decrypt, encrypt
+from django_twofactor.models import UserAuthToken
+from django_twofactor.util import chunks, decrypt_value, encrypt_value
+
+
+FIELDS = ("name", "type", "is_active", "counter", "last_time_step",
+          "time_drift")
+
+FORMAT = "django_twofactor"
+VERSION = 2
+KDF_ITERATIONS = 100000
+
+
+def open_stream(path, mode):
+    """
+    Opens `path` in binary `mode` ("rb" or "wb"), gzipped if it ends in
+    ".gz". "-" is stdin or stdout.
+    """
+    if path == "-":
+        stream = sys.stdin if mode == "rb" else sys.stdout
+        return getattr(stream, "buffer", stream)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return io.open(path, mode)
+
+
+def _derive_keys(transport_key, salt, iterations):
+    """ The encryption and MAC keys for `transport_key`. """
+    key = pbkdf2(transport_key, salt, iterations, dklen=64, digest=sha256)
+    return key[:32], key[32:]
+
+
+def _mac(mac_key, record):
+    message = json.dumps(record, sort_keys=True)
+    return hmac.new(mac_key, force_bytes(message), sha256).hexdigest()
+
+
+def _signed(mac_key, record):
+    record["mac"] = _mac(mac_key, record)
+    return json.dumps(record, sort_keys=True)
+
+
+def _verified(mac_key, line_number, line):
+    """ The record on `line`, if its MAC is right; raises ValueError. """
+    try:
+        record = json.loads(line)
+        mac = record.pop("mac")
+    except (ValueError, KeyError, AttributeError):
+        raise ValueError("Line %d is not a device record." % line_number)
+    if not constant_time_compare(mac, _mac(mac_key, record)):
+        raise ValueError("Line %d doesn't match its MAC: wrong transport "
+                         "key, or the file was altered." % line_number)
+    return record
+
+
+def export_tokens(out, transport_key, queryset=None, chunk_size=1000,
+                  progress=None):
+    """
+    Writes the devices in `queryset` (default: all) to the binary stream
+    `out`, re-encrypting each seed under `transport_key`. `progress` is
+    called with the running total after every chunk. Returns the total.
+    """
+    if queryset is None:
+        queryset = UserAuthToken.objects.all()
+    rows = (queryset.order_by("pk")
+                    .values("user__username", "encrypted_seed", *FIELDS)
+                    .iterator())
+    kdf_salt = _gen_salt()
+    seed_key, mac_key = _derive_keys(transport_key, kdf_salt, KDF_ITERATIONS)
+    header = {"format": FORMAT, "version": VERSION, "kdf": "pbkdf2_sha256",
+              "iterations": KDF_ITERATIONS, "salt": kdf_salt}
+    out.write((json.dumps(header, sort_keys=True) + "\n").encode("utf-8"))
+    total = 0
+    for chunk in chunks(rows, chunk_size):
+        lines = []
+        for row in chunk:
+            record = dict((field, row[field]) for field in FIELDS)
+            record["username"] = row["user__username"]
+            salt = _gen_salt()
+            record["seed"] = "%s$%s" % (salt, encrypt(
+                decrypt_value(row["encrypted_seed"]), salt, seed_key))
+            lines.append(_signed(mac_key, record))
+        out.write(("\n".join(lines) + "\n").encode("utf-8"))
+        total += len(chunk)
+        if progress is not None:
+            progress(total)
+    out.write((_signed(mac_key, {"count": total}) + "\n").encode("utf-8"))
+    return total
+
+
+def import_tokens(lines, transport_key, batch_size=1000, replace=False,
+                  progress=None):
+    """
+    Loads devices from an iterable of JSON `lines`, re-encrypting each seed
+    for this site. Devices whose user already has one of the same name are
+    skipped, or replaced if `replace` is set; devices of unknown users are
+    skipped. `progress` is called with the running counts after every
+    batch. Returns a dict of counts: created, replaced, existing, no_user.
+
+    Raises ValueError, with nothing written, if the file isn't a complete
+    export made with `transport_key`.
+    """
+    lines = iter(enumerate(
+        (line for line in lines if line.strip()), start=1))
+    try:
+        header = json.loads(next(lines)[1])
+    except (StopIteration, ValueError):
+        header = None
+    if (not isinstance(header, dict) or header.get("format") != FORMAT or
+            header.get("version") != VERSION or
+            header.get("kdf") != "pbkdf2_sha256"):
+        raise ValueError("Not a file written by this version of "
+                         "twofactor_export.")
+    seed_key, mac_key = _derive_keys(
+        transport_key, header["salt"], header["iterations"])
+
+    # Every record is checked before its batch is written, and the whole
+    # import is one transaction, so a bad line anywhere leaves the
+    # database as it was.
+    seen = [0]
+    trailer = []
+
+    def records():
+        for line_number, line in lines:
+            record = _verified(mac_key, line_number, line)
+            if "count" in record:
+                trailer.append(record["count"])
+                return
+            seen[0] += 1
+            yield record
+
+    with transaction.atomic():
+        counts = _import_records(records(), seed_key, batch_size, replace,
+                                 progress)
+        if trailer != seen or next(lines, None) is not None:
+            raise ValueError("The file is truncated or has extra lines.")
+    return counts
+
+
+def _import_records(records, seed_key, batch_size, replace, progress):
+    counts = {"created": 0, "replaced": 0, "existing": 0, "no_user": 0}
+    for batch in chunks(records, batch_size):
+        user_ids = dict(User.objects.filter(
+            username__in=set(record["username"] for record in batch)
+        ).values_list("username", "pk"))
+
+        # Keyed by (user, name): a later line for the same device wins.
+        tokens = {}
+        for record in batch:
+            user_id = user_ids.get(record["username"])
+            if user_id is None:
+                counts["no_user"] += 1
+                continue
+            salt, encrypted = record["seed"].split("$", 1)
+            tokens[(user_id, record["name"])] = UserAuthToken(
+                user_id=user_id,
+                encrypted_seed=encrypt_value(
+                    decrypt(encrypted, salt, seed_key)),
+                **dict((field, record[field]) for field in FIELDS))
+
+        existing = set(UserAuthToken.objects.filter(
+            user__in=set(user_id for user_id, name in tokens),
+        ).values_list("user_id", "name")) & set(tokens)
+        replaced = 0
+        if existing and replace:
+            replaced = len(existing)
+            UserAuthToken.objects.filter(reduce(or_, [
+                Q(user=user_id, name=name) for user_id, name in existing
+            ])).delete()
+            counts["replaced"] += replaced
+        else:
+            for key in existing:
+                del tokens[key]
+            counts["existing"] += len(existing)
+        UserAuthToken.objects.bulk_create(list(tokens.values()))
+        counts["created"] += len(tokens) - replaced
+        if progress is not None:
+            progress(counts)
+    return counts
@@ -0,0 +1,91 @@
+"""
+Records when devices were last used, without a database write per login.
+
+A successful verification only notes the device and the time in this
+process. Once `TWOFACTOR_LAST_USED_INTERVAL` seconds (default 300; 0 turns
+tracking off) have passed since the last flush, the next one writes all
+noted times to `UserAuthToken.last_used` with a single UPDATE per
+`FLUSH_BATCH_SIZE` devices, so each device is written at most once per
+interval and process. `UserAuthToken.last_used` can thus lag by that much,
+and uses noted by a process that exits before its next flush are lost;
+call `flush()` on shutdown if that matters. A flush that fails is logged
+and its times are kept for the next one; it never fails the login. A
+time is never written over a later one, e.g. from another process.
+"""
+
+import logging
+import threading
+
+from django.db import transaction
+from django.db.models import Case, DateTimeField, F, Q, Value, When
+from django.utils import timezone
+
+from django_twofactor.conf import get_config, perf_counter
+
+
+logger = logging.getLogger(__name__)
+
+
+FLUSH_BATCH_SIZE = 500
+
+_pending = {}
+_lock = threading.Lock()
+_last_flush = [None]
+
+
+def record(token):
+    """ Notes that `token` was just used, and flushes if it is time. """
+    config = get_config()
+    if not config.last_used_interval:
+        return
+    now = perf_counter()
+    with _lock:
+        _pending[token.pk] = timezone.now()
+        if _last_flush[0] is None:
+            _last_flush[0] = now
+        due = now - _last_flush[0] >= config.last_used_interval
+        if due:
+            _last_flush[0] = now
+    if due:
+        flush()
+
+
+def flush():
+    """
+    Writes the noted times to the database. Returns how many were
+    written.
+    """
+    from django_twofactor.models import UserAuthToken
+
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    pending = sorted(pending.items())
+    for i in range(0, len(pending), FLUSH_BATCH_SIZE):
+        batch = pending[i:i + FLUSH_BATCH_SIZE]
+        try:
+            # In a savepoint, so that a failure doesn't break the request's
+            # transaction.
+            with transaction.atomic():
+                UserAuthToken.objects.filter(
+                    pk__in=[pk for pk, used in batch]
+                ).update(last_used=Case(
+                    *[When(Q(pk=pk) & (Q(last_used__isnull=True) |
+                                       Q(last_used__lt=used)),
+                           then=Value(used))
+                      for pk, used in batch],
+                    default=F("last_used"),
+                    output_field=DateTimeField()))
+        except Exception:
+            logger.exception("Two-factor last used times not written")
+            _requeue(pending[i:])
+            return i
+    return len(pending)
+
+
+def _requeue(items):
+    """ Notes `items` again, unless a later use has been noted since. """
+    with _lock:
+        for pk, used in items:
+            if pk not in _pending or _pending[pk] < used:
+                _pending[pk] = used
@@ -1,14 +1,18 @@
 from base64 import b32encode
 from binascii import hexlify
 from hashlib import sha256, md5
+from itertools import chain, islice
 import string
+import threading
 try:
     from urllib.parse import urlencode
 except ImportError:
     from urllib import urlencode
+from django_twofactor.conf import get_config, perf_counter
 from django_twofactor.encutil import encrypt, decrypt, _gen_salt
-from oath import accept_hotp, accept_totp, hotp
+from django_twofactor.shadow import get_shadow
 from django.conf import settings
+from django.utils.crypto import constant_time_compare
 from django.utils.encoding import force_bytes
 
 # Get best `random` implementation we can.
@@ -18,27 +22,26 @@ try:
 except:
     pass
 
-# Newer versions of oath have the `hotp` function as `oath.hotp`,
-# older versions as `oath.hotp.hotp`
-try:
-    hotp = hotp.hotp
-except AttributeError:
-    pass
-
-# Parse out some settings, if we have 'em.
-TOTP_OPTIONS = getattr(settings, "TWOFACTOR_TOTP_OPTIONS", {})
-PERIOD = TOTP_OPTIONS.get('period', 30)
-FORWARD_DRIFT = TOTP_OPTIONS.get('forward_drift', 1)
-BACKWARD_DRIFT = TOTP_OPTIONS.get('backward_drift', 1)
-
-# note: Google Authenticator only outputs dec6, so changing this
-# will result in incompatibility
-DEFAULT_TOKEN_TYPE = TOTP_OPTIONS.get('default_token_type', "dec6")
+_oath_functions = None
 
-ENCRYPTION_KEY = getattr(settings, "TWOFACTOR_ENCRYPTION_KEY", "")
+def load_oath():
+    """
+    Imports python-oath on first use (or from `django_twofactor.warm_up`)
+    and returns its `(accept_hotp, hotp)` functions.
+    """
+    global _oath_functions
+    if _oath_functions is None:
+        from oath import accept_hotp, hotp
+        # Newer versions of oath have the `hotp` function as `oath.hotp`,
+        # older versions as `oath.hotp.hotp`
+        try:
+            hotp = hotp.hotp
+        except AttributeError:
+            pass
+        _oath_functions = (accept_hotp, hotp)
+    return _oath_functions
 
 CHECKSUM_LENGTH = 1
-HOTP_MAX_COUNTER = getattr(settings, "HOTP_MAX_COUNTER", 100)
 
 def random_seed(rawsize=10):
     """ Generates a random seed as a raw byte string. """
@@ -46,36 +49,98 @@ def random_seed(rawsize=10):
 
 def encrypt_value(raw_value):
     salt = _gen_salt()
-    return "%s$%s" %  (salt, encrypt(raw_value, ENCRYPTION_KEY+salt))
+    return "%s$%s" %  (salt, encrypt(raw_value, get_config().encryption_key+salt))
 
 def decrypt_value(salted_value):
     salt, encrypted_value = salted_value.split("$", 1)
-    return decrypt(encrypted_value, ENCRYPTION_KEY+salt)
+    return decrypt(encrypted_value, get_config().encryption_key+salt)
 
 def check_raw_seed(raw_seed, auth_code, token_type=None):
     """
     Checks whether `auth_code` is a valid authentication code at the current time,
     based on the `raw_seed` (raw byte string representation of `seed`).
     """
-    if not token_type:
-        token_type = DEFAULT_TOKEN_TYPE
-    return accept_totp(
-        hexlify(force_bytes(raw_seed)).decode('ascii'),
-        auth_code,
-        token_type,
-        period=PERIOD,
-        forward_drift=FORWARD_DRIFT,
-        backward_drift=BACKWARD_DRIFT
-    )[0]
+    return match_totp_step(raw_seed, auth_code, token_type) is not None
+
+def match_totp_step(raw_seed, auth_code, token_type=None, t=None, drift=0):
+    """
+    Returns the TOTP time step (seconds since epoch // period) for which
+    `auth_code` is valid around time `t` (default: now), or None.
+
+    Steps are tried nearest first, starting from `drift`: the offset in
+    steps at which the device last matched. After that the configured
+    window around `t` is tried, in case the device has been resynced. No
+    step more than `max_forward_drift` after `t` or `max_backward_drift`
+    before it is accepted.
+    """
+    config = get_config()
+    if t is None:
+        t = config.clock()
+    token_type = token_type or config.token_type
+    return _shadowed("match_totp_step", _match_totp_step,
+                     (raw_seed, auth_code, token_type, t, drift))
+
+def _match_totp_step(raw_seed, auth_code, token_type, t, drift):
+    config = get_config()
+    hotp = load_oath()[1]
+    current_step = int(t) // config.period
+    key = hexlify(force_bytes(raw_seed)).decode('ascii')
+    for offset in _drift_search_order(config, drift):
+        step = current_step + offset
+        if step >= 0 and constant_time_compare(
+                hotp(key, step, token_type), auth_code):
+            return step
+    return None
+
+def _shadowed(kind, func, args):
+    """
+    Returns `func(*args)`, and compares it with the shadow engine's result
+    when shadow verification is on (see `django_twofactor.shadow`).
+    """
+    shadow = get_shadow()
+    if shadow is None:
+        return func(*args)
+    start = perf_counter()
+    result = func(*args)
+    shadow.compare(kind, args, result, perf_counter() - start)
+    return result
+
+def _drift_search_order(config, drift):
+    """
+    The time step offsets to try for a device that has drifted `drift`
+    steps: the window around the drift first, then the steps of the usual
+    window not tried yet. Each step comes once, within the drift bounds.
+    """
+    if drift:
+        candidates = chain((drift + o for o in config.drift_search_order),
+                           config.drift_search_order)
+    else:
+        candidates = config.drift_search_order
+    offsets = []
+    for offset in candidates:
+        if (-config.max_backward_drift <= offset <=
+                config.max_forward_drift and offset not in offsets):
+            offsets.append(offset)
+    return offsets
+
+def current_time_step(t=None):
+    """ The TOTP time step at time `t` (default: now). """
+    config = get_config()
+    if t is None:
+        t = config.clock()
+    return int(t) // config.period
 
 def check_hotp(raw_seed, auth_code, counter, token_type=None):
     """
     Checks whether `auth_code` is a valid authentication code for `counter`
     based on the `raw_seed` (raw byte string representation of `seed`).
     """
-    if not token_type:
-        token_type = DEFAULT_TOKEN_TYPE
+    return _shadowed("check_hotp", _check_hotp,
+                     (raw_seed, auth_code, counter,
+                      token_type or get_config().token_type))
 
+def _check_hotp(raw_seed, auth_code, counter, token_type):
+    accept_hotp = load_oath()[0]
     return accept_hotp(
         hexlify(force_bytes(raw_seed)).decode('ascii'),
         auth_code,
@@ -92,12 +157,11 @@ def get_hotp(raw_seed, counter, token_type=None):
     Checks whether `auth_code` is a valid authentication code for `counter`
     based on the `raw_seed` (raw byte string representation of `seed`).
     """
-    if not token_type:
-        token_type = DEFAULT_TOKEN_TYPE
+    hotp = load_oath()[1]
     return hotp(
         hexlify(force_bytes(raw_seed)).decode('ascii'),
         counter,
-        token_type,
+        token_type or get_config().token_type,
     )
 
 def get_google_url(raw_seed, hostname=None, type="totp"):
@@ -161,13 +225,56 @@ def random_base36_with_checksum(length=10):
     return "%s%s" % (base36, checksum)
 
 
-def list_codes(raw_seed, n=HOTP_MAX_COUNTER):
+def list_codes(raw_seed, n=None):
     """
-    Get a generator over `n` first HOTP codes.
+    Get a generator over `n` (default: `HOTP_MAX_COUNTER`) first HOTP codes.
     """
+    if n is None:
+        n = get_config().hotp_max_counter
     for i in range(n):
         yield get_hotp(raw_seed, i)
 
 
+def chunks(iterable, size):
+    """ Yields lists of up to `size` consecutive items of `iterable`. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class SingleFlight(object):
+    """
+    Runs a function once for concurrent callers with the same key: the
+    first caller runs it, the others wait and get its result (or its
+    exception). Nothing is kept once the call is done.
+    """
 
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
 
+    def do(self, key, func):
+        """ Returns `(result, shared)` of `func()` for `key`. """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event()}
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"], True
+        try:
+            call["result"] = func()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+        return call["result"], False
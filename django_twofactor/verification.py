@@ -0,0 +1,132 @@
+"""
+Remembers in the session that a user passed two-factor authentication, so
+that views can require it (see `decorators.twofactor_required` and
+`middleware.TwoFactorMiddleware`) without querying their tokens.
+
+The session is stamped with the user, the device and the time when a login
+with a token succeeds. Resetting, disabling or deleting a device records
+the time in a `TwoFactorRevocation` row of the user, which voids older
+stamps of all of that user's sessions. The time is cached, so checking a
+stamp usually costs one cache read; when the cache has lost it or can't be
+reached, it is read from the database instead.
+"""
+
+import logging
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY as AUTH_SESSION_KEY
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+
+from django_twofactor.conf import get_config
+
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = "_twofactor_verified"
+REVOKED_KEY = "twofactor-revoked-{0}"
+
+
+def stamp(request, token):
+    """ Records in `request.session` that `token` was just verified. """
+    # Caches the user's revocation time, for get_verification().
+    revoked_at(token.user_id)
+    request.session[SESSION_KEY] = {
+        "user_id": str(token.user_id),
+        "token_id": token.pk,
+        "time": get_config().clock(),
+    }
+    request._twofactor_verification = request.session[SESSION_KEY]
+
+
+def get_verification(request):
+    """
+    The stamp of `request.session` (a dict with `user_id`, `token_id` and
+    `time`) if it is still valid, else None.
+    """
+    if hasattr(request, "_twofactor_verification"):
+        return request._twofactor_verification
+
+    verification = request.session.get(SESSION_KEY)
+    if verification is not None:
+        # The auth session key is a string on every Django version.
+        if verification["user_id"] != str(
+                request.session.get(AUTH_SESSION_KEY)):
+            verification = None
+        else:
+            revoked = revoked_at(verification["user_id"])
+            if revoked is not None and revoked >= verification["time"]:
+                del request.session[SESSION_KEY]
+                verification = None
+    request._twofactor_verification = verification
+    return verification
+
+
+def is_verified(request):
+    return get_verification(request) is not None
+
+
+def revoked_at(user_id):
+    """
+    When the stamps and grants of user `user_id` were last voided, or None.
+    """
+    from django_twofactor.models import TwoFactorRevocation
+
+    key = REVOKED_KEY.format(user_id)
+    try:
+        revoked = cache.get(key)
+    except Exception:
+        logger.exception("Can't read two-factor revocations from the cache")
+        revoked = None
+    if revoked is None:
+        # 0 caches that there is none.
+        revoked = TwoFactorRevocation.objects.filter(
+            user_id=user_id).values_list("time", flat=True).first() or 0
+        try:
+            cache.set(key, revoked, settings.SESSION_COOKIE_AGE)
+        except Exception:
+            pass
+    return revoked or None
+
+
+def revoke(user_ids):
+    """ Voids the existing stamps of the users in `user_ids`. """
+    from django_twofactor.models import TwoFactorRevocation
+
+    user_ids = set(int(user_id) for user_id in user_ids)
+    now = get_config().clock()
+    revocations = TwoFactorRevocation.objects.filter(user_id__in=user_ids)
+    if revocations.update(time=now) < len(user_ids):
+        missing = user_ids - set(revocations.values_list("user_id", flat=True))
+        try:
+            with transaction.atomic():
+                TwoFactorRevocation.objects.bulk_create(
+                    [TwoFactorRevocation(user_id=user_id, time=now)
+                     for user_id in missing])
+        except IntegrityError:
+            # Another request created some of them meanwhile.
+            for user_id in missing:
+                TwoFactorRevocation.objects.update_or_create(
+                    user_id=user_id, defaults={"time": now})
+    # The database has it; the cache is only a shortcut.
+    try:
+        cache.set_many(
+            dict((REVOKED_KEY.format(user_id), now) for user_id in user_ids),
+            settings.SESSION_COOKIE_AGE)
+    except Exception:
+        logger.exception("Can't cache two-factor revocations")
+
+
+def _stamp_on_login(sender, request, user, **kwargs):
+    if request is None or not hasattr(request, "session"):
+        return
+    token = getattr(user, "twofactor_token", None)
+    if token is not None:
+        stamp(request, token)
+    else:
+        request.session.pop(SESSION_KEY, None)
+        request._twofactor_verification = None
+
+
+user_logged_in.connect(_stamp_on_login)
@@ -1,31 +1,41 @@
 from django.shortcuts import render
 from django.views.decorators.cache import never_cache
 from django.contrib.auth.decorators import login_required
-from django.conf import settings
 from django.core.cache import cache
 from django.utils.encoding import force_text
 
+from . import gridcard_pool
+from .conf import get_config
 from .util import key_to_seed, random_base36_with_checksum, list_codes
 
 
-GRIDCARD_CACHE_KEY = getattr(
-    settings, "TWOFACTOR_GRIDCARD_CACHE_KEY", "twofactor-gridcard-{0}")
-GRIDCARD_CACHE_TIME = getattr(
-    settings, "TWOFACTOR_GRIDCARD_CACHE_TIME", 24 * 60 * 60)
-
-
 @never_cache
 @login_required
 def generate_gridcard(request):
-    cache_key = GRIDCARD_CACHE_KEY.format(request.user.username)
+    config = get_config()
+    cache_key = config.gridcard_cache_key.format(request.user.username)
 
     key = cache.get(cache_key)
+    codes = None
     if not key:
-        key = random_base36_with_checksum()
-        cache.set(cache_key, key, GRIDCARD_CACHE_TIME)
+        entry = gridcard_pool.claim() if config.gridcard_pool_size else None
+        if entry:
+            key, codes = entry
+        else:
+            key = random_base36_with_checksum()
+        # `add` so that simultaneous requests of a user agree on one key.
+        if cache.add(cache_key, key, config.gridcard_cache_time):
+            if codes:
+                cache.set(gridcard_pool.CODES_KEY.format(key), codes,
+                          config.gridcard_cache_time)
+        else:
+            key = cache.get(cache_key) or key
+            codes = None
     key = force_text(key)
-    raw_seed = key_to_seed(key)
-    codes = list_codes(raw_seed)
+    if codes is None:
+        codes = cache.get(gridcard_pool.CODES_KEY.format(key))
+    if codes is None:
+        codes = list_codes(key_to_seed(key))
 
     context = {
         "key": key,
@@ -8,6 +8,8 @@ template_patterns = ['templates/*.html',
 
 package_name = 'django_twofactor'
 packages = ['django_twofactor',
+            'django_twofactor.management',
+            'django_twofactor.management.commands',
             'django_twofactor.migrations']
 
 long_description = open("README.mdown").read() + "\n"
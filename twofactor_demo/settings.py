@@ -99,6 +99,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django_twofactor.middleware.TwoFactorMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
 )
 
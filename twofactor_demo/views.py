@@ -8,13 +8,16 @@ from django_twofactor.forms import (
 
 @login_required(login_url="/")
 def change_settings(request):
+    # Loaded once by TwoFactorMiddleware and shared by the forms below.
+    tokens = request.twofactor_tokens
     reset_form = None
     disable_form = None
     gridcard_form = None
     if request.method == "POST":
         post = request.POST
         if post.get("reset_confirmation"):
-            reset_form = ResetTwoFactorAuthForm(request.user, data=post)
+            reset_form = ResetTwoFactorAuthForm(
+                request.user, tokens=tokens, data=post)
             if reset_form.is_valid():
                 reset_form.save()
                 return redirect("auth-enabled")
@@ -30,7 +33,9 @@ def change_settings(request):
                 return redirect("auth-enabled-gridcard")
 
     return render(request, "twofactor_demo/settings.html", {
-        "reset_form": reset_form or ResetTwoFactorAuthForm(request.user),
+        "tokens": tokens,
+        "reset_form": reset_form or ResetTwoFactorAuthForm(
+            request.user, tokens=tokens),
         "disable_form": disable_form or DisableTwoFactorAuthForm(request.user),
         "gridcard_form": gridcard_form or GridCardActivationForm(request.user),
     })